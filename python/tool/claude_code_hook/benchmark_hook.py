@@ -0,0 +1,643 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Benchmarks for the CozeLoop Claude Code hook.
+
+Usage:
+    python benchmark_hook.py resume
+    python benchmark_hook.py payload
+    python benchmark_hook.py startup
+    python benchmark_hook.py parse
+    python benchmark_hook.py truncate
+    python benchmark_hook.py exporter
+    python benchmark_hook.py construct
+    python benchmark_hook.py pipeline [--sizes 10x5,40x5,100x5]
+    python benchmark_hook.py generate OUT.jsonl [--turns 50 --steps 10 --fan-out 2 ...]
+"""
+
+import argparse
+import gzip
+import http.server
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import cozeloop_hook  # noqa: E402
+
+
+HOOK_SCRIPT = str(Path(__file__).resolve().parent / "cozeloop_hook.py")
+
+
+class _TranscriptWriter:
+    """Write records with the envelope Claude Code puts around every transcript line."""
+
+    def __init__(self, f, session_id: str, rng: random.Random):
+        self.f = f
+        self.rng = rng
+        self.header = {"isSidechain": False, "userType": "external", "cwd": "/home/dev/project",
+                       "sessionId": session_id, "version": "2.0.0", "gitBranch": "main"}
+        self.clock = datetime(2026, 1, 1, tzinfo=timezone.utc)
+        self.parent_uuid = None
+        self.serial = 0
+        self.encode = json.JSONEncoder(separators=(",", ":"), ensure_ascii=False).encode
+
+    def uuid(self) -> str:
+        self.serial += 1
+        return f"{self.rng.getrandbits(32):08x}-0000-4000-8000-{self.serial:012x}"
+
+    def tick(self, seconds: float) -> str:
+        self.clock += timedelta(seconds=seconds)
+        return self.clock.isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+    def emit(self, record_type: str, seconds: float = 0.05, **fields):
+        uuid = self.uuid()
+        self.f.write(self.encode(dict(self.header, parentUuid=self.parent_uuid, type=record_type,
+                                      uuid=uuid, timestamp=self.tick(seconds), **fields)) + "\n")
+        self.parent_uuid = uuid
+
+    def raw(self, record: Dict[str, Any]):
+        self.f.write(self.encode(record) + "\n")
+
+
+def _tool_output(rng: random.Random, tool_id: str, size: int) -> str:
+    """Tool output of roughly `size` chars (+-50%) that differs between calls."""
+    n = max(size // 2 + rng.randrange(size + 1), 16)
+    line = f"{tool_id} " + "".join(rng.choice("abcdefghij") for _ in range(60)) + "\n"
+    return (line * (n // len(line) + 1))[:n]
+
+
+def _assistant_lines(w: _TranscriptWriter, msg_id: str, blocks: List[Dict[str, Any]], split_lines: bool,
+                     usage: Dict[str, int], seconds: float, stop_reason: Optional[str] = None, **fields):
+    """Write one API response, one block per line when `split_lines` (as Claude Code does)."""
+    groups = [[block] for block in blocks] if split_lines else [blocks]
+    for k, group in enumerate(groups):
+        last = k == len(groups) - 1
+        w.emit("assistant", seconds if k == 0 else 0.01, requestId=f"req_{msg_id}", message={
+            "role": "assistant", "id": msg_id, "type": "message", "model": "claude-sonnet-4-5",
+            "content": group, "stop_reason": stop_reason,
+            "usage": usage if last else dict(usage, output_tokens=1)}, **fields)
+
+
+def generate_transcript(path: str, n_turns: int, steps_per_turn: int = 5, fan_out: int = 1,
+                        output_size: int = 1500, split_lines: bool = True, thinking: bool = True,
+                        subagent_every: int = 4, subagent_steps: int = 3, snapshots: bool = True,
+                        seed: int = 0, session_id: str = "bench-session"):
+    """Write a synthetic Claude Code transcript.
+
+    Every turn is a user prompt followed by `steps_per_turn` model calls that
+    each run `fan_out` tools in parallel, and a final text answer. With
+    `split_lines` the thinking, text and tool_use blocks of one response are
+    written as separate lines sharing `message.id`. Every `subagent_every`-th
+    step (0 = never) runs a Task tool whose sub-agent makes `subagent_steps`
+    calls, written as progress records before the Task result. File history
+    snapshots and system records are interleaved as in real sessions.
+    """
+    rng = random.Random(seed)
+    context_tokens = 8000
+    with open(path, 'w', encoding='utf-8') as f:
+        w = _TranscriptWriter(f, session_id, rng)
+        for t in range(n_turns):
+            if snapshots:
+                w.raw({"type": "file-history-snapshot", "messageId": w.uuid(), "isSnapshotUpdate": False,
+                       "snapshot": {"messageId": f"snap_{t}", "timestamp": w.tick(0),
+                                    "trackedFileBackups": {
+                                        f"/home/dev/project/src/module_{k}.py": {
+                                            "backupFileName": f"{k:016x}@v{t}", "version": t,
+                                            "backupTime": w.tick(0)}
+                                        for k in range(min(t + 1, 50))}}})
+            w.emit("user", 20, message={"role": "user", "content": f"task {t}: " + "please look into it " * 10})
+            if snapshots:
+                w.emit("system", subtype="informational", content="hook output " + "x" * 200, level="info")
+            for k in range(steps_per_turn + 1):
+                final = k == steps_per_turn
+                msg_id = f"msg_{t:04d}_{k:03d}"
+                blocks: List[Dict[str, Any]] = []
+                if thinking:
+                    blocks.append({"type": "thinking", "thinking": f"step {k} of turn {t} " + "hmm " * 40,
+                                   "signature": "c2ln" * 20})
+                blocks.append({"type": "text", "text": (f"done with task {t}" if final else f"running step {k}")})
+                subagent = not final and subagent_every and (k + 1) % subagent_every == 0
+                tool_ids = [] if final else [f"toolu_{t:04d}_{k:03d}_{j}" for j in range(fan_out)]
+                for j, tool_id in enumerate(tool_ids):
+                    if subagent and j == 0:
+                        blocks.append({"type": "tool_use", "id": tool_id, "name": "Task", "input": {
+                            "description": f"explore {k}", "subagent_type": "Explore",
+                            "prompt": "find the relevant code " * 5}})
+                    else:
+                        blocks.append({"type": "tool_use", "id": tool_id, "name": "Bash" if j % 2 == 0 else "Read",
+                                       "input": {"command": f"grep -rn pattern_{k}_{j} src/"}})
+                context_tokens += 400 + output_size // 4 * fan_out
+                usage = {"input_tokens": 10, "cache_creation_input_tokens": 400 + output_size // 4 * fan_out,
+                         "cache_read_input_tokens": context_tokens, "output_tokens": 150 + 30 * len(tool_ids)}
+                _assistant_lines(w, msg_id, blocks, split_lines, usage, rng.uniform(1, 6),
+                                 stop_reason="end_turn" if final else "tool_use")
+                for j, tool_id in enumerate(tool_ids):
+                    if subagent and j == 0:
+                        sub_usage = _write_subagent(w, rng, tool_id, t, k, subagent_steps, output_size, split_lines)
+                        w.emit("user", 0.1, message={"role": "user", "content": [
+                            {"type": "tool_result", "tool_use_id": tool_id,
+                             "content": [{"type": "text", "text": "sub-agent report " + "z" * 500}]}]},
+                               toolUseResult={"status": "completed", "agentId": f"agent_{t}_{k}",
+                                              "totalDurationMs": 30000, "usage": sub_usage})
+                    else:
+                        output = _tool_output(rng, tool_id, output_size)
+                        w.emit("user", rng.uniform(0.05, 2), message={"role": "user", "content": [
+                            {"type": "tool_result", "tool_use_id": tool_id, "content": output}]},
+                               toolUseResult={"stdout": output, "stderr": "", "interrupted": False})
+
+
+def _write_subagent(w: _TranscriptWriter, rng: random.Random, parent_id: str, t: int, k: int,
+                    n_steps: int, output_size: int, split_lines: bool) -> Dict[str, int]:
+    """Write the progress records of one Task sub-agent and return its total usage."""
+    agent_id = f"agent_{t}_{k}"
+    total = {"input_tokens": 0, "output_tokens": 0}
+
+    def progress(inner: Dict[str, Any], message_type: str, seconds: float):
+        w.emit("progress", seconds, parentToolUseID=parent_id, toolUseID=parent_id, data={
+            "type": "agent_progress", "agentId": agent_id, "prompt": "",
+            "message": {"type": message_type, "message": inner}})
+
+    progress({"role": "user", "content": [{"type": "text", "text": "find the relevant code " * 5}]}, "user", 0.1)
+    for s in range(n_steps + 1):
+        final = s == n_steps
+        msg_id = f"sub_{t:04d}_{k:03d}_{s:02d}"
+        tool_id = f"toolu_sub_{t:04d}_{k:03d}_{s:02d}"
+        blocks = [{"type": "text", "text": "summary of findings" if final else f"searching {s}"}]
+        if not final:
+            blocks.append({"type": "tool_use", "id": tool_id, "name": "Grep", "input": {"pattern": f"p{s}"}})
+        usage = {"input_tokens": 2000 + 500 * s, "output_tokens": 80}
+        total["input_tokens"] += usage["input_tokens"]
+        total["output_tokens"] += usage["output_tokens"]
+        for group in ([[b] for b in blocks] if split_lines else [blocks]):
+            progress({"role": "assistant", "id": msg_id, "model": "claude-haiku-4-5", "content": group,
+                      "usage": usage}, "assistant", rng.uniform(0.5, 3))
+        if not final:
+            progress({"role": "user", "content": [{"type": "tool_result", "tool_use_id": tool_id,
+                                                   "content": _tool_output(rng, tool_id, output_size // 2)}]},
+                     "user", rng.uniform(0.05, 1))
+    return total
+
+
+class _RecordingSpan:
+    """No-op span that counts the serialized size of inputs and outputs."""
+
+    def __init__(self, client):
+        self._client = client
+
+    def _record(self, value):
+        if hasattr(value, "model_dump_json"):
+            # As the SDK serializes tags
+            value = value.model_dump_json(exclude_none=True)
+        self._client.payload_bytes += len(str(value).encode())
+
+    def set_input(self, value):
+        self._record(value)
+
+    def set_output(self, value):
+        self._record(value)
+
+    def __getattr__(self, name):
+        if name.startswith("set_"):
+            return lambda *args, **kwargs: None
+        raise AttributeError(name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _RecordingClient:
+    """Stand-in for the CozeLoop client that exports nothing."""
+
+    def __init__(self):
+        self.payload_bytes = 0
+        self.spans = 0
+
+    def start_span(self, name, span_type, **kwargs):
+        self.spans += 1
+        return _RecordingSpan(self)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def _best_of(fn, repeat: int = 5) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def bench_resume(sizes=(30, 300, 3000), tail: int = 10):
+    """Compare line-skip resume with byte-offset resume when only `tail` lines are new."""
+    print(f"{'lines':>10} {'rescan (ms)':>12} {'offset (ms)':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_turns in sizes:
+            path = os.path.join(tmp, f"transcript_{n_turns}.jsonl")
+            generate_transcript(path, n_turns, output_size=200, snapshots=False)
+            messages = cozeloop_hook.read_new_messages(path, 0)
+            n = len(messages)
+            start_line = n - tail
+            state = {"last_processed_line": start_line}
+            cozeloop_hook.record_resume_point(state, path, messages[start_line - 1]["_end_offset"])
+
+            rescan = _best_of(lambda: cozeloop_hook.read_new_messages(path, start_line))
+            offset = _best_of(lambda: cozeloop_hook.read_new_messages(path, start_line, state))
+            assert len(cozeloop_hook.read_new_messages(path, start_line, state)) == tail
+            print(f"{n:>10} {rescan * 1000:>12.2f} {offset * 1000:>12.2f}")
+
+
+def bench_payload(sizes=((5, 10), (10, 20), (20, 40)), output_size: int = 2000):
+    """Compare payload bytes of the full and delta input modes, with and without dedup."""
+    modes = [("full", False), ("delta", False), ("full", True), ("delta", True)]
+    names = [f"{mode}{'+dedup' if dedup else ''}" for mode, dedup in modes]
+    print(f"{'turns x steps':>14} " + " ".join(f"{name + ' (KB)':>17}" for name in names) + f" {'ms':>28}")
+    input_mode, dedup_mode = cozeloop_hook.INPUT_MODE, cozeloop_hook.DEDUP_MODE
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for n_turns, steps in sizes:
+                path = os.path.join(tmp, f"session_{n_turns}_{steps}.jsonl")
+                generate_transcript(path, n_turns, steps, output_size=output_size, subagent_every=0)
+                turns = cozeloop_hook.group_messages_into_turns(cozeloop_hook.read_new_messages(path))
+                sizes_kb, times_ms = [], []
+                for mode, dedup in modes:
+                    cozeloop_hook.INPUT_MODE, cozeloop_hook.DEDUP_MODE = mode, dedup
+                    client = _RecordingClient()
+                    t0 = time.perf_counter()
+                    cozeloop_hook.send_turns_to_cozeloop(turns, "bench-session", client=client)
+                    times_ms.append((time.perf_counter() - t0) * 1000)
+                    sizes_kb.append(client.payload_bytes / 1024)
+                print(f"{f'{n_turns} x {steps}':>14} " + " ".join(f"{kb:>17.1f}" for kb in sizes_kb)
+                      + " " + "/".join(f"{ms:.0f}" for ms in times_ms).rjust(28))
+    finally:
+        cozeloop_hook.INPUT_MODE, cozeloop_hook.DEDUP_MODE = input_mode, dedup_mode
+
+
+def _run_hook(home: str, transcript: str, **env) -> float:
+    """Run the hook as Claude Code would and return its wall time in seconds."""
+    hook_env = dict(os.environ, HOME=home, **env)
+    # Exports go to a closed local port so network latency is not measured
+    hook_env.setdefault("COZELOOP_WORKSPACE_ID", "bench")
+    hook_env.setdefault("COZELOOP_API_TOKEN", "bench")
+    hook_env.setdefault("COZELOOP_API_BASE", "http://127.0.0.1:9")
+    payload = json.dumps({"transcript_path": transcript, "session_id": "bench-session",
+                          "hook_event_name": "Stop"})
+    t0 = time.perf_counter()
+    subprocess.run([sys.executable, HOOK_SCRIPT], input=payload.encode(), env=hook_env,
+                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    return time.perf_counter() - t0
+
+
+def bench_startup(base_turns: int = 20, large_turns: int = 40, steps: int = 10, repeat: int = 3):
+    """Measure hook wall time for disabled, no-op, small-delta and large-delta invocations."""
+    results = {"disabled": [], "no-op": [], "small delta": [], "large delta": []}
+    for _ in range(repeat):
+        with tempfile.TemporaryDirectory() as home:
+            path = os.path.join(home, "transcript.jsonl")
+            # Write base_turns + 1 turns, then hold back the last one for the small delta
+            generate_transcript(path, base_turns + 1, steps)
+            with open(path, 'rb') as f:
+                data = f.read()
+            turns = cozeloop_hook.group_messages_into_turns(cozeloop_hook.read_new_messages(path))
+            split = turns[base_turns]["start_offset"]
+            with open(path, 'wb') as f:
+                f.write(data[:split])
+            _run_hook(home, path)
+            results["disabled"].append(_run_hook(home, path, TRACE_TO_COZELOOP="false"))
+            results["no-op"].append(_run_hook(home, path))
+            with open(path, 'ab') as f:
+                f.write(data[split:])
+            results["small delta"].append(_run_hook(home, path))
+        with tempfile.TemporaryDirectory() as home:
+            path = os.path.join(home, "transcript.jsonl")
+            generate_transcript(path, large_turns, steps)
+            results["large delta"].append(_run_hook(home, path))
+    print(f"{'invocation':>12} {'best (ms)':>10}")
+    for name, times in results.items():
+        print(f"{name:>12} {min(times) * 1000:>10.1f}")
+
+
+def bench_parse(n_turns: int = 200, repeat: int = 5):
+    """Measure transcript parse throughput with and without the pre-decode filter and orjson."""
+    variants = [("stdlib", False), ("stdlib", True)]
+    if cozeloop_hook.orjson is not None:
+        variants += [("orjson", False), ("orjson", True)]
+    orjson_module, skipped_record_type = cozeloop_hook.orjson, cozeloop_hook.skipped_record_type
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "transcript.jsonl")
+        generate_transcript(path, n_turns)
+        size_mb = os.path.getsize(path) / (1024 * 1024)
+        print(f"{size_mb:.1f} MB, {n_turns} turns")
+        print(f"{'backend':>8} {'filter':>7} {'best (ms)':>10} {'MB/s':>8}")
+        try:
+            for backend, use_filter in variants:
+                cozeloop_hook.orjson = orjson_module if backend == "orjson" else None
+                cozeloop_hook.skipped_record_type = skipped_record_type if use_filter else (lambda line: None)
+                best = _best_of(lambda: cozeloop_hook.read_new_messages(path), repeat)
+                print(f"{backend:>8} {'on' if use_filter else 'off':>7} {best * 1000:>10.1f} {size_mb / best:>8.1f}")
+        finally:
+            cozeloop_hook.orjson, cozeloop_hook.skipped_record_type = orjson_module, skipped_record_type
+
+
+def bench_truncate(repeat: int = 5):
+    """Compare json.dumps(...)[:limit] with the bounded serializer on huge tool payloads."""
+    payloads = {
+        "10 MB text block": [{"type": "text", "text": "line of output\n" * 700_000}],
+        "5 MB image block": {"type": "image", "source": {"type": "base64", "data": "QUJD" * 1_300_000}},
+        "50k small items": [{"type": "file", "path": f"/src/module_{k}.py", "size": k} for k in range(50_000)],
+        "2 MB tool input": {"file_path": "/tmp/out.txt", "content": "x" * 2_000_000},
+    }
+    print(f"{'payload':>18} {'dumps+slice (ms)':>17} {'bounded (ms)':>13} {'speedup':>8}")
+    for name, payload in payloads.items():
+        sliced = _best_of(lambda: json.dumps(payload, ensure_ascii=False)[:4096], repeat)
+        bounded = _best_of(lambda: cozeloop_hook.dumps_bounded(payload, 4096), repeat)
+        assert cozeloop_hook.dumps_bounded(payload, 4096).startswith(json.dumps(payload, ensure_ascii=False)[:4096])
+        print(f"{name:>18} {sliced * 1000:>17.2f} {bounded * 1000:>13.3f} {sliced / bounded:>7.0f}x")
+
+
+def _run_pipeline(path: str, client: Optional[_RecordingClient] = None, trace_memory: bool = False):
+    """Run read -> group -> history -> send once, returning (seconds, peak bytes) per phase.
+
+    Grouping merges split lines into the parsed messages, so every run parses
+    the transcript afresh.
+    """
+    client = client or _RecordingClient()
+    results: Dict[str, tuple] = {}
+    data: Dict[str, Any] = {}
+    phases = [
+        ("read", lambda: cozeloop_hook.read_new_messages(path)),
+        ("group", lambda: cozeloop_hook.group_messages_into_turns(data["read"])),
+        ("history", lambda: cozeloop_hook._build_history_messages(data["group"][:-1])),
+        ("send", lambda: cozeloop_hook.send_turns_to_cozeloop(data["group"], "bench-session", client=client)),
+    ]
+    for name, fn in phases:
+        if trace_memory:
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+        t0 = time.perf_counter()
+        data[name] = fn()
+        elapsed = time.perf_counter() - t0
+        peak = tracemalloc.get_traced_memory()[1] - base if trace_memory else 0
+        results[name] = (elapsed, peak)
+    return results
+
+
+def bench_pipeline(sizes=((10, 5), (40, 5), (100, 5)), fan_out: int = 2, output_size: int = 1500,
+                   subagent_every: int = 4, repeat: int = 3):
+    """Time each stage of the export pipeline on synthetic sessions of several sizes.
+
+    Spans go to a no-op client, so the figures are the hook's own cost. Times
+    are the best of `repeat` runs; peak memory is measured in a separate run
+    under tracemalloc (which slows it down) as the growth above the memory
+    held when the phase started.
+    """
+    cozeloop_hook._import_sdk()
+    phases = ("read", "group", "history", "send")
+    print(f"input mode {cozeloop_hook.INPUT_MODE}, fan-out {fan_out}, tool output ~{output_size} chars, "
+          f"sub-agent every {subagent_every} steps")
+    print(f"{'turns x steps':>14} {'MB':>6} {'lines':>7} {'spans':>6} "
+          + " ".join(f"{name + ' ms/peak MB':>18}" for name in phases))
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_turns, steps in sizes:
+            path = os.path.join(tmp, f"session_{n_turns}_{steps}.jsonl")
+            generate_transcript(path, n_turns, steps, fan_out=fan_out, output_size=output_size,
+                                subagent_every=subagent_every)
+            with open(path, 'rb') as f:
+                n_lines = sum(1 for _ in f)
+            best = {name: float("inf") for name in phases}
+            client = _RecordingClient()
+            for _ in range(repeat):
+                client = _RecordingClient()
+                for name, (elapsed, _) in _run_pipeline(path, client).items():
+                    best[name] = min(best[name], elapsed)
+            tracemalloc.start()
+            try:
+                peaks = {name: peak for name, (_, peak) in _run_pipeline(path, trace_memory=True).items()}
+            finally:
+                tracemalloc.stop()
+            cells = [f"{best[name] * 1000:.0f}/{peaks[name] / (1024 * 1024):.1f}" for name in phases]
+            print(f"{f'{n_turns} x {steps}':>14} {os.path.getsize(path) / (1024 * 1024):>6.1f} {n_lines:>7} "
+                  f"{client.spans:>6} " + " ".join(f"{cell:>18}" for cell in cells))
+
+
+class _Collector(http.server.ThreadingHTTPServer):
+    """Local stand-in for the CozeLoop endpoints that records request bodies and headers.
+
+    Responses are 200 unless HTTP status codes are queued in `statuses`.
+    """
+
+    def __init__(self):
+        self.requests: List[bytes] = []
+        self.headers: List[Dict[str, str]] = []
+        self.statuses: List[int] = []
+
+        collector = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                if self.headers.get("Content-Encoding") == "gzip":
+                    collector.raw_bytes += len(gzip.decompress(body))
+                else:
+                    collector.raw_bytes += len(body)
+                collector.requests.append(body)
+                collector.headers.append({k.lower(): v for k, v in self.headers.items()})
+                status = collector.statuses.pop(0) if collector.statuses else 200
+                response = b'{"code":0,"msg":""}'
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, *args):
+                pass
+
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.raw_bytes = 0
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def reset(self):
+        self.requests, self.headers, self.statuses, self.raw_bytes = [], [], [], 0
+
+
+def bench_exporter(sizes=((10, 5), (40, 5)), repeat: int = 3):
+    """Compare the SDK client with the direct OTLP/HTTP exporter against a local collector.
+
+    Time covers building the spans and flushing them to the collector; bytes
+    are what crossed the wire and what that is uncompressed.
+    """
+    cozeloop_hook._import_sdk()
+    collector = _Collector()
+    # The SDK caches clients by their options, so each client is created once and flushed per run
+    clients = {
+        "sdk": cozeloop_hook._MeteredClient(cozeloop_hook.cozeloop.new_client(
+            api_base_url=collector.url, workspace_id="bench", api_token="bench")),
+        "otlp": cozeloop_hook._MeteredClient(cozeloop_hook._OtlpClient(
+            endpoint=collector.url + "/v1/traces", workspace_id="bench", api_token="bench")),
+    }
+    print(f"input mode {cozeloop_hook.INPUT_MODE}")
+    print(f"{'turns x steps':>14} {'exporter':>9} {'spans':>6} {'requests':>9} {'best (ms)':>10} "
+          f"{'wire (KB)':>10} {'raw (KB)':>9}")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for n_turns, steps in sizes:
+                path = os.path.join(tmp, f"session_{n_turns}_{steps}.jsonl")
+                generate_transcript(path, n_turns, steps)
+                for name, client in clients.items():
+                    best = float("inf")
+                    for _ in range(repeat):
+                        turns = cozeloop_hook.group_messages_into_turns(cozeloop_hook.read_new_messages(path))
+                        client.spans = 0
+                        collector.reset()
+                        t0 = time.perf_counter()
+                        cozeloop_hook.send_turns_to_cozeloop(turns, "bench-session", client=client)
+                        client.flush()
+                        best = min(best, time.perf_counter() - t0)
+                    wire = sum(len(body) for body in collector.requests)
+                    print(f"{f'{n_turns} x {steps}':>14} {name:>9} {client.spans:>6} {len(collector.requests):>9} "
+                          f"{best * 1000:>10.0f} {wire / 1024:>10.1f} {collector.raw_bytes / 1024:>9.1f}")
+    finally:
+        for client in clients.values():
+            client.close()
+        collector.shutdown()
+        collector.server_close()
+
+
+class _Unvalidated:
+    """Stand-in for a model class whose constructor skips validation."""
+
+    def __init__(self, cls):
+        self.cls = cls
+
+    def __call__(self, **fields):
+        return self.cls.model_construct(**fields)
+
+
+def bench_construct(sizes=((10, 5), (40, 5), (100, 5)), repeat: int = 3):
+    """Compare ways of building and serializing model inputs on synthetic sessions.
+
+    "history" builds the model messages of all turns with validation (as the
+    hook does) and with model_construct. "send" exports the session to a no-op
+    client that serializes what it is given, once with a ModelInput per model
+    span and once with the inputs joined from cached message encodings.
+    """
+    cozeloop_hook._import_sdk()
+    names = ("ModelMessage", "ModelMessagePart", "ModelToolCall", "ModelToolCallFunction")
+    validated = {name: getattr(cozeloop_hook, name) for name in names}
+    encode_model_input = cozeloop_hook._encode_model_input
+
+    def model_input(messages, trace):
+        return cozeloop_hook.ModelInput(messages=list(messages), tools=[],
+                                        tool_choice=cozeloop_hook.ModelToolChoice(type="", function=None))
+
+    print(f"input mode {cozeloop_hook.INPUT_MODE}")
+    print(f"{'turns x steps':>14} {'messages':>9} {'history (ms)':>13} {'construct (ms)':>15} "
+          f"{'send (ms)':>10} {'encoded (ms)':>13}")
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for n_turns, steps in sizes:
+                path = os.path.join(tmp, f"session_{n_turns}_{steps}.jsonl")
+                generate_transcript(path, n_turns, steps)
+                turns = cozeloop_hook.group_messages_into_turns(cozeloop_hook.read_new_messages(path))
+                n_messages = len(cozeloop_hook._build_history_messages(turns))
+                history = _best_of(lambda: cozeloop_hook._build_history_messages(turns), repeat)
+                for name in names:
+                    setattr(cozeloop_hook, name, _Unvalidated(validated[name]))
+                try:
+                    construct = _best_of(lambda: cozeloop_hook._build_history_messages(turns), repeat)
+                finally:
+                    for name in names:
+                        setattr(cozeloop_hook, name, validated[name])
+                send = {}
+                for label, encode in (("model", model_input), ("encoded", encode_model_input)):
+                    cozeloop_hook._encode_model_input = encode
+                    send[label] = _best_of(lambda: cozeloop_hook.send_turns_to_cozeloop(
+                        turns, "bench-session", client=_RecordingClient()), repeat)
+                cozeloop_hook._encode_model_input = encode_model_input
+                print(f"{f'{n_turns} x {steps}':>14} {n_messages:>9} {history * 1000:>13.1f} "
+                      f"{construct * 1000:>15.1f} {send['model'] * 1000:>10.0f} {send['encoded'] * 1000:>13.0f}")
+    finally:
+        cozeloop_hook._encode_model_input = encode_model_input
+
+
+def _parse_sizes(value: str):
+    """Parse "20x5,100x10" into ((20, 5), (100, 10))."""
+    return tuple(tuple(int(n) for n in size.split("x")) for size in value.split(","))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="benchmark", required=True)
+    for name in ("resume", "payload", "startup", "parse", "truncate", "exporter", "construct"):
+        commands.add_parser(name)
+    pipeline = commands.add_parser("pipeline", help="per-phase time and peak memory at several session sizes")
+    pipeline.add_argument("--sizes", type=_parse_sizes, default=((10, 5), (40, 5), (100, 5)),
+                          help="comma separated TURNSxSTEPS (default: 10x5,40x5,100x5)")
+    pipeline.add_argument("--repeat", type=int, default=3)
+    generate = commands.add_parser("generate", help="write a synthetic transcript")
+    generate.add_argument("output")
+    generate.add_argument("--seed", type=int, default=0)
+    for p in (pipeline, generate):
+        p.add_argument("--fan-out", type=int, default=2, help="parallel tool calls per step")
+        p.add_argument("--output-size", type=int, default=1500, help="average tool output size in chars")
+        p.add_argument("--subagent-every", type=int, default=4, help="run a Task sub-agent every N steps (0: never)")
+    generate.add_argument("--turns", type=int, default=50)
+    generate.add_argument("--steps", type=int, default=10, help="model calls with tool use per turn")
+    generate.add_argument("--subagent-steps", type=int, default=3)
+    generate.add_argument("--no-split", action="store_true",
+                          help="write each response on one line instead of one line per content block")
+    generate.add_argument("--no-thinking", action="store_true")
+    generate.add_argument("--no-snapshots", action="store_true",
+                          help="omit file-history-snapshot and system records")
+    args = parser.parse_args()
+    if args.benchmark == "generate":
+        generate_transcript(args.output, args.turns, args.steps, fan_out=args.fan_out,
+                            output_size=args.output_size, split_lines=not args.no_split,
+                            thinking=not args.no_thinking, subagent_every=args.subagent_every,
+                            subagent_steps=args.subagent_steps, snapshots=not args.no_snapshots,
+                            seed=args.seed)
+    elif args.benchmark == "pipeline":
+        bench_pipeline(args.sizes, fan_out=args.fan_out, output_size=args.output_size,
+                       subagent_every=args.subagent_every, repeat=args.repeat)
+    elif args.benchmark == "construct":
+        bench_construct()
+    elif args.benchmark == "exporter":
+        bench_exporter()
+    elif args.benchmark == "resume":
+        bench_resume()
+    elif args.benchmark == "payload":
+        bench_payload()
+    elif args.benchmark == "startup":
+        bench_startup()
+    elif args.benchmark == "parse":
+        bench_parse()
+    elif args.benchmark == "truncate":
+        bench_truncate()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,43 +14,296 @@ Usage:
     3. Set environment variables `COZELOOP_WORKSPACE_ID` and `COZELOOP_API_TOKEN`
        in your project's `.claude/settings.local.json`.
     4. Run Claude Code as normal - traces will be sent automatically.
+
+    For a local performance view of a transcript, without exporting:
+        python cozeloop_hook.py --report [trace.json] [--transcript FILE]
 """
 
+import argparse
+import contextlib
+import ctypes
+import ctypes.util
 import json
 import os
+import queue
+import select
+import signal
+import socket
+import struct
+import subprocess
 import sys
 import glob
+import gzip
 import hashlib
+import itertools
+import threading
+import time
 from datetime import datetime
 from pathlib import Path
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Iterable, Iterator
 
-# --- SDK Import ---
 try:
-    import cozeloop
-    from cozeloop.spec.tracespec import (
-        Runtime, ModelInput, ModelMessage, ModelToolChoice,
-        ModelOutput, ModelChoice, ModelToolCall, ModelToolCallFunction,
-        ModelMessagePart, ModelMessagePartType
-    )
+    import fcntl
+except ImportError:  # Windows: no daemon mode
+    fcntl = None
+
+try:
+    import orjson
 except ImportError:
-    print("Error: cozeloop SDK not found. Please install it with: pip install cozeloop", file=sys.stderr)
-    sys.exit(1)
+    orjson = None
+
+# --- SDK Import ---
+#
+# Importing the SDK (and pydantic with it) dominates the hook's startup time, so
+# it is deferred until something is actually exported; see _import_sdk.
+cozeloop = None
+Runtime = ModelInput = ModelMessage = ModelToolChoice = None
+ModelOutput = ModelChoice = ModelToolCall = ModelToolCallFunction = None
+ModelMessagePart = ModelMessagePartType = None
+
+def _import_sdk():
+    """Import the CozeLoop SDK into module globals on first use."""
+    global cozeloop, Runtime, ModelInput, ModelMessage, ModelToolChoice
+    global ModelOutput, ModelChoice, ModelToolCall, ModelToolCallFunction
+    global ModelMessagePart, ModelMessagePartType
+    if cozeloop is not None:
+        return
+    try:
+        import cozeloop
+        from cozeloop.spec.tracespec import (
+            Runtime, ModelInput, ModelMessage, ModelToolChoice,
+            ModelOutput, ModelChoice, ModelToolCall, ModelToolCallFunction,
+            ModelMessagePart, ModelMessagePartType
+        )
+    except ImportError:
+        print("Error: cozeloop SDK not found. Please install it with: pip install cozeloop", file=sys.stderr)
+        sys.exit(1)
 
 # --- Configuration ---
 DEBUG = os.environ.get("CC_COZELOOP_DEBUG", "").lower() == "true"
+# Model span input encoding: "full" (default) or "delta", see _set_model_input
+INPUT_MODE = os.environ.get("CC_COZELOOP_INPUT_MODE", "full").lower()
+# Span start/end times: "transcript" (line timestamps, default) or "hook" (time of export), see _span_start
+SPAN_TIMING = os.environ.get("CC_COZELOOP_SPAN_TIMING", "transcript").lower()
+# Tag turn spans with their time breakdown and critical path, see turn_time_breakdown
+TURN_ANALYTICS = os.environ.get("CC_COZELOOP_TURN_ANALYTICS", "true").lower() == "true"
+CRITICAL_PATH_TAG_CHARS = 1024
+# Prompt cache: flag a model call whose hit ratio drops below CACHE_COLLAPSE_RATIO
+# right after a call at or above CACHE_WARM_RATIO, see _check_cache_collapse
+CACHE_WARM_RATIO = 0.5
+CACHE_COLLAPSE_RATIO = float(os.environ.get("CC_COZELOOP_CACHE_COLLAPSE_RATIO", "0.2"))
+CACHE_MIN_INPUT_TOKENS = 1024
+# Context growth: token sizes tagged when first reached, and the shrink taken as a compaction, see _context_growth_tags
+CONTEXT_THRESHOLDS = sorted(int(t) for t in os.environ.get(
+    "CC_COZELOOP_CONTEXT_THRESHOLDS", "50000,100000,150000").split(",") if t.strip())
+CONTEXT_SHRINK_RATIO = float(os.environ.get("CC_COZELOOP_CONTEXT_SHRINK_RATIO", "0.5"))
+# Cross-check every Nth encoded model input against the pydantic model (0 = off), see _encode_model_input
+VALIDATE_SAMPLE = int(os.environ.get("CC_COZELOOP_VALIDATE_SAMPLE", "0"))
+# Replace repeated large text blocks within a trace by references, see _dedup_text
+DEDUP_MODE = os.environ.get("CC_COZELOOP_DEDUP", "").lower() == "true"
+DEDUP_MIN_CHARS = int(os.environ.get("CC_COZELOOP_DEDUP_MIN_CHARS", "512"))
+# Payload budgets (0 = unlimited), see _degrade_model_messages
+TRACE_BUDGET_BYTES = int(os.environ.get("CC_COZELOOP_TRACE_BUDGET_BYTES", "0"))
+SPAN_BUDGET_BYTES = int(os.environ.get("CC_COZELOOP_SPAN_BUDGET_BYTES", "0"))
+DEGRADED_TOOL_OUTPUT_CHARS = 256
+# Hand payloads to a resident exporter daemon, see send_to_daemon
+DAEMON_MODE = os.environ.get("CC_COZELOOP_DAEMON", "").lower() == "true"
+DAEMON_IDLE_SECONDS = float(os.environ.get("CC_COZELOOP_DAEMON_IDLE_SECONDS", "600"))
+DAEMON_CONNECT_TIMEOUT = 2.0
+DAEMON_SPAWN_TIMEOUT = 3.0
+# Session head sampling and always-keep rules, see is_session_sampled
+SAMPLE_RATE = float(os.environ.get("CC_COZELOOP_SAMPLE_RATE", "1"))
+SAMPLE_KEEP_TOKENS = int(os.environ.get("CC_COZELOOP_SAMPLE_KEEP_TOKENS", "200000"))
+# Live follow mode, see follow_transcript
+FOLLOW_QUIET_SECONDS = 2.0
+FOLLOW_POLL_INTERVAL = 0.5
+FOLLOW_EXIT_SECONDS = float(os.environ.get("CC_COZELOOP_FOLLOW_EXIT_SECONDS", "1800"))
+# Write span batches to a local spool replayed in the background, see spool_turns
+SPOOL_MODE = os.environ.get("CC_COZELOOP_SPOOL", "").lower() == "true"
+SPOOL_MAX_BYTES = int(os.environ.get("CC_COZELOOP_SPOOL_MAX_BYTES", str(64 * 1024 * 1024)))
+SPOOL_MAX_AGE_SECONDS = float(os.environ.get("CC_COZELOOP_SPOOL_MAX_AGE_SECONDS", str(7 * 24 * 3600)))
+SPOOL_BACKOFF_INITIAL = 1.0
+SPOOL_BACKOFF_MAX = 300.0
+# Export backend: "sdk" (CozeLoop SDK client) or "otlp" (gzip'ed OTLP/HTTP), see _OtlpClient
+EXPORTER = os.environ.get("CC_COZELOOP_EXPORTER", "sdk").lower()
+OTLP_ENDPOINT = os.environ.get("CC_COZELOOP_OTLP_ENDPOINT") or (
+    os.environ.get("COZELOOP_API_BASE", "https://api.coze.cn").rstrip("/") + "/v1/loop/opentelemetry/v1/traces")
+OTLP_MAX_REQUEST_BYTES = int(os.environ.get("CC_COZELOOP_OTLP_MAX_REQUEST_BYTES", str(16 * 1024 * 1024)))
+OTLP_TIMEOUT = 30.0
+# Transcripts are repetitive: level 3 compresses ~25x at a third of level 6's cost
+OTLP_GZIP_LEVEL = 3
+# Self-instrumentation: JSON lines metrics file and root span tag, see _phase
+METRICS_FILE = os.environ.get("CC_COZELOOP_METRICS_FILE", "")
+METRICS_TAG = os.environ.get("CC_COZELOOP_METRICS_TAG", "").lower() == "true"
+# Number of most recent transcripts re-stat'ed on each transcript index refresh
+INDEX_RESTAT_RECENT = 16
+# Number of leading transcript bytes checksummed to detect a rewritten file
+PREFIX_CHECKSUM_BYTES = 4096
+
+# Transcript record types that carry no conversation content
+SKIPPED_RECORD_TYPES = ("system", "file-history-snapshot")
 
 def debug_log(message: str):
     """Print debug message if debug mode is enabled."""
     if DEBUG:
         print(f"[COZELOOP_HOOK_DEBUG] {datetime.now().isoformat()} - {message}", file=sys.stderr)
 
+# --- Self-Instrumentation ---
+#
+# process_transcript times its phases (state load, read/parse, grouping,
+# history build, span construction, client close/flush, ...) and counts
+# lines, bytes, turns, spans and payload bytes. Phase times are exclusive:
+# the parser and grouper run lazily inside span construction, and the time
+# spent pulling from them is booked to their own phases. With
+# CC_COZELOOP_METRICS_FILE the result of each invocation is appended to that
+# file as one JSON line; with CC_COZELOOP_METRICS_TAG=true the figures known
+# when the trace is finished go onto the root span's `hook_metrics` tag.
+# Instrumentation is off (and costs nothing per line) unless one of them or
+# --profile is used.
+
+_metrics: Dict[str, Any] = {"enabled": False, "phases": {}, "counters": {}, "stack": []}
+
+
+def reset_metrics(enabled: bool):
+    """Start collecting metrics for a new invocation."""
+    _metrics.update(enabled=enabled, phases={}, counters={}, stack=[])
+
+
+@contextlib.contextmanager
+def _phase(name: str):
+    """Book the time spent in the block to phase `name`, pausing the enclosing phase."""
+    if not _metrics["enabled"]:
+        yield
+        return
+    phases, stack = _metrics["phases"], _metrics["stack"]
+    now = time.perf_counter()
+    if stack:
+        parent, started = stack[-1]
+        phases[parent] = phases.get(parent, 0.0) + now - started
+    stack.append([name, now])
+    try:
+        yield
+    finally:
+        now = time.perf_counter()
+        _, started = stack.pop()
+        phases[name] = phases.get(name, 0.0) + now - started
+        if stack:
+            stack[-1][1] = now
+
+
+def _timed_iter(iterable: Iterable[Any], name: str, counter: Optional[str] = None) -> Iterable[Any]:
+    """Book the time spent producing each item of `iterable` to phase `name`."""
+    if not _metrics["enabled"]:
+        return iterable
+
+    def timed():
+        it = iter(iterable)
+        done = object()
+        while True:
+            with _phase(name):
+                item = next(it, done)
+            if item is done:
+                return
+            if counter:
+                _count(counter)
+            yield item
+
+    return timed()
+
+
+def _count(name: str, n: int = 1):
+    """Add to a metrics counter."""
+    if _metrics["enabled"]:
+        _metrics["counters"][name] = _metrics["counters"].get(name, 0) + n
+
+
+def metrics_snapshot() -> Dict[str, Any]:
+    """Return the phase times (ms) and counters collected so far."""
+    return {
+        "phases_ms": {name: round(seconds * 1000, 2) for name, seconds in _metrics["phases"].items()},
+        "counters": dict(_metrics["counters"]),
+    }
+
+
+def write_metrics(record: Dict[str, Any]):
+    """Append one invocation's metrics to CC_COZELOOP_METRICS_FILE."""
+    try:
+        with open(os.path.expanduser(METRICS_FILE), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record) + "\n")
+    except IOError as e:
+        debug_log(f"Error writing metrics: {e}")
+
+
+def _payload_size(value: Any) -> int:
+    """Serialized size of a span input or output."""
+    if hasattr(value, "model_dump_json"):
+        return len(value.model_dump_json())
+    return len(str(value))
+
+
+class _MeteredSpan:
+    """Delegate to a span, counting the size of its input and output."""
+
+    def __init__(self, span):
+        self.span = span
+
+    def set_input(self, value):
+        _count("payload_bytes", _payload_size(value))
+        self.span.set_input(value)
+
+    def set_output(self, value):
+        _count("payload_bytes", _payload_size(value))
+        self.span.set_output(value)
+
+    def __getattr__(self, name):
+        return getattr(self.span, name)
+
+    def __enter__(self):
+        self.span.__enter__()
+        return self
+
+    def __exit__(self, *exc):
+        return self.span.__exit__(*exc)
+
+
+class _MeteredClient:
+    """Delegate to a CozeLoop client, counting spans (and payload bytes while metrics are on)."""
+
+    def __init__(self, client):
+        self.client = client
+        self.spans = 0
+
+    def start_span(self, *args, **kwargs):
+        self.spans += 1
+        _count("spans")
+        if isinstance(kwargs.get("child_of"), _MeteredSpan):
+            kwargs["child_of"] = kwargs["child_of"].span
+        span = self.client.start_span(*args, **kwargs)
+        return _MeteredSpan(span) if _metrics["enabled"] else span
+
+    def close(self):
+        with _phase("flush"):
+            self.client.close()
+
+    def flush(self):
+        with _phase("flush"):
+            self.client.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
 # --- State Management ---
 
-def get_state_file_path(conversation_file: str) -> str:
-    """Get the state file path for tracking processed messages."""
+def get_state_dir() -> Path:
+    """Get (and create) the directory holding hook state files."""
     state_dir = Path.home() / ".claude" / "cozeloop_state"
     state_dir.mkdir(parents=True, exist_ok=True)
+    return state_dir
+
+def get_state_file_path(conversation_file: str) -> str:
+    """Get the state file path for tracking processed messages."""
+    state_dir = get_state_dir()
     file_hash = hashlib.md5(conversation_file.encode()).hexdigest()[:12]
     return str(state_dir / f"state_{file_hash}.json")
 
@@ -64,16 +317,131 @@ def load_state(state_file: str) -> Dict[str, Any]:
             debug_log(f"Error loading state: {e}")
     return {"last_processed_line": 0, "session_id": None}
 
+# Grouper carry keys (see iter_turns); only the start of the open turn is saved
+_CARRY_KEYS = ("open_turn", "pending_tool_ids", "orphan_progress")
+
 def save_state(state_file: str, state: Dict[str, Any]):
-    """Save the processing state to file."""
+    """Save the processing state to file.
+
+    A turn carried in the state is saved as the line and byte offset it starts
+    at, not as the grouped turn; restore_open_turn rebuilds it from the
+    transcript.
+    """
+    if "open_turn" in state:
+        open_turn = state["open_turn"]
+        state = {k: v for k, v in state.items() if k not in _CARRY_KEYS}
+        if open_turn:
+            state["open_turn_line"] = open_turn["start_line"]
+            state["open_turn_offset"] = open_turn.get("start_offset")
     try:
-        with open(state_file, 'w') as f:
-            json.dump(state, f, indent=2)
+        atomic_write(state_file, json.dumps(state, indent=2))
     except IOError as e:
         debug_log(f"Error saving state: {e}")
 
+def atomic_write(path: str, data: str, durable: bool = True):
+    """Replace `path` with `data` so readers see either the old or the new file.
+
+    The data goes to a temporary file in the same directory that is renamed
+    over `path`; with `durable` it is fsync'ed first, so a crash cannot leave
+    an empty file behind either.
+    """
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+            if durable:
+                f.flush()
+                os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except OSError:
+            pass
+        raise
+
 # --- Conversation File Handling ---
 
+def _load_transcript_index(index_file: str) -> Dict[str, Any]:
+    """Load the transcript index, or an empty one."""
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+        if isinstance(index.get("dirs"), dict) and isinstance(index.get("files"), dict):
+            return index
+    except (json.JSONDecodeError, IOError) as e:
+        debug_log(f"Rebuilding transcript index: {e}")
+    return {"dirs": {}, "files": {}}
+
+def refresh_transcript_index(root: Path, index_file: str) -> Dict[str, List[int]]:
+    """Bring the transcript index for `root` up to date and return {path: [mtime_ns, size]}.
+
+    The index stores, per directory, its mtime and the subdirectories and
+    .jsonl files it contained. Only directories whose mtime changed (files
+    added, removed or renamed) are listed again. Appending to a transcript
+    does not touch its directory, so the most recently modified transcripts
+    are re-stat'ed on every refresh as well.
+    """
+    index = _load_transcript_index(index_file)
+    dirs: Dict[str, Any] = index["dirs"]
+    files: Dict[str, List[int]] = index["files"]
+    changed = False
+    seen_dirs = set()
+    pending = [str(root)]
+    while pending:
+        dir_path = pending.pop()
+        seen_dirs.add(dir_path)
+        try:
+            dir_mtime = os.stat(dir_path).st_mtime_ns
+        except OSError:
+            continue
+        entry = dirs.get(dir_path)
+        if not entry or entry.get("mtime_ns") != dir_mtime:
+            subdirs, dir_files = [], []
+            try:
+                with os.scandir(dir_path) as it:
+                    for e in it:
+                        if e.is_dir(follow_symlinks=False):
+                            subdirs.append(e.path)
+                        elif e.name.endswith(".jsonl") and e.is_file():
+                            st = e.stat()
+                            files[e.path] = [st.st_mtime_ns, st.st_size]
+                            dir_files.append(e.path)
+            except OSError as e:
+                debug_log(f"Error scanning {dir_path}: {e}")
+                continue
+            for stale in set(entry.get("files", []) if entry else []) - set(dir_files):
+                files.pop(stale, None)
+            entry = {"mtime_ns": dir_mtime, "subdirs": subdirs, "files": dir_files}
+            dirs[dir_path] = entry
+            changed = True
+        pending.extend(entry["subdirs"])
+
+    # Forget directories that disappeared, together with their files
+    for gone in set(dirs) - seen_dirs:
+        for stale in dirs.pop(gone).get("files", []):
+            files.pop(stale, None)
+        changed = True
+
+    for path in sorted(files, key=lambda p: files[p][0], reverse=True)[:INDEX_RESTAT_RECENT]:
+        try:
+            st = os.stat(path)
+        except OSError:
+            files.pop(path, None)
+            changed = True
+            continue
+        if [st.st_mtime_ns, st.st_size] != files[path]:
+            files[path] = [st.st_mtime_ns, st.st_size]
+            changed = True
+
+    if changed:
+        try:
+            # Only a cache, so a lost update after a crash is fine
+            atomic_write(index_file, json.dumps(index), durable=False)
+        except IOError as e:
+            debug_log(f"Error saving transcript index: {e}")
+    return files
+
 def find_latest_conversation_file() -> Optional[str]:
     """Find the most recently modified conversation file in ~/.claude/projects/."""
     claude_dir = Path.home() / ".claude" / "projects"
@@ -81,34 +449,180 @@ def find_latest_conversation_file() -> Optional[str]:
         debug_log(f"Claude projects directory not found: {claude_dir}")
         return None
 
-    jsonl_files = list(claude_dir.rglob("*.jsonl"))
-    if not jsonl_files:
+    files = refresh_transcript_index(claude_dir, str(get_state_dir() / "transcript_index.json"))
+    if not files:
         debug_log("No conversation files (*.jsonl) found.")
         return None
 
-    latest_file = max(jsonl_files, key=lambda p: p.stat().st_mtime)
+    latest_file = max(files, key=lambda p: files[p][0])
     debug_log(f"Found latest conversation file: {latest_file}")
-    return str(latest_file)
+    return latest_file
+
+def _prefix_checksum(f, length: int) -> str:
+    """Checksum the first `length` bytes of an open binary file."""
+    f.seek(0)
+    return hashlib.md5(f.read(length)).hexdigest()
+
+def is_transcript_replaced(file_path: str, state: Dict[str, Any]) -> bool:
+    """Return True if the transcript was rotated (new inode) or truncated since the saved resume point."""
+    offset = state.get("byte_offset")
+    if not isinstance(offset, int) or offset <= 0:
+        return False
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return False
+    if state.get("inode") != file_stat.st_ino:
+        debug_log("Transcript inode changed, rereading it from the start")
+        return True
+    if file_stat.st_size < offset or file_stat.st_size < state.get("file_size", 0):
+        debug_log("Transcript was truncated, rereading it from the start")
+        return True
+    return False
 
-def read_new_messages(file_path: str, start_line: int = 0) -> List[Dict[str, Any]]:
-    """Read new messages from a conversation file since the last processed line."""
-    messages = []
+def reset_transcript_state(state: Dict[str, Any]):
+    """Forget the read position, history store coverage and carried turn of a replaced transcript."""
+    state["last_processed_line"] = 0
+    state["open_turn"] = None
+    state["pending_tool_ids"] = []
+    state["orphan_progress"] = {}
+    for key in ("model_chain", "open_turn_line", "open_turn_offset", "history_line", "history_count", "history_digest", "byte_offset", "file_size", "mtime_ns", "inode", "prefix_checksum"):
+        state.pop(key, None)
+
+def _is_line_start(f, offset: int) -> bool:
+    """Return True if `offset` is the start of a line of an open binary file."""
+    if offset <= 0:
+        return offset == 0
+    f.seek(offset - 1)
+    return f.read(1) == b"\n"
+
+def _resolve_resume_offset(f, file_stat: os.stat_result, state: Dict[str, Any]) -> Optional[int]:
+    """Validate the saved byte offset against the current file.
+
+    Returns the offset to seek to, or None when the saved offset cannot be
+    trusted and the reader falls back to skipping `start_line` lines. Callers
+    check is_transcript_replaced first: a rotated or truncated file is reread
+    from line 0 rather than skipped into.
+    """
+    offset = state.get("byte_offset")
+    if not isinstance(offset, int) or offset <= 0:
+        return None
+    if state.get("inode") != file_stat.st_ino or file_stat.st_size < offset:
+        return None
+    # The saved offset must sit right after a newline
+    if not _is_line_start(f, offset):
+        debug_log("Saved offset is not on a line boundary, falling back to rescan")
+        return None
+    if _prefix_checksum(f, min(offset, PREFIX_CHECKSUM_BYTES)) != state.get("prefix_checksum"):
+        debug_log("Transcript prefix changed, falling back to rescan")
+        return None
+    return offset
+
+def json_loads(data):
+    """Parse JSON from bytes or str, with orjson when it is installed and the stdlib otherwise."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+_SKIPPED_TYPE_VALUES = tuple(f'"{t}"'.encode() for t in SKIPPED_RECORD_TYPES)
+
+def skipped_record_type(line: bytes) -> Optional[str]:
+    """Return the record type of a transcript line if it is one of SKIPPED_RECORD_TYPES.
+
+    Looks at the raw bytes only: the first `"type":` key must be a top-level
+    one (no nested object opened before it) and its value one of the skipped
+    types. Lines that do not match exactly are left for the full parse.
+    """
+    pos = line.find(b'"type":')
+    if pos < 0 or line.count(b"{", 0, pos) != 1:
+        return None
+    pos += 7
+    if line[pos:pos + 1] == b" ":
+        pos += 1
+    for record_type, value in zip(SKIPPED_RECORD_TYPES, _SKIPPED_TYPE_VALUES):
+        if line.startswith(value, pos):
+            return record_type
+    return None
+
+def iter_new_messages(file_path: str, start_line: int = 0, state: Optional[Dict[str, Any]] = None,
+                      start_offset: Optional[int] = None) -> Iterator[Dict[str, Any]]:
+    """Yield new messages from a conversation file since the last processed line.
+
+    When `state` carries a valid resume point (see `record_resume_point`), the
+    reader seeks straight to the unread tail instead of skipping `start_line`
+    lines from the top; `start_offset`, the byte offset of `start_line`, is
+    used the same way when it falls on a line boundary. Each message carries
+    `_line_number`, `_offset` and `_end_offset` (byte offsets of the start of
+    its line and just past it). Records of SKIPPED_RECORD_TYPES are not
+    decoded; they are yielded as stubs holding only their type.
+    """
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for i, line in enumerate(f):
-                if i < start_line:
-                    continue
-                line = line.strip()
-                if line:
-                    try:
-                        msg = json.loads(line)
-                        msg['_line_number'] = i
-                        messages.append(msg)
-                    except json.JSONDecodeError:
-                        debug_log(f"Skipping malformed JSON on line {i+1}")
+        with open(file_path, 'rb') as f:
+            offset = 0
+            skip_lines = start_line
+            if start_offset is not None and start_line > 0 and _is_line_start(f, start_offset):
+                offset = start_offset
+                skip_lines = 0
+            elif state and start_line > 0:
+                resume_offset = _resolve_resume_offset(f, os.fstat(f.fileno()), state)
+                if resume_offset is not None:
+                    offset = resume_offset
+                    skip_lines = 0
+            f.seek(offset)
+            first_offset = offset
+            i = start_line - skip_lines
+            for raw_line in f:
+                offset += len(raw_line)
+                if i >= start_line:
+                    line = raw_line.strip()
+                    if line:
+                        try:
+                            record_type = skipped_record_type(line)
+                            msg = {"type": record_type} if record_type else json_loads(line)
+                            msg['_line_number'] = i
+                            msg['_offset'] = offset - len(raw_line)
+                            msg['_end_offset'] = offset
+                        except (ValueError, TypeError):
+                            debug_log(f"Skipping malformed JSON on line {i+1}")
+                        else:
+                            yield msg
+                i += 1
+            _count("bytes_read", offset - first_offset)
     except (IOError, FileNotFoundError) as e:
         debug_log(f"Error reading conversation file: {e}")
-    return messages
+
+def read_new_messages(file_path: str, start_line: int = 0,
+                      state: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+    """Read new messages from a conversation file since the last processed line."""
+    return list(iter_new_messages(file_path, start_line, state))
+
+def is_transcript_unchanged(file_path: str, state: Dict[str, Any]) -> bool:
+    """Return True if the transcript has not changed since the saved resume point.
+
+    Only stats the file, so a no-op hook invocation never opens the transcript.
+    """
+    try:
+        file_stat = os.stat(file_path)
+    except OSError:
+        return False
+    return (state.get("byte_offset") == file_stat.st_size
+            and state.get("inode") == file_stat.st_ino
+            and state.get("mtime_ns") == file_stat.st_mtime_ns)
+
+def record_resume_point(state: Dict[str, Any], file_path: str, byte_offset: int):
+    """Store the byte offset, file identity and prefix checksum used to resume reading."""
+    try:
+        with open(file_path, 'rb') as f:
+            file_stat = os.fstat(f.fileno())
+            state["byte_offset"] = byte_offset
+            state["file_size"] = file_stat.st_size
+            state["mtime_ns"] = file_stat.st_mtime_ns
+            state["inode"] = file_stat.st_ino
+            state["prefix_checksum"] = _prefix_checksum(f, min(byte_offset, PREFIX_CHECKSUM_BYTES))
+    except (IOError, FileNotFoundError) as e:
+        debug_log(f"Error recording resume point: {e}")
+        for key in ("byte_offset", "file_size", "mtime_ns", "inode", "prefix_checksum"):
+            state.pop(key, None)
 
 # --- Content Helpers ---
 
@@ -125,15 +639,117 @@ def is_empty_content(content: Any) -> bool:
             return True
     return False
 
+def _truncation_marker(total: int, approximate: bool = False) -> str:
+    return f"...[truncated, {'~' if approximate else ''}{total} chars total]"
+
+def truncate_text(text: str, limit: int) -> str:
+    """Cut text to `limit` characters, appending a marker with the original length."""
+    if len(text) <= limit:
+        return text
+    return text[:limit] + _truncation_marker(len(text))
+
+_JSON_CONSTANTS = {None: "null", True: "true", False: "false"}
+
+def _dumps_scalar(value: Any) -> str:
+    """json.dumps for non-container values, skipping the encoder setup for the common ones."""
+    if value is None or value is True or value is False:
+        return _JSON_CONSTANTS[value]
+    if type(value) is int:
+        return str(value)
+    return json.dumps(value, ensure_ascii=False)
+
+def _json_key(key: Any) -> str:
+    """Convert a dict key to the string json.dumps uses for it."""
+    if isinstance(key, str):
+        return key
+    if key is None or key is True or key is False:
+        return _JSON_CONSTANTS[key]
+    if isinstance(key, float):
+        return json.dumps(float(key))
+    if isinstance(key, int):
+        return int.__repr__(key)
+    return str(key)
+
+def _json_size(value: Any, sample: int = 256) -> int:
+    """Approximate length of the JSON encoding of `value`.
+
+    Escape sequences are not counted, and containers with more than `sample`
+    entries are extrapolated from their first `sample` entries.
+    """
+    if isinstance(value, str):
+        return len(value) + 2
+    if isinstance(value, dict):
+        entries = [_json_size(_json_key(k)) + 2 + _json_size(v) for k, v in itertools.islice(value.items(), sample)]
+    elif isinstance(value, (list, tuple)):
+        entries = [_json_size(v) for v in itertools.islice(value, sample)]
+    else:
+        return len(_dumps_scalar(value))
+    if not entries:
+        return 2
+    return 2 + sum(entries) * len(value) // len(entries) + 2 * (len(value) - 1)
+
+def _encode_bounded(value: Any, out: List[str], remaining: int) -> int:
+    """Append the JSON encoding of `value` to `out`, stopping once `remaining` characters are written.
+
+    Strings are cut before they are escaped, so the work done is bounded by
+    `remaining` rather than by the size of `value`. Returns the budget left
+    (zero or less once the encoding was cut short).
+    """
+    if remaining <= 0:
+        return remaining
+    if isinstance(value, str):
+        piece = json.dumps(value[:remaining], ensure_ascii=False)
+    elif isinstance(value, dict):
+        out.append("{")
+        remaining -= 1
+        for n, (key, item) in enumerate(value.items()):
+            if remaining <= 0:
+                return remaining
+            piece = (", " if n else "") + json.dumps(_json_key(key), ensure_ascii=False) + ": "
+            out.append(piece)
+            remaining = _encode_bounded(item, out, remaining - len(piece))
+        piece = "}"
+    elif isinstance(value, (list, tuple)):
+        out.append("[")
+        remaining -= 1
+        for n, item in enumerate(value):
+            if remaining <= 0:
+                return remaining
+            if n:
+                out.append(", ")
+                remaining -= 2
+            remaining = _encode_bounded(item, out, remaining)
+        piece = "]"
+    else:
+        piece = _dumps_scalar(value)
+    if remaining > 0:
+        out.append(piece)
+    return remaining - len(piece)
+
+def dumps_bounded(value: Any, limit: int) -> str:
+    """Serialize `value` like json.dumps(ensure_ascii=False), cut to `limit` characters.
+
+    Unlike json.dumps(...)[:limit], serialization stops once the budget is
+    spent, so a multi-MB tool payload costs about as much as a small one. A
+    cut result ends with a truncation marker giving the full length, as
+    estimated by _json_size ("~N chars total").
+    """
+    out: List[str] = []
+    _encode_bounded(value, out, limit + 1)
+    text = "".join(out)
+    if len(text) <= limit:
+        return text
+    return text[:limit] + _truncation_marker(_json_size(value), approximate=True)
+
 def format_content(content: Any, truncate: int = 4096) -> str:
     """Format message content for trace display."""
     if isinstance(content, str):
-        return content[:truncate]
+        return truncate_text(content, truncate)
     if isinstance(content, dict):
-        return json.dumps(content, ensure_ascii=False)[:truncate]
+        return dumps_bounded(content, truncate)
     if isinstance(content, list):
-        return json.dumps(content, ensure_ascii=False)[:truncate]
-    return str(content)[:truncate]
+        return dumps_bounded(content, truncate)
+    return truncate_text(str(content), truncate)
 
 
 # --- Message Parsing and Grouping ---
@@ -179,77 +795,90 @@ def _extract_progress_inner_message(msg: Dict[str, Any]) -> Optional[Dict[str, A
         "model": inner_msg.get("model"),
         "parentToolUseID": msg.get("parentToolUseID"),
         "agentId": data.get("agentId", ""),
+        "timestamp": msg.get("timestamp"),
     }
 
 
-def _group_subagent_steps(progress_msgs: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Group sub-agent progress messages into steps (same logic as top-level).
+def _append_subagent_message(steps: List[Dict[str, Any]], pmsg: Dict[str, Any]):
+    """Fold one sub-agent progress message into its steps (same logic as top-level).
 
-    Each step is an assistant message (model call) + its tool_calls + tool_results.
-    Returns list of steps in the same format as turn["steps"], but with simplified
-    assistant_message structure.
+    Each step is an assistant message (model call) + its tool_calls + tool_results,
+    in the same format as turn["steps"] but with a simplified assistant_message.
     """
-    steps = []
-
-    for pmsg in progress_msgs:
-        role = pmsg.get("role")
-        content = pmsg.get("content", [])
-
-        if role == "user":
-            # Could be tool_result or user input for the sub-agent
-            if isinstance(content, list):
-                has_tool_result = any(
-                    isinstance(item, dict) and item.get("type") == "tool_result"
-                    for item in content
-                )
-                if has_tool_result and steps:
-                    for item in content:
-                        if isinstance(item, dict) and item.get("type") == "tool_result":
-                            steps[-1]["tool_results"].append(item)
-            # Skip non-tool-result user messages (sub-agent prompt)
-            continue
+    role = pmsg.get("role")
+    content = pmsg.get("content", [])
+    timestamp = pmsg.get("timestamp")
+
+    if role == "user":
+        # Could be tool_result or user input for the sub-agent;
+        # non-tool-result user messages (sub-agent prompt) are skipped
+        if isinstance(content, list) and steps:
+            for item in content:
+                if isinstance(item, dict) and item.get("type") == "tool_result":
+                    steps[-1]["tool_results"].append(item)
+                    _record_tool_end(steps[-1]["tool_calls"], item.get("tool_use_id"), timestamp)
+        return
 
-        if role == "assistant":
-            tool_calls = []
-            if isinstance(content, list):
-                for item in content:
-                    if isinstance(item, dict) and item.get("type") == "tool_use":
-                        tool_calls.append(item)
-
-            msg_id = pmsg.get("id")
-            last_step = steps[-1] if steps else None
-            last_msg_id = last_step.get("_msg_id") if last_step else None
-
-            if last_step and msg_id and msg_id == last_msg_id:
-                # Same API response — merge
-                existing = last_step["assistant_message"].get("message", {}).get("content", [])
-                if isinstance(existing, list) and isinstance(content, list):
-                    existing.extend(content)
-                last_step["tool_calls"].extend(tool_calls)
-                usage = pmsg.get("usage", {})
-                if usage.get("input_tokens", 0) > 0 or usage.get("output_tokens", 0) > 0:
-                    last_step["assistant_message"]["message"]["usage"] = usage
-            else:
-                steps.append({
-                    "assistant_message": {
-                        "message": {
-                            "role": "assistant",
-                            "content": content,
-                            "id": msg_id,
-                            "model": pmsg.get("model", ""),
-                            "usage": pmsg.get("usage", {}),
-                        }
-                    },
-                    "tool_calls": tool_calls,
-                    "tool_results": [],
-                    "_msg_id": msg_id,
-                })
+    if role == "assistant":
+        tool_calls = []
+        if isinstance(content, list):
+            for item in content:
+                if isinstance(item, dict) and item.get("type") == "tool_use":
+                    if timestamp:
+                        item["_start_time"] = timestamp
+                    tool_calls.append(item)
+
+        msg_id = pmsg.get("id")
+        last_step = steps[-1] if steps else None
+        last_msg_id = last_step.get("_msg_id") if last_step else None
+
+        if last_step and msg_id and msg_id == last_msg_id:
+            # Same API response — merge
+            existing = last_step["assistant_message"].get("message", {}).get("content", [])
+            if isinstance(existing, list) and isinstance(content, list):
+                existing.extend(content)
+            last_step["tool_calls"].extend(tool_calls)
+            last_step["_end_time"] = timestamp or last_step.get("_end_time")
+            usage = pmsg.get("usage", {})
+            if usage.get("input_tokens", 0) > 0 or usage.get("output_tokens", 0) > 0:
+                last_step["assistant_message"]["message"]["usage"] = usage
+        else:
+            steps.append({
+                "assistant_message": {
+                    "message": {
+                        "role": "assistant",
+                        "content": content,
+                        "id": msg_id,
+                        "model": pmsg.get("model", ""),
+                        "usage": pmsg.get("usage", {}),
+                    }
+                },
+                "tool_calls": tool_calls,
+                "tool_results": [],
+                "_msg_id": msg_id,
+                "_end_time": timestamp,
+            })
 
-    return steps
+
+def _record_tool_end(tool_calls: List[Dict[str, Any]], tool_id: Optional[str], timestamp: Optional[str]):
+    """Note when the result of one of `tool_calls` arrived."""
+    if not timestamp:
+        return
+    for tc in tool_calls:
+        if tc.get("id") == tool_id:
+            tc["_end_time"] = timestamp
+
+
+def _attach_subagent_message(tool_call: Dict[str, Any], inner: Dict[str, Any]):
+    """Attach a sub-agent progress message to the tool call that spawned it."""
+    _append_subagent_message(tool_call.setdefault("_sub_steps", []), inner)
+    # agentId is the same for all messages under this parent
+    if inner.get("agentId") and not tool_call.get("_agent_id"):
+        tool_call["_agent_id"] = inner["agentId"]
 
 
-def group_messages_into_turns(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Group messages into conversation turns (user -> assistant -> tool_results).
+def iter_turns(messages: Iterable[Dict[str, Any]], carry: Optional[Dict[str, Any]] = None) -> Iterator[Dict[str, Any]]:
+    """Group a stream of messages into conversation turns (user -> assistant -> tool_results).
 
     A turn represents a complete interaction cycle starting from a real user input.
     Within each turn, we track individual "steps" -- each step is a single model
@@ -264,45 +893,45 @@ def group_messages_into_turns(messages: List[Dict[str, Any]]) -> List[Dict[str,
       - tool_calls: tool_use items from this assistant message
       - tool_results: matching tool_result items from the following user message(s)
 
-    Sub-agent (Task tool) progress messages are parsed and stored as
-    sub_steps on the step containing the parent tool call.
+    Sub-agent (Task tool) progress messages are parsed as they arrive and stored
+    as sub_steps on the parent tool call.
+
+    Messages are consumed one at a time and each turn is yielded as soon as the
+    next real user input closes it, so only one turn is held in memory. The turn
+    still open at the end of the stream is left in `carry` ("open_turn", together
+    with its "pending_tool_ids" and any "orphan_progress"); passing the same
+    carry to the next call resumes that turn.
     """
-    turns = []
-    current_turn = None
+    if carry is None:
+        carry = {}
+    current_turn = carry.get("open_turn")
+    pending_tool_ids = set(carry.get("pending_tool_ids", []))
+    orphan_progress: Dict[str, List[Dict[str, Any]]] = carry.get("orphan_progress", {})
+    tool_calls_by_id: Dict[str, Dict[str, Any]] = {}
+    if current_turn:
+        for step in current_turn["steps"]:
+            for tc in step["tool_calls"]:
+                tool_calls_by_id[tc.get("id", "")] = tc
 
-    # First pass: collect progress messages grouped by parentToolUseID,
-    # and collect toolUseResult usage keyed by tool_use_id.
-    subagent_progress: Dict[str, List[Dict[str, Any]]] = {}
-    tool_use_result_usage: Dict[str, Dict[str, Any]] = {}
-    for msg in messages:
-        if msg.get("type") == "progress":
-            inner = _extract_progress_inner_message(msg)
-            if inner and inner.get("parentToolUseID"):
-                parent_id = inner["parentToolUseID"]
-                if parent_id not in subagent_progress:
-                    subagent_progress[parent_id] = []
-                subagent_progress[parent_id].append(inner)
-        # Collect toolUseResult usage from tool_result messages
-        tur = msg.get("toolUseResult")
-        if isinstance(tur, dict) and tur.get("usage"):
-            message = msg.get("message", {})
-            content = message.get("content", [])
-            if isinstance(content, list):
-                for item in content:
-                    if isinstance(item, dict) and item.get("type") == "tool_result":
-                        tid = item.get("tool_use_id", "")
-                        if tid:
-                            tool_use_result_usage[tid] = tur["usage"]
-
-    # Second pass: build turns from user/assistant messages
     for msg in messages:
         msg_type = msg.get("type")
         role = msg.get("role")
         message = msg.get("message", {})
         message_role = message.get("role", "")
 
+        # Sub-agent progress: attach to the parent tool call
+        if msg_type == "progress":
+            inner = _extract_progress_inner_message(msg)
+            if inner and inner.get("parentToolUseID"):
+                parent_id = inner["parentToolUseID"]
+                if parent_id in tool_calls_by_id:
+                    _attach_subagent_message(tool_calls_by_id[parent_id], inner)
+                else:
+                    orphan_progress.setdefault(parent_id, []).append(inner)
+            continue
+
         # Skip non-conversation messages
-        if msg_type in ("progress", "system", "file-history-snapshot"):
+        if msg_type in SKIPPED_RECORD_TYPES:
             continue
 
         # Check if this is a user message
@@ -311,19 +940,33 @@ def group_messages_into_turns(messages: List[Dict[str, Any]]) -> List[Dict[str,
         if is_user_msg:
             # Check if this is a tool_result message (should not start a new turn)
             if is_tool_result_message(msg):
+                tool_results = extract_tool_result_from_message(msg)
                 # Attach tool results to the last step of the current turn
                 if current_turn and current_turn["steps"]:
-                    tool_results = extract_tool_result_from_message(msg)
                     current_turn["steps"][-1]["tool_results"].extend(tool_results)
+                # Attach total usage from toolUseResult for sub-agent token distribution
+                tur = msg.get("toolUseResult")
+                for tr in tool_results:
+                    tid = tr.get("tool_use_id", "")
+                    pending_tool_ids.discard(tid)
+                    tc = tool_calls_by_id.get(tid)
+                    if tc is not None and msg.get("timestamp"):
+                        tc["_end_time"] = msg["timestamp"]
+                    if tc is not None and "_sub_steps" in tc and isinstance(tur, dict) and tur.get("usage"):
+                        tc["_total_usage"] = tur["usage"]
             else:
                 # This is a real user input, start a new turn
                 if current_turn:
-                    turns.append(current_turn)
+                    yield current_turn
                 current_turn = {
                     "user_message": msg,
                     "steps": [],
-                    "start_line": msg.get("_line_number", 0)
+                    "start_line": msg.get("_line_number", 0),
+                    "start_offset": msg.get("_offset"),
                 }
+                pending_tool_ids = set()
+                tool_calls_by_id = {}
+                orphan_progress = {}
         elif msg_type == "assistant" or role == "assistant" or message_role == "assistant":
             if current_turn:
                 # Extract tool_use items from this line's content
@@ -333,6 +976,14 @@ def group_messages_into_turns(messages: List[Dict[str, Any]]) -> List[Dict[str,
                     for item in content:
                         if isinstance(item, dict) and item.get("type") == "tool_use":
                             tool_calls.append(item)
+                for tc in tool_calls:
+                    tool_id = tc.get("id", "")
+                    tool_calls_by_id[tool_id] = tc
+                    pending_tool_ids.add(tool_id)
+                    if msg.get("timestamp"):
+                        tc["_start_time"] = msg["timestamp"]
+                    for inner in orphan_progress.pop(tool_id, []):
+                        _attach_subagent_message(tc, inner)
 
                 # Claude Code writes text and tool_use from the same API response
                 # as separate JSONL lines sharing the same message.id.
@@ -348,6 +999,7 @@ def group_messages_into_turns(messages: List[Dict[str, Any]]) -> List[Dict[str,
                     if isinstance(existing_content, list) and isinstance(content, list):
                         existing_content.extend(content)
                     last_step["tool_calls"].extend(tool_calls)
+                    last_step["_end_time"] = msg.get("timestamp") or last_step.get("_end_time")
                     # Carry over usage from the later line (earlier line typically has zeros)
                     usage = message.get("usage", {})
                     if usage.get("input_tokens", 0) > 0 or usage.get("output_tokens", 0) > 0:
@@ -358,36 +1010,70 @@ def group_messages_into_turns(messages: List[Dict[str, Any]]) -> List[Dict[str,
                         "assistant_message": msg,
                         "tool_calls": tool_calls,
                         "tool_results": [],
+                        "_end_time": msg.get("timestamp"),
                     })
 
-    # Don't forget the last turn
-    if current_turn:
-        turns.append(current_turn)
+    carry["open_turn"] = current_turn
+    carry["pending_tool_ids"] = sorted(pending_tool_ids)
+    carry["orphan_progress"] = orphan_progress
+
+
+def is_turn_complete(turn: Dict[str, Any], pending_tool_ids: Iterable[str] = ()) -> bool:
+    """Return True if the turn ended with a final model response and no tool call is pending.
+
+    Text and tool_use of one response are written as separate lines and the
+    final text line often has no stop_reason, so a last step without tool
+    calls counts as final whatever its stop_reason.
+    """
+    steps = turn.get("steps", [])
+    return bool(steps) and not steps[-1]["tool_calls"] and not list(pending_tool_ids)
+
+
+def open_turn_start(state: Dict[str, Any]) -> Optional[int]:
+    """Return the line the turn carried in the state starts at, or None if there is none."""
+    if "open_turn" in state:
+        return state["open_turn"]["start_line"] if state["open_turn"] else None
+    return state.get("open_turn_line")
 
-    # Third pass: attach sub-agent steps, agentId, and total usage to their parent tool calls
-    for turn in turns:
-        for step in turn["steps"]:
-            for tc in step["tool_calls"]:
-                tool_id = tc.get("id", "")
-                if tool_id in subagent_progress:
-                    progress_msgs = subagent_progress[tool_id]
-                    tc["_sub_steps"] = _group_subagent_steps(progress_msgs)
-                    # Extract agentId (same for all messages under this parent)
-                    for pm in progress_msgs:
-                        if pm.get("agentId"):
-                            tc["_agent_id"] = pm["agentId"]
-                            break
-                    # Attach total usage from toolUseResult for token distribution
-                    if tool_id in tool_use_result_usage:
-                        tc["_total_usage"] = tool_use_result_usage[tool_id]
 
+def restore_open_turn(file_path: str, state: Dict[str, Any]):
+    """Rebuild the turn carried in the state from its lines in the transcript.
+
+    The state file keeps only where the open turn starts (see save_state); its
+    lines up to the last processed one are grouped again, which also restores
+    the pending tool calls and orphaned sub-agent progress of the carry.
+    """
+    if "open_turn" in state:
+        return
+    start_line = state.pop("open_turn_line", None)
+    start_offset = state.pop("open_turn_offset", None)
+    state["open_turn"] = None
+    state["pending_tool_ids"] = []
+    state["orphan_progress"] = {}
+    if start_line is None:
+        return
+    end_line = state.get("last_processed_line", 0)
+    messages = itertools.takewhile(lambda m: m.get("_line_number", 0) < end_line,
+                                   iter_new_messages(file_path, start_line, start_offset=start_offset))
+    for turn in iter_turns(messages, state):
+        debug_log(f"Turn at line {turn.get('start_line')} was closed before the open turn, skipping it")
+    if state["open_turn"] is None:
+        debug_log(f"Open turn at line {start_line} not found in the transcript")
+
+
+def group_messages_into_turns(messages: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Group messages into conversation turns, including the last (possibly open) turn."""
+    carry: Dict[str, Any] = {}
+    turns = list(iter_turns(messages, carry))
+    if carry.get("open_turn"):
+        turns.append(carry["open_turn"])
     return turns
 
 
 # --- CozeLoop Message Helpers ---
 
 def _make_message(role: str, content: str = "", tool_calls: list = None,
-                   tool_call_id: str = "", parts: list = None) -> ModelMessage:
+                   tool_call_id: str = "", parts: list = None) -> "ModelMessage":
     """Helper to create a CozeLoop ModelMessage with default fields."""
     return ModelMessage(
         role=role,
@@ -408,33 +1094,41 @@ def _format_tool_output(result_content: Any, max_len: int = 2000) -> str:
     extract and join text parts instead of dumping raw JSON.
     """
     if isinstance(result_content, str):
-        if len(result_content) > max_len:
-            return result_content[:max_len] + "..."
-        return result_content
+        return truncate_text(result_content, max_len)
 
     if isinstance(result_content, list):
         text_parts = []
+        count = length = total = 0
+        approximate = False
         for item in result_content:
             if isinstance(item, dict):
                 if item.get("type") == "text":
-                    text_parts.append(item.get("text", ""))
+                    text = item.get("text", "")
+                    size = len(text)
                 else:
-                    # Non-text items: serialize compactly
-                    text_parts.append(json.dumps(item, ensure_ascii=False))
+                    # Non-text items: serialize, but only as far as the output can still grow
+                    text = dumps_bounded(item, max(max_len - length, 0))
+                    size = _json_size(item)
+                    approximate = True
             elif isinstance(item, str):
-                text_parts.append(item)
+                text, size = item, len(item)
+            else:
+                continue
+            separator = 1 if count else 0
+            count += 1
+            total += separator + size
+            if length <= max_len:
+                text_parts.append(text)
+                length += separator + len(text)
         joined = "\n".join(text_parts)
-        if len(joined) > max_len:
-            return joined[:max_len] + "..."
+        if total > max_len or len(joined) > max_len:
+            return joined[:max_len] + _truncation_marker(max(total, len(joined)), approximate)
         return joined
 
-    s = str(result_content)
-    if len(s) > max_len:
-        return s[:max_len] + "..."
-    return s
+    return truncate_text(str(result_content), max_len)
 
 
-def _make_tool_result_message(result_content: Any, tool_call_id: str = "") -> ModelMessage:
+def _make_tool_result_message(result_content: Any, tool_call_id: str = "") -> "ModelMessage":
     """Create a role='tool' ModelMessage for model input.
 
     When result_content is a list, items go into parts (not content) to avoid
@@ -450,7 +1144,7 @@ def _make_tool_result_message(result_content: Any, tool_call_id: str = "") -> Mo
                 else:
                     parts_list.append(ModelMessagePart(
                         type=ModelMessagePartType.TEXT,
-                        text=json.dumps(item, ensure_ascii=False)[:4096]
+                        text=dumps_bounded(item, 4096)
                     ))
             elif isinstance(item, str):
                 parts_list.append(ModelMessagePart(type=ModelMessagePartType.TEXT, text=item))
@@ -469,7 +1163,7 @@ def _make_tool_result_message(result_content: Any, tool_call_id: str = "") -> Mo
     )
 
 
-def _raw_content_to_input_message(raw_content: Any, role: str) -> List[ModelMessage]:
+def _raw_content_to_input_message(raw_content: Any, role: str) -> List["ModelMessage"]:
     """Convert raw Claude content to CozeLoop ModelMessage(s) suitable for model input.
 
     When content is a list:
@@ -535,7 +1229,7 @@ def _raw_content_to_input_message(raw_content: Any, role: str) -> List[ModelMess
             # Any other type goes into parts as text (serialized)
             parts_list.append(ModelMessagePart(
                 type=ModelMessagePartType.TEXT,
-                text=json.dumps(item, ensure_ascii=False)[:4096]
+                text=dumps_bounded(item, 4096)
             ))
 
     # When parts are used, content should be empty to avoid duplication
@@ -548,405 +1242,1557 @@ def _raw_content_to_input_message(raw_content: Any, role: str) -> List[ModelMess
     )]
 
 
+def _append_turn_history(history_messages: list, turn: Dict[str, Any]):
+    """Append the user input, assistant outputs and tool results of a turn to history."""
+    user_message = turn.get("user_message", {}).get("message", {})
+    user_content = user_message.get("content") if user_message else None
+    if user_message and not is_empty_content(user_content):
+        history_messages.append(_make_message("user", format_content(user_content)))
+    for step in turn.get("steps", []):
+        msg = step.get("assistant_message", {})
+        asst_content = msg.get("message", {}).get("content")
+        if not is_empty_content(asst_content):
+            history_messages.extend(_raw_content_to_input_message(asst_content, "assistant"))
+        for tr in step.get("tool_results", []):
+            tr_content = tr.get("content", "")
+            history_messages.append(_make_tool_result_message(
+                tr_content,
+                tool_call_id=tr.get("tool_use_id", "")
+            ))
+
+
 def _build_history_messages(history_turns: List[Dict[str, Any]]) -> list:
     """Build cumulative history messages from previously processed turns."""
     history_messages = []
     for ht in (history_turns or []):
-        ht_user = ht.get("user_message", {}).get("message", {})
-        ht_user_content = ht_user.get("content") if ht_user else None
-        if ht_user and not is_empty_content(ht_user_content):
-            history_messages.append(_make_message("user", format_content(ht_user_content)))
-        for step in ht.get("steps", []):
-            msg = step.get("assistant_message", {})
-            asst_content = msg.get("message", {}).get("content")
-            if not is_empty_content(asst_content):
-                history_messages.extend(_raw_content_to_input_message(asst_content, "assistant"))
-            for tr in step.get("tool_results", []):
-                tr_content = tr.get("content", "")
-                history_messages.append(_make_tool_result_message(
-                    tr_content,
-                    tool_call_id=tr.get("tool_use_id", "")
-                ))
+        _append_turn_history(history_messages, ht)
     return history_messages
 
 
-# --- CozeLoop Trace Reporting ---
+# --- History Store ---
+#
+# Model inputs are prefixed with every message of the earlier turns. Instead of
+# re-reading and regrouping the whole transcript on each run, the serialized
+# history messages are kept in an append-only JSONL file next to the state file.
+# The state records how many lines of the transcript and how many messages the
+# store covers, so a stale or missing store is rebuilt from the transcript. It
+# also keeps a rolling digest of the stored lines, which spooled batches use to
+# check that the head of the store is still the history they were built on.
+
+def get_history_file_path(state_file: str) -> str:
+    """Get the history store path that belongs to a state file."""
+    state_path = Path(state_file)
+    file_hash = state_path.stem.replace("state_", "", 1)
+    return str(state_path.with_name(f"history_{file_hash}.jsonl"))
+
+def load_history_messages(history_file: str, state: Dict[str, Any]) -> Optional[list]:
+    """Load stored history messages, or None if the store does not match the state."""
+    if state.get("history_line") != state.get("last_processed_line"):
+        return None
+    history_messages = []
+    try:
+        with open(history_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    history_messages.append(ModelMessage.model_validate_json(line))
+    except (IOError, ValueError) as e:
+        debug_log(f"Error loading history store: {e}")
+        return None
+    if len(history_messages) != state.get("history_count") or "history_digest" not in state:
+        debug_log("History store is out of sync with state")
+        return None
+    return history_messages
+
+def history_digest(prefix_digest: str, lines: Iterable[str]) -> str:
+    """Extend a rolling digest of history store lines (each with its newline)."""
+    digest = prefix_digest
+    for line in lines:
+        digest = hashlib.md5(f"{digest}:{line}".encode()).hexdigest()
+    return digest
+
+def save_history_messages(history_file: str, messages: list, state: Dict[str, Any], append: bool = True):
+    """Write history messages to the store and record its coverage in the state.
+
+    A torn append is caught by the message count check in
+    load_history_messages; a rewrite replaces the store atomically.
+    """
+    lines = [message.model_dump_json() + "\n" for message in messages]
+    try:
+        if append:
+            with open(history_file, 'a', encoding='utf-8') as f:
+                f.writelines(lines)
+        else:
+            atomic_write(history_file, "".join(lines))
+        state["history_count"] = (state.get("history_count", 0) if append else 0) + len(messages)
+        state["history_digest"] = history_digest(state.get("history_digest", "") if append else "", lines)
+        state["history_line"] = state.get("last_processed_line", 0)
+    except IOError as e:
+        debug_log(f"Error saving history store: {e}")
+        state.pop("history_line", None)
+
+
+# --- Model Input Encoding ---
+#
+# Every model span's input is the full context so far, so a turn with N model
+# calls uploads O(N^2) messages. With CC_COZELOOP_INPUT_MODE=delta, the first
+# model span of each turn (and of each sub-agent run) carries the full context
+# and later spans carry only the messages added since the previous model span.
+# Each span is tagged with a rolling digest of its whole input (`input_hash`);
+# delta spans also carry the digest and length of the prefix they extend
+# (`input_prefix_hash`, `input_prefix_len`), so the full input can be
+# reassembled by following the chain of digests.
+
+_validated_inputs = itertools.count(1)
 
-def send_turns_to_cozeloop(turns: List[Dict[str, Any]], session_id: str, history_turns: Optional[List[Dict[str, Any]]] = None):
-    """Send conversation turns to CozeLoop.
-
-    Span hierarchy:
-      root_span (claude_code_request) [input=user_input, output=final_response]
-        +-- turn_span
-              |-- model_span (1st model call)
-              |-- tool_span / agent_span (tool call from 1st model response)
-              |-- model_span (2nd model call, after receiving tool result)
-              |-- tool_span / agent_span (tool call from 2nd model response)
-              |-- ...
-              +-- model_span (Nth model call, final text response)
+
+def _cache_encoding(cache: Dict[int, Any], message) -> tuple:
+    """Encode a model message for _encode_model_input and remember the result."""
+    # Keep the message alive so its id is not reused within the trace
+    entry = cache[id(message)] = (message, message.model_dump_json(exclude_none=True))
+    return entry
+
+
+def _encode_model_input(messages: list, trace: Optional[Dict[str, Any]]) -> Any:
+    """Return a model span input, as JSON assembled from per-message encodings.
+
+    Model inputs repeat the whole context, so building a ModelInput per span
+    and letting the SDK serialize it encodes every history message once per
+    later model span. The encoding of each message is cached in the trace
+    state instead, and the input JSON is joined from it; the SDK sends string
+    inputs as is, so the payload is byte for byte what ModelInput would give.
+    Without trace state the ModelInput itself is returned.
     """
-    if not turns:
+    model_input = None
+    if not trace or VALIDATE_SAMPLE and next(_validated_inputs) % VALIDATE_SAMPLE == 0:
+        model_input = ModelInput(messages=list(messages), tools=[],
+                                 tool_choice=ModelToolChoice(type="", function=None))
+        if not trace:
+            return model_input
+    cache = trace["encoded"]
+    fragments = [(cache.get(id(message)) or _cache_encoding(cache, message))[1] for message in messages]
+    encoded = '{"messages":[' + ",".join(fragments) + '],"tools":[],"tool_choice":{"type":""}}'
+    if model_input is not None and encoded != model_input.model_dump_json(exclude_none=True):
+        debug_log("Encoded model input differs from ModelInput, sending the model instead")
+        return model_input
+    return encoded
+
+
+def _new_input_cursor() -> Dict[str, Any]:
+    """Track how much of a growing input message list was already sent."""
+    return {"sent": 0, "digest": ""}
+
+
+def _chain_digest(prefix_digest: str, messages: list) -> str:
+    """Extend a rolling digest of model messages with further messages."""
+    digest = prefix_digest
+    for message in messages:
+        message_digest = hashlib.sha1(message.model_dump_json().encode()).hexdigest()
+        digest = hashlib.sha1(f"{digest}:{message_digest}".encode()).hexdigest()
+    return digest
+
+
+def _set_model_input(span, messages: list, cursor: Dict[str, Any],
+                     trace: Optional[Dict[str, Any]] = None, history_len: int = 0):
+    """Set a model span input, as full context or as a delta depending on the input mode.
+
+    `trace` is the per-trace state (see _new_trace_state); `history_len` is the
+    number of leading messages that come from earlier turns.
+    """
+    if INPUT_MODE != "delta":
+        span.set_input(_encode_model_input(_prepare_model_messages(span, messages, history_len, trace), trace))
         return
 
-    debug_log(f"Initializing CozeLoop client for session: {session_id}")
-    client = cozeloop.new_client()
+    sent = cursor["sent"]
+    delta = messages[sent:]
+    digest = _chain_digest(cursor["digest"], delta)
+    tags = {"input_encoding": "delta" if sent else "full", "input_hash": digest}
+    if sent:
+        tags["input_prefix_hash"] = cursor["digest"]
+        tags["input_prefix_len"] = sent
+    span.set_tags(tags)
+    span.set_input(_encode_model_input(
+        _prepare_model_messages(span, delta, max(history_len - sent, 0), trace), trace))
+    cursor["sent"] = len(messages)
+    cursor["digest"] = digest
+
+
+# --- Content Dedup ---
+#
+# Tool outputs and file contents recur throughout a session: every later model
+# span of a turn repeats them in its input, and so does every later turn
+# through the history prefix. With CC_COZELOOP_DEDUP=true, a text block of at
+# least CC_COZELOOP_DEDUP_MIN_CHARS characters is sent in full only the first
+# time it occurs in a trace; the span carrying it lists the block digests in
+# its `dedup_blocks` tag. Later occurrences in the same trace are replaced by
+# "[dedup:<digest> <n> chars]". The root span reports the lookups, hits, hit
+# rate and bytes saved of the export.
+#
+# Once every block of a message is known, each later occurrence of it comes
+# out the same, so that copy is kept per message for the rest of the trace:
+# later spans reuse it, and with it its cached encoding (see
+# _encode_model_input), instead of copying and encoding the message again.
+
+def _new_dedup_state() -> Optional[Dict[str, Any]]:
+    """Start the dedup table of a trace, or None when dedup is off."""
+    if not DEDUP_MODE:
+        return None
+    return {"digests": {}, "messages": {}, "lookups": 0, "hits": 0, "bytes_saved": 0}
+
+
+def _dedup_text(text: Any, dedup: Optional[Dict[str, Any]], defined: List[str]) -> Any:
+    """Return `text`, or a reference to it if the trace already carries the same block.
+
+    Digests of blocks seen for the first time are appended to `defined`.
+    """
+    if dedup is None or not isinstance(text, str) or len(text) < DEDUP_MIN_CHARS:
+        return text
+    dedup["lookups"] += 1
+    digest = dedup["digests"].get(text)
+    if digest is None:
+        digest = hashlib.sha1(text.encode()).hexdigest()[:16]
+        dedup["digests"][text] = digest
+        defined.append(digest)
+        return text
+    reference = f"[dedup:{digest} {len(text)} chars]"
+    dedup["hits"] += 1
+    dedup["bytes_saved"] += len(text.encode()) - len(reference)
+    return reference
+
+
+def _tag_dedup_blocks(span, defined: List[str]):
+    """Record on a span the digests of the blocks it carries in full."""
+    if defined:
+        span.set_tags({"dedup_blocks": ",".join(defined)})
+
+
+def _dedup_message(message, dedup: Dict[str, Any], defined: List[str]):
+    """Return `message`, or a copy of it with repeated text blocks replaced by references."""
+    cached = dedup["messages"].get(id(message))
+    if cached is not None:
+        _, copy, hits, saved = cached
+        dedup["lookups"] += hits
+        dedup["hits"] += hits
+        dedup["bytes_saved"] += saved
+        return copy
+    lookups, hits, saved = dedup["lookups"], dedup["hits"], dedup["bytes_saved"]
+    update = {}
+    content = _dedup_text(message.content, dedup, defined)
+    if content is not message.content:
+        update["content"] = content
+    if message.parts:
+        parts = []
+        for part in message.parts:
+            text = _dedup_text(part.text, dedup, defined)
+            parts.append(part if text is part.text else part.model_copy(update={"text": text}))
+        if any(new is not old for new, old in zip(parts, message.parts)):
+            update["parts"] = parts
+    copy = message.model_copy(update=update) if update else message
+    hits = dedup["hits"] - hits
+    if dedup["lookups"] - lookups == hits:
+        # Every block was a reference: later occurrences come out the same.
+        # Keep the message alive so its id is not reused within the trace
+        dedup["messages"][id(message)] = (message, copy, hits, dedup["bytes_saved"] - saved)
+    return copy
+
+
+def _dedup_messages(span, messages: list, dedup: Optional[Dict[str, Any]]) -> list:
+    """Copy model messages with repeated text blocks replaced by references."""
+    if dedup is None:
+        return list(messages)
+    defined: List[str] = []
+    result = [_dedup_message(message, dedup, defined) for message in messages]
+    _tag_dedup_blocks(span, defined)
+    return result
+
+
+def _dedup_tags(dedup: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Summarize the dedup table of a trace as root span tags."""
+    if dedup is None:
+        return {}
+    return {
+        "dedup_lookups": dedup["lookups"],
+        "dedup_hits": dedup["hits"],
+        "dedup_hit_rate": round(dedup["hits"] / dedup["lookups"], 3) if dedup["lookups"] else 0,
+        "dedup_bytes_saved": dedup["bytes_saved"],
+    }
+
+
+# --- Payload Budget ---
+#
+# CC_COZELOOP_TRACE_BUDGET_BYTES and CC_COZELOOP_SPAN_BUDGET_BYTES cap the
+# payload of one trace and of one span (estimated as serialized characters).
+# As a trace uses up its budget, detail is degraded in steps that never go
+# back within the trace:
+#   level 1 (50% used): model inputs drop the history of earlier turns
+#   level 2 (75% used): tool outputs and tool results in model inputs are cut
+#                       to DEGRADED_TOOL_OUTPUT_CHARS
+#   level 3 (90% used): sub-agent runs are summarized on their agent span
+#                       instead of exported step by step
+#   level 4 (spent):    model inputs, model outputs, tool inputs and tool
+#                       outputs are replaced by their size in `budget_*` tags
+# so a trace overshoots its budget only by the span that spent it and the
+# empty payloads of the spans after it.
+# A span over the span budget gets the same treatment on its own, and a model
+# input still over it loses its oldest messages. Each degraded span records
+# what was dropped in `budget_*` tags; the root span reports the trace total.
+
+def _new_budget_state() -> Optional[Dict[str, Any]]:
+    """Start the budget accounting of a trace, or None when no budget is set."""
+    if not TRACE_BUDGET_BYTES and not SPAN_BUDGET_BYTES:
+        return None
+    return {"bytes": 0, "level": 0, "degraded_spans": 0, "sizes": {}}
 
+
+def _budget_level(budget: Optional[Dict[str, Any]]) -> int:
+    """Return the degradation level the trace has reached."""
+    if budget is None or not TRACE_BUDGET_BYTES:
+        return 0
+    used = budget["bytes"] / TRACE_BUDGET_BYTES
+    level = 0 if used < 0.5 else 1 if used < 0.75 else 2 if used < 0.9 else 3 if used < 1 else 4
+    budget["level"] = max(budget["level"], level)
+    return budget["level"]
+
+
+def _message_size(message, budget: Dict[str, Any]) -> int:
+    """Serialized size of a model message, computed once per message object."""
+    entry = budget["sizes"].get(id(message))
+    if entry is None:
+        # Keep the message alive so its id is not reused within the trace
+        entry = budget["sizes"][id(message)] = (message, len(message.model_dump_json()))
+    return entry[1]
+
+
+def _shrink_tool_message(message):
+    """Copy a tool result message with its text cut to DEGRADED_TOOL_OUTPUT_CHARS."""
+    text = message.content or "\n".join(part.text or "" for part in message.parts)
+    return message.model_copy(update={"content": truncate_text(text, DEGRADED_TOOL_OUTPUT_CHARS), "parts": []})
+
+
+def _degrade_model_messages(span, messages: list, history_len: int, budget: Optional[Dict[str, Any]]) -> list:
+    """Drop and shrink model input messages as the trace and span budgets require."""
+    if budget is None:
+        return messages
+    level = _budget_level(budget)
+
+    def over_span_budget(msgs) -> bool:
+        return bool(SPAN_BUDGET_BYTES) and sum(_message_size(m, budget) for m in msgs) > SPAN_BUDGET_BYTES
+
+    tags: Dict[str, Any] = {}
+    if level >= 4:
+        if messages:
+            span.set_tags({"budget_dropped_messages": len(messages), "budget_level": level})
+            budget["degraded_spans"] += 1
+        return []
+    if history_len and (level >= 1 or over_span_budget(messages)):
+        messages = messages[history_len:]
+        tags["budget_dropped_history"] = history_len
+    if level >= 2 or over_span_budget(messages):
+        shrunk = [
+            _shrink_tool_message(m) if m.role == "tool" and _message_size(m, budget) > DEGRADED_TOOL_OUTPUT_CHARS else m
+            for m in messages
+        ]
+        count = sum(1 for new, old in zip(shrunk, messages) if new is not old)
+        if count:
+            messages = shrunk
+            tags["budget_shrunk_tool_results"] = count
+    if over_span_budget(messages):
+        # Keep the most recent messages that fit, and at least the last one
+        size = 0
+        start = len(messages)
+        while start > 0 and size + _message_size(messages[start - 1], budget) <= SPAN_BUDGET_BYTES:
+            start -= 1
+            size += _message_size(messages[start], budget)
+        start = min(start, len(messages) - 1)
+        messages = messages[start:]
+        tags["budget_dropped_messages"] = start
+    if tags:
+        tags["budget_level"] = level
+        span.set_tags(tags)
+        budget["degraded_spans"] += 1
+    return messages
+
+
+def _degrade_tool_output(span, output: str, budget: Optional[Dict[str, Any]]) -> str:
+    """Cut a tool output as the trace and span budgets require."""
+    if budget is None:
+        return output
+    level = _budget_level(budget)
+    if level >= 4:
+        if output:
+            span.set_tags({"budget_dropped_output": len(output), "budget_level": level})
+            budget["degraded_spans"] += 1
+        return ""
+    limit = DEGRADED_TOOL_OUTPUT_CHARS if level >= 2 else SPAN_BUDGET_BYTES
+    if limit and len(output) > limit:
+        span.set_tags({"budget_shrunk_output": len(output), "budget_level": level})
+        budget["degraded_spans"] += 1
+        return truncate_text(output, limit)
+    return output
+
+
+def _degrade_span_payload(span, size: int, budget: Optional[Dict[str, Any]], tag: str) -> bool:
+    """Return True if a model output or tool input of `size` must be dropped, tagging the span."""
+    if budget is None or _budget_level(budget) < 4 or not size:
+        return False
+    span.set_tags({tag: size, "budget_level": budget["level"]})
+    budget["degraded_spans"] += 1
+    return True
+
+
+def _budget_tags(budget: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Summarize the budget accounting of a trace as root span tags."""
+    if budget is None:
+        return {}
+    tags = {
+        "budget_trace_bytes": budget["bytes"],
+        "budget_level": budget["level"],
+        "budget_degraded_spans": budget["degraded_spans"],
+    }
+    if budget["level"] >= 4:
+        tags["budget_exhausted"] = True
+    return tags
+
+
+# --- Trace State ---
+#
+# Per-trace state threaded through the span builders: the dedup table, the
+# payload budget (either is None when its feature is off), the cache of
+# encoded model messages (see _encode_model_input), the prompt cache and
+# context growth rollups (see Prompt Cache Metrics and Context Growth), and
+# the model chain: what the next main-chain model call is compared with. The
+# chain outlives the trace; it is kept in the transcript state as
+# "model_chain", so the first call of an export is compared with the last
+# call of the previous one.
+
+def _new_trace_state(chain: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Start the state of one exported trace, continuing `chain` when given."""
+    return {"dedup": _new_dedup_state(), "budget": _new_budget_state(), "encoded": {},
+            "cache": _new_cache_rollup(), "growth": _new_context_growth(),
+            "chain": chain if chain is not None else {}}
+
+
+def _charge(trace: Optional[Dict[str, Any]], size: int):
+    """Count payload bytes against the trace budget."""
+    if trace and trace["budget"] is not None:
+        trace["budget"]["bytes"] += size
+
+
+def _prepare_model_messages(span, messages: list, history_len: int, trace: Optional[Dict[str, Any]]) -> list:
+    """Apply the payload budget and dedup to a model input, charging what is sent."""
+    if not trace:
+        return list(messages)
+    messages = _degrade_model_messages(span, messages, history_len, trace["budget"])
+    messages = _dedup_messages(span, messages, trace["dedup"])
+    if trace["budget"] is not None:
+        _charge(trace, sum(_message_size(m, trace["budget"]) for m in messages))
+    return messages
+
+
+def _set_tool_input(span, tool_input: str, trace: Optional[Dict[str, Any]]):
+    """Set a tool span input, unless the trace budget is spent."""
+    if trace and _degrade_span_payload(span, len(tool_input), trace["budget"], "budget_dropped_input"):
+        tool_input = ""
+    _charge(trace, len(tool_input))
+    span.set_input(tool_input)
+
+
+def _set_model_output(span, model_output, trace: Optional[Dict[str, Any]]):
+    """Set a model span output, as an empty response if the trace budget is spent."""
+    if trace and trace["budget"] is not None:
+        size = len(model_output.model_dump_json())
+        if _degrade_span_payload(span, size, trace["budget"], "budget_dropped_output"):
+            model_output = _build_model_output([])
+            size = len(model_output.model_dump_json())
+        _charge(trace, size)
+    span.set_output(model_output)
+
+
+def _set_tool_output(span, output: str, trace: Optional[Dict[str, Any]]):
+    """Set a tool span output within the budget, as a reference if the trace already carries it."""
+    if not trace:
+        span.set_output(output)
+        return
+    output = _degrade_tool_output(span, output, trace["budget"])
+    defined: List[str] = []
+    output = _dedup_text(output, trace["dedup"], defined)
+    _tag_dedup_blocks(span, defined)
+    _charge(trace, len(output))
+    span.set_output(output)
+
+
+def _trace_tags(trace: Optional[Dict[str, Any]]) -> Dict[str, Any]:
+    """Root span tags summarizing the dedup, budget and prompt cache state of a trace."""
+    if not trace:
+        return {}
+    return {**_dedup_tags(trace["dedup"]), **_budget_tags(trace["budget"]), **_cache_rollup_tags(trace["cache"]),
+            "session_cache_collapses": trace["chain"].get("cache_collapses", 0),
+            **_context_growth_rollup_tags(trace["growth"])}
+
+
+# --- Span Timing ---
+#
+# Every transcript line carries the ISO 8601 `timestamp` it was written at.
+# iter_turns keeps the ones that bound a span: `_end_time` on a step (its
+# last assistant line) and `_start_time` / `_end_time` on a tool call (its
+# tool_use line and the line with its tool_result), for sub-agent steps too.
+# Spans are then placed on the transcript's clock rather than the hook's:
+#
+#   turn       user prompt              -> last step or tool result
+#   model      previous event of turn   -> last line of the response
+#   tool       tool_use                 -> tool_result
+#
+# so model latency, tool latency and the idle time between turns show up as
+# they happened, including when a spooled batch is replayed hours later. A
+# span whose bounds are unknown (older transcripts, interrupted tools) falls
+# back to the hook's clock for its start and to zero length for its end.
+# CC_COZELOOP_SPAN_TIMING=hook times every span by the export instead.
+
+def _parse_timestamp(value: Any) -> Optional[datetime]:
+    """Parse a transcript timestamp; None when absent or invalid."""
+    if not isinstance(value, str) or not value:
+        return None
     try:
-        with client.start_span(name="claude_code_request", span_type="main") as root_span:
-            root_span.set_runtime(Runtime(library="claude-code"))
-            root_span.set_tags({
-                "thread_id": session_id,
-                "total_turns": len(turns),
-                "source": "claude_code"
-            })
-            root_span.set_baggage({
-                "thread_id": session_id,
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        return None
+
+
+def _latest(*times: Optional[datetime]) -> Optional[datetime]:
+    """Return the latest of `times`, ignoring None."""
+    known = [t for t in times if t is not None]
+    return max(known) if known else None
+
+
+def _step_end_time(step: Dict[str, Any]) -> Optional[datetime]:
+    """Return the time of the last event of a step: its response or one of its tool results."""
+    return _latest(_parse_timestamp(step.get("_end_time")),
+                   *(_parse_timestamp(tc.get("_end_time")) for tc in step.get("tool_calls", [])))
+
+
+def _span_start(start: Optional[datetime]) -> Optional[datetime]:
+    """Return the `start_time` to open a span with; None leaves it to the exporter's clock."""
+    return start if SPAN_TIMING == "transcript" else None
+
+
+def _finish_at(span, start: Optional[datetime], end: Optional[datetime]):
+    """Set the finish time of a span started at `start`, never before it."""
+    if start is None or SPAN_TIMING != "transcript":
+        return
+    span.set_finish_time(max(end, start) if end is not None else start)
+
+
+# --- Turn Analytics ---
+#
+# A turn is a chain: each model call waits for the previous event of the turn,
+# the tools it requests run (possibly in parallel), and the next model call
+# waits for the last of their results. The critical path of a turn is thus
+# its model calls interleaved with the tool that finished last in each step;
+# attributing the turn's wall time along it gives a breakdown that sums up:
+#
+#   model     model calls
+#   tools     critical tool calls, by tool name (Task calls with sub-agent
+#             steps count as subagent instead)
+#   gap       everything else, e.g. between a response and its tool start
+#
+# The breakdown is put on the turn span as flat tags (time_*_ms, time_dominant,
+# critical_path) so turns can be filtered in CozeLoop without opening them.
+
+def turn_time_breakdown(turn: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    """Attribute the wall time of a turn along its critical path, in seconds.
+
+    Returns None when the turn has no usable timestamps (see Span Timing).
+    """
+    start = _turn_start_time(turn)
+    if start is None:
+        return None
+    breakdown = {"total": 0.0, "model": 0.0, "tools": {}, "subagent": 0.0, "gap": 0.0, "critical_path": []}
+    last = start
+    for j, step in enumerate(turn.get("steps", [])):
+        model_end = _latest(last, _parse_timestamp(step.get("_end_time")))
+        model_seconds = (model_end - last).total_seconds()
+        breakdown["model"] += model_seconds
+        breakdown["critical_path"].append((f"model_call_{j}", model_seconds))
+
+        # The next model call waits for the last tool result of this step
+        critical, critical_end = None, model_end
+        for tc in step.get("tool_calls", []):
+            end = _parse_timestamp(tc.get("_end_time"))
+            if end is not None and end > critical_end:
+                critical, critical_end = tc, end
+        if critical is not None:
+            tool_start = min(max(_parse_timestamp(critical.get("_start_time")) or model_end, model_end), critical_end)
+            breakdown["gap"] += (tool_start - model_end).total_seconds()
+            tool_seconds = (critical_end - tool_start).total_seconds()
+            tool_name = critical.get("name", "unknown")
+            if critical.get("_sub_steps"):
+                breakdown["subagent"] += tool_seconds
+                breakdown["critical_path"].append((f"agent_{tool_name}", tool_seconds))
+            else:
+                breakdown["tools"][tool_name] = breakdown["tools"].get(tool_name, 0.0) + tool_seconds
+                breakdown["critical_path"].append((f"tool_{tool_name}", tool_seconds))
+        last = critical_end
+    breakdown["total"] = (last - start).total_seconds()
+    return breakdown
+
+
+def _ms(seconds: float) -> int:
+    """Convert seconds to whole milliseconds."""
+    return int(round(seconds * 1000))
+
+
+def _turn_time_tags(turn: Dict[str, Any]) -> Dict[str, Any]:
+    """Format turn_time_breakdown as turn span tags; empty if it is unavailable."""
+    breakdown = turn_time_breakdown(turn) if TURN_ANALYTICS else None
+    if breakdown is None:
+        return {}
+    tools = breakdown["tools"]
+    shares = {"model": breakdown["model"], "subagent": breakdown["subagent"], "gap": breakdown["gap"],
+              **{f"tool:{name}": seconds for name, seconds in tools.items()}}
+    path = ">".join(f"{name}:{_ms(seconds)}" for name, seconds in breakdown["critical_path"])
+    if len(path) > CRITICAL_PATH_TAG_CHARS:
+        path = path[:CRITICAL_PATH_TAG_CHARS - 3].rsplit(">", 1)[0] + ">..."
+    return {
+        "time_total_ms": _ms(breakdown["total"]),
+        "time_model_ms": _ms(breakdown["model"]),
+        "time_tool_ms": _ms(sum(tools.values())),
+        "time_subagent_ms": _ms(breakdown["subagent"]),
+        "time_gap_ms": _ms(breakdown["gap"]),
+        "time_by_tool": json.dumps({name: _ms(seconds) for name, seconds in tools.items()}, separators=(",", ":")),
+        "time_dominant": max(shares, key=shares.get),
+        "critical_path": path,
+    }
+
+
+# --- Prompt Cache Metrics ---
+#
+# A model call's input tokens are split three ways by the API: read from the
+# prompt cache, written to it, and not cached at all. The model span's input
+# token count is their sum; the split is kept as tags on every model span,
+# rolled up on turn and root spans, with the hit ratio read / (read + write +
+# uncached). Sub-agent calls get even shares of the sub-agent totals, as their
+# token counts (see _emit_subagent_spans).
+#
+# A cache collapse is a main-chain model call of at least CACHE_MIN_INPUT_TOKENS
+# whose hit ratio falls below CACHE_COLLAPSE_RATIO right after a call at or
+# above CACHE_WARM_RATIO: the cached prefix was invalidated (an edited system
+# prompt or tool list, an expired cache) and the whole context was paid for
+# again. Such calls are tagged cache_collapse, and counted on turn and root.
+# The previous call may belong to an earlier export, e.g. when the cache
+# expired between two prompts; the root also carries the session's count as
+# session_cache_collapses.
+
+def _cache_usage(usage: Dict[str, Any]) -> Dict[str, int]:
+    """Split the input tokens of an API usage record into cache read, cache write and uncached."""
+    usage = usage or {}
+    return {
+        "read": usage.get("cache_read_input_tokens", 0) or 0,
+        "write": usage.get("cache_creation_input_tokens", 0) or 0,
+        "uncached": usage.get("input_tokens", 0) or 0,
+    }
+
+
+def _cache_hit_ratio(cache: Dict[str, int]) -> Optional[float]:
+    """Return the share of input tokens read from the cache, None without input tokens."""
+    total = cache["read"] + cache["write"] + cache["uncached"]
+    return cache["read"] / total if total else None
+
+
+def _cache_tags(cache: Dict[str, int]) -> Dict[str, Any]:
+    """Format a cache split as span tags."""
+    tags = {
+        "cache_read_tokens": cache["read"],
+        "cache_write_tokens": cache["write"],
+        "uncached_input_tokens": cache["uncached"],
+    }
+    ratio = _cache_hit_ratio(cache)
+    if ratio is not None:
+        tags["cache_hit_ratio"] = round(ratio, 4)
+    return tags
+
+
+def _new_cache_rollup() -> Dict[str, Any]:
+    """Start a prompt cache rollup."""
+    return {"read": 0, "write": 0, "uncached": 0, "collapses": 0}
+
+
+def _add_cache_usage(total: Dict[str, Any], cache: Dict[str, int]):
+    """Add a cache split to a running total."""
+    for key in ("read", "write", "uncached"):
+        total[key] += cache[key]
+
+
+def _check_cache_collapse(trace: Optional[Dict[str, Any]], cache: Dict[str, int]) -> Optional[float]:
+    """Track a main-chain model call; return the previous hit ratio if the call is a cache collapse."""
+    ratio = _cache_hit_ratio(cache)
+    if not trace or ratio is None:
+        return None
+    chain = trace["chain"]
+    previous = chain.get("cache_hit_ratio")
+    chain["cache_hit_ratio"] = ratio
+    if (previous is not None and previous >= CACHE_WARM_RATIO and ratio < CACHE_COLLAPSE_RATIO
+            and sum(cache.values()) >= CACHE_MIN_INPUT_TOKENS):
+        chain["cache_collapses"] = chain.get("cache_collapses", 0) + 1
+        return previous
+    return None
+
+
+def _cache_rollup_tags(rollup: Dict[str, Any]) -> Dict[str, Any]:
+    """Format a prompt cache rollup as turn or root span tags."""
+    tags = {**_cache_tags(rollup), "cache_collapses": rollup["collapses"]}
+    if rollup["collapses"]:
+        tags["cache_collapse"] = True
+    return tags
+
+
+def turn_cache_usage(turn: Dict[str, Any]) -> Dict[str, int]:
+    """Sum the cache split over the model calls of a turn, sub-agents included."""
+    total = {"read": 0, "write": 0, "uncached": 0}
+    for step in turn.get("steps", []):
+        _add_cache_usage(total, _cache_usage(step.get("assistant_message", {}).get("message", {}).get("usage")))
+        for tc in step.get("tool_calls", []):
+            if tc.get("_sub_steps"):
+                _add_cache_usage(total, _cache_usage(tc.get("_total_usage")))
+    return total
+
+
+def _turn_cache_tags(turn: Dict[str, Any], context: Dict[str, Any]) -> Dict[str, Any]:
+    """Roll up the prompt cache usage of a finished turn into its trace; return the turn span tags."""
+    rollup = {**turn_cache_usage(turn), "collapses": context["cache_collapses"]}
+    if context.get("trace"):
+        _add_cache_usage(context["trace"]["cache"], rollup)
+        context["trace"]["cache"]["collapses"] += rollup["collapses"]
+    return _cache_rollup_tags(rollup)
+
+
+def advance_model_chain(turns: Iterable[Dict[str, Any]], chain: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Yield turns unchanged, advancing `chain` over their main-chain model calls as an export would.
+
+    Used when turns are spooled instead of exported, so the next export
+    continues from them.
+    """
+    trace = {"chain": chain}
+    for turn in turns:
+        if not turn.get("_sampled_out"):
+            for step in turn.get("steps", []):
+                cache = _cache_usage(step.get("assistant_message", {}).get("message", {}).get("usage"))
+                _check_cache_collapse(trace, cache)
+                if sum(cache.values()) > 0:
+                    chain["context_tokens"] = sum(cache.values())
+        yield turn
+
+
+# --- Context Growth ---
+#
+# Each main-chain model call resends the whole context, so its size drives
+# both latency and cost. Model spans are tagged with the context size in
+# tokens (from the API usage, cache included) and in bytes (the serialized
+# messages of the full context, independent of the input mode, dedup and
+# budget), and with the growth in tokens since the previous main-chain call,
+# which may belong to an earlier export (see the model chain, _new_trace_state).
+#
+# Two kinds of events are marked on the span where they happen:
+#   context_threshold_crossed  the context reached one of CC_COZELOOP_CONTEXT_THRESHOLDS
+#   context_compacted          it shrank by at least CC_COZELOOP_CONTEXT_SHRINK_RATIO,
+#                              i.e. the conversation was compacted
+# Turn and root spans get the start, end and peak sizes, the growth per step
+# and the number of either event.
+
+def _new_context_growth() -> Dict[str, Any]:
+    """Start a context growth rollup over main-chain model calls, in tokens."""
+    return {"first": None, "last": None, "steps": 0, "peak": 0, "crossings": 0, "compactions": 0}
+
+
+def _context_bytes(context: Dict[str, Any]) -> int:
+    """Serialized size of the model context so far, sizing each message once per turn context.
+
+    `input_messages` only grows within a turn, so the messages sized before are
+    skipped; encodings are shared with _encode_model_input through the trace.
+    """
+    messages, sized = context["input_messages"], context["context_size"]
+    cache = context["trace"]["encoded"] if context.get("trace") else {}
+    for message in messages[sized[0]:]:
+        sized[1] += len((cache.get(id(message)) or _cache_encoding(cache, message))[1])
+    sized[0] = len(messages)
+    return sized[1]
+
+
+def _context_growth_tags(context: Dict[str, Any], tokens: int) -> Dict[str, Any]:
+    """Track the context size of a main-chain model call; return its span tags."""
+    tags = {"context_bytes": _context_bytes(context), "context_messages": len(context["input_messages"])}
+    if tokens <= 0:
+        return tags
+    tags["context_tokens"] = tokens
+    rollups = [context["growth"]] + ([context["trace"]["growth"]] if context.get("trace") else [])
+    if context.get("trace"):
+        chain = context["trace"]["chain"]
+        previous = chain.get("context_tokens")
+        chain["context_tokens"] = tokens
+    else:
+        previous = context["growth"]["last"]
+    crossed = compacted = False
+    if previous is not None:
+        tags["context_growth_tokens"] = tokens - previous
+        crossed = [t for t in CONTEXT_THRESHOLDS if previous < t <= tokens]
+        if crossed:
+            tags["context_threshold_crossed"] = crossed[-1]
+        compacted = tokens <= previous * (1 - CONTEXT_SHRINK_RATIO)
+        if compacted:
+            tags.update({"context_compacted": True, "context_tokens_before": previous})
+    for rollup in rollups:
+        if rollup["first"] is None:
+            rollup["first"] = tokens
+        rollup["last"] = tokens
+        rollup["steps"] += 1
+        rollup["peak"] = max(rollup["peak"], tokens)
+        rollup["crossings"] += len(crossed or [])
+        rollup["compactions"] += compacted
+    return tags
+
+
+def _context_growth_rollup_tags(rollup: Dict[str, Any]) -> Dict[str, Any]:
+    """Format a context growth rollup as turn or root span tags."""
+    if not rollup["steps"]:
+        return {}
+    growth = rollup["last"] - rollup["first"]
+    return {
+        "context_tokens_start": rollup["first"],
+        "context_tokens_end": rollup["last"],
+        "context_peak_tokens": rollup["peak"],
+        "context_growth_tokens": growth,
+        "context_growth_per_step": round(growth / max(rollup["steps"] - 1, 1)),
+        "context_threshold_crossings": rollup["crossings"],
+        "context_compactions": rollup["compactions"],
+    }
+
+
+# --- CozeLoop Trace Reporting ---
+#
+# Span hierarchy:
+#   root_span (claude_code_request) [input=user_input, output=final_response]
+#     +-- turn_span
+#           |-- model_span (1st model call)
+#           |-- tool_span / agent_span (tool call from 1st model response)
+#           |     +-- subagent_model / tool spans (Task tool sub-agent steps)
+#           |-- model_span (2nd model call, after receiving tool result)
+#           |-- ...
+#           +-- model_span (Nth model call, final text response)
+#
+# The helpers below create one level of this tree each, with an explicit
+# parent, so the batch exporter and the live (--follow) exporter share them.
+
+def _last_text_output(turn: Dict[str, Any]) -> Optional[str]:
+    """Return the last assistant text of a turn, if any."""
+    for step in reversed(turn.get("steps", [])):
+        asst = step.get("assistant_message", {}).get("message", {})
+        content = asst.get("content", [])
+        if isinstance(content, list):
+            text_parts = [
+                item.get("text", "")
+                for item in content
+                if isinstance(item, dict) and item.get("type") == "text" and item.get("text")
+            ]
+            if text_parts:
+                return "\n".join(text_parts)
+        elif isinstance(content, str) and content.strip():
+            return content
+    return None
+
+
+def _build_model_output(raw_content: Any) -> "ModelOutput":
+    """Build a model span output: text -> parts, tool_use -> tool_calls."""
+    text_parts = []
+    tool_call_list = []
+    parts_list = []
+    if isinstance(raw_content, list):
+        for item in raw_content:
+            if not isinstance(item, dict):
+                continue
+            item_type = item.get("type", "")
+            if item_type == "text":
+                text = item.get("text", "")
+                if text:
+                    text_parts.append(text)
+                    parts_list.append(ModelMessagePart(type=ModelMessagePartType.TEXT, text=text))
+            elif item_type == "tool_use":
+                tool_call_list.append(ModelToolCall(
+                    id=item.get("id", ""),
+                    type="function",
+                    function=ModelToolCallFunction(
+                        name=item.get("name", ""),
+                        arguments=json.dumps(item.get("input", {}), ensure_ascii=False) if isinstance(item.get("input"), dict) else str(item.get("input", ""))
+                    )
+                ))
+            else:
+                parts_list.append(ModelMessagePart(
+                    type=ModelMessagePartType.TEXT,
+                    text=dumps_bounded(item, 4096)
+                ))
+    elif isinstance(raw_content, str) and raw_content:
+        text_parts.append(raw_content)
+
+    content_text = "" if parts_list else ("\n".join(text_parts) if text_parts else "")
+    finish_reason = "tool_calls" if tool_call_list else "stop"
+
+    return ModelOutput(choices=[ModelChoice(
+        finish_reason=finish_reason,
+        index=0,
+        message=ModelMessage(
+            role="assistant",
+            content=content_text,
+            reasoning_content="",
+            parts=parts_list,
+            name="",
+            tool_calls=tool_call_list if tool_call_list else [],
+            tool_call_id="",
+            metadata={}
+        )
+    )])
+
+
+def _start_root_span(client, session_id: str, start_time: Optional[datetime] = None):
+    """Start the claude_code_request root span of a trace."""
+    root_span = client.start_span(name="claude_code_request", span_type="main", start_time=start_time)
+    root_span.set_runtime(Runtime(library="claude-code"))
+    root_span.set_tags({
+        "thread_id": session_id,
+        "source": "claude_code"
+    })
+    root_span.set_baggage({
+        "thread_id": session_id,
+    })
+    return root_span
+
+
+def _start_turn_span(client, parent, turn: Dict[str, Any], turn_index: int, session_id: str):
+    """Start the span of one turn under `parent`, at the time of its user prompt."""
+    turn_span = client.start_span(name=f"turn_{turn_index}", span_type="main", child_of=parent,
+                                  start_time=_span_start(_turn_start_time(turn)))
+    turn_span.set_runtime(Runtime(library="claude-code"))
+    turn_span.set_tags({
+        "thread_id": session_id,
+        "turn_index": turn_index,
+        "total_steps": len(turn.get("steps", [])),
+        "source": "claude_code",
+    })
+    if turn.get("_sample_reason"):
+        turn_span.set_tags({"sample_reason": turn["_sample_reason"], "sample_rate": SAMPLE_RATE})
+    return turn_span
+
+
+def _turn_start_time(turn: Dict[str, Any]) -> Optional[datetime]:
+    """Return the time of the user prompt of a turn."""
+    return _parse_timestamp(turn.get("user_message", {}).get("timestamp"))
+
+
+def _new_turn_context(turn: Dict[str, Any], history_messages: list,
+                      trace: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Build the model input context for the first model call of a turn.
+
+    `trace` is the per-trace state (see _new_trace_state). `last_time` is
+    the time of the latest event of the turn so far, see Span Timing, and
+    `cache_collapses` counts its model calls flagged by _check_cache_collapse;
+    `growth` and `context_size` track the context size, see Context Growth.
+    """
+    input_messages = list(history_messages)
+    user_message = turn.get("user_message", {}).get("message", {})
+    user_raw_content = user_message.get("content") if user_message else None
+    if not is_empty_content(user_raw_content):
+        input_messages.append(_make_message("user", format_content(user_raw_content)))
+    return {"input_messages": input_messages, "input_cursor": _new_input_cursor(),
+            "history_len": len(history_messages), "trace": trace, "last_time": _turn_start_time(turn),
+            "cache_collapses": 0, "growth": _new_context_growth(), "context_size": [0, 0]}
+
+
+def _emit_step_spans(client, parent, step: Dict[str, Any], step_index: int, context: Dict[str, Any]):
+    """Create the model span and tool/agent spans of one step under `parent`.
+
+    `context` (see _new_turn_context) is extended with the step's assistant
+    output and tool results for the following model calls.
+    """
+    input_messages = context["input_messages"]
+    assistant_msg = step.get("assistant_message", {})
+    assistant_message_obj = assistant_msg.get("message", {})
+    raw_content = assistant_message_obj.get("content", [])
+    model_name = assistant_message_obj.get("model", "claude-code")
+
+    # --- Create model span for this step ---
+    # The model call starts with the previous event of the turn (the prompt or the last tool result)
+    model_start = context.get("last_time")
+    with client.start_span(name=f"model_call_{step_index}", span_type="model", child_of=parent,
+                           start_time=_span_start(model_start)) as model_span:
+        _finish_at(model_span, model_start, _parse_timestamp(step.get("_end_time")))
+        model_span.set_runtime(Runtime(library="claude-code"))
+        model_span.set_model_name(model_name)
+
+        # Set input: accumulated context up to this point
+        _set_model_input(model_span, input_messages, context["input_cursor"],
+                         context.get("trace"), context.get("history_len", 0))
+        _set_model_output(model_span, _build_model_output(raw_content), context.get("trace"))
+
+        # Set token usage for this specific model call
+        usage = assistant_message_obj.get("usage") or {}
+        cache = _cache_usage(usage)
+        input_tokens = sum(cache.values())
+        output_tokens = usage.get("output_tokens", 0) or 0
+        if input_tokens > 0:
+            model_span.set_input_tokens(input_tokens)
+        if output_tokens > 0:
+            model_span.set_output_tokens(output_tokens)
+        model_span.set_tags({**_cache_tags(cache), **_context_growth_tags(context, sum(cache.values()))})
+        previous_ratio = _check_cache_collapse(context.get("trace"), cache)
+        if previous_ratio is not None:
+            context["cache_collapses"] += 1
+            model_span.set_tags({"cache_collapse": True, "cache_hit_ratio_previous": round(previous_ratio, 4)})
+
+    # Add this assistant message to context for subsequent steps
+    if not is_empty_content(raw_content):
+        input_messages.extend(_raw_content_to_input_message(raw_content, "assistant"))
+
+    # --- Create tool spans for each tool call in this step ---
+    for tool_call in step.get("tool_calls", []):
+        _emit_tool_span(client, parent, tool_call, step.get("tool_results", []), step_index, context.get("trace"))
+
+    # Add tool results to context for subsequent model calls
+    for result in step.get("tool_results", []):
+        result_content = result.get("content", "")
+        input_messages.append(_make_tool_result_message(
+            result_content,
+            tool_call_id=result.get("tool_use_id", "")
+        ))
+    context["last_time"] = _latest(model_start, _step_end_time(step))
+
+
+def _emit_tool_span(client, parent, tool_call: Dict[str, Any], tool_results: List[Dict[str, Any]], step_index: int,
+                    trace: Optional[Dict[str, Any]] = None):
+    """Create the span of one tool call, or an agent span with its sub-agent steps."""
+    tool_name = tool_call.get('name', 'unknown')
+    sub_steps = tool_call.get("_sub_steps", [])
+    agent_id = tool_call.get("_agent_id", "")
+    is_agent = bool(sub_steps)
+
+    # Task tool with sub-agent steps uses "agent" span type
+    span_type = "agent" if is_agent else "tool"
+    span_name = f"agent_{tool_name}" if is_agent else f"tool_{tool_name}"
+
+    tool_start = _parse_timestamp(tool_call.get("_start_time"))
+    with client.start_span(name=span_name, span_type=span_type, child_of=parent,
+                           start_time=_span_start(tool_start)) as tool_span:
+        _finish_at(tool_span, tool_start, _parse_timestamp(tool_call.get("_end_time")))
+        tool_span.set_runtime(Runtime(library="claude-code"))
+        tags = {
+            "tool_name": tool_name,
+            "tool_call_id": tool_call.get("id"),
+            "step_index": step_index,
+        }
+        if is_agent:
+            tags["agent_name"] = agent_id
+        tool_span.set_tags(tags)
+        _set_tool_input(tool_span, dumps_bounded(tool_call.get("input", {}), 2000), trace)
+
+        # Find matching tool result
+        tool_id = tool_call.get("id")
+        for result in tool_results:
+            if result.get("tool_use_id") == tool_id:
+                result_content = result.get("content", "")
+                _set_tool_output(tool_span, _format_tool_output(result_content), trace)
+                break
+
+        # If this tool call has sub-agent steps (e.g. Task tool),
+        # create child spans for each sub-agent model call and tool call,
+        # or only summarize them once the trace budget is nearly spent.
+        if sub_steps and trace and _budget_level(trace["budget"]) >= 3:
+            sub_tools = sorted({tc.get("name", "unknown") for step in sub_steps for tc in step.get("tool_calls", [])})
+            tool_span.set_tags({
+                "budget_summarized_subagent": len(sub_steps),
+                "subagent_tools": ",".join(sub_tools),
+                "budget_level": 3,
             })
+            trace["budget"]["degraded_spans"] += 1
+        elif sub_steps:
+            _emit_subagent_spans(client, tool_span, tool_call, trace)
+
+
+def _emit_subagent_spans(client, parent, tool_call: Dict[str, Any], trace: Optional[Dict[str, Any]] = None):
+    """Create model and tool spans for the sub-agent steps of a Task tool call."""
+    sub_steps = tool_call.get("_sub_steps", [])
+    agent_id = tool_call.get("_agent_id", "")
+
+    # Initialize sub-agent input with the prompt (first user message)
+    sub_input_messages = []
+    sub_input_cursor = _new_input_cursor()
+    task_prompt = tool_call.get("input", {}).get("prompt", "")
+    if task_prompt:
+        sub_input_messages.append(_make_message("user", format_content(task_prompt)))
+
+    # Distribute total usage evenly across sub-agent model steps.
+    total_usage = tool_call.get("_total_usage") or {}
+    total_cache = _cache_usage(total_usage)
+    total_in = sum(total_cache.values())
+    total_out = total_usage.get("output_tokens", 0) or 0
+    n_model_steps = len(sub_steps)
+    per_step_in = total_in // n_model_steps if n_model_steps > 0 else 0
+    per_step_out = total_out // n_model_steps if n_model_steps > 0 else 0
+    # Give remainder to the last step
+    remainder_in = total_in - per_step_in * n_model_steps if n_model_steps > 0 else 0
+    remainder_out = total_out - per_step_out * n_model_steps if n_model_steps > 0 else 0
+    # Sub-agent model calls start with the Task call or the previous sub-agent tool result
+    sub_last_time = _parse_timestamp(tool_call.get("_start_time"))
+
+    for sk, sub_step in enumerate(sub_steps):
+        sub_asst = sub_step.get("assistant_message", {}).get("message", {})
+        sub_content = sub_asst.get("content", [])
+        sub_model = sub_asst.get("model") or "claude-code"
+
+        # Sub-agent model span
+        with client.start_span(name=f"subagent_model_{sk}", span_type="model", child_of=parent,
+                               start_time=_span_start(sub_last_time)) as sub_model_span:
+            _finish_at(sub_model_span, sub_last_time, _parse_timestamp(sub_step.get("_end_time")))
+            sub_model_span.set_runtime(Runtime(library="claude-code"))
+            sub_model_span.set_model_name(sub_model)
+            sub_model_span.set_tags({"agent_name": agent_id})
+
+            # Set input: accumulated sub-agent context
+            _set_model_input(sub_model_span, sub_input_messages, sub_input_cursor, trace)
+            _set_model_output(sub_model_span, _build_model_output(sub_content), trace)
+
+            # Distribute tokens evenly; remainder goes to last step
+            step_in = per_step_in + (remainder_in if sk == n_model_steps - 1 else 0)
+            step_out = per_step_out + (remainder_out if sk == n_model_steps - 1 else 0)
+            if step_in > 0:
+                sub_model_span.set_input_tokens(step_in)
+            if step_out > 0:
+                sub_model_span.set_output_tokens(step_out)
+            sub_model_span.set_tags(_cache_tags({
+                key: value // n_model_steps + (value % n_model_steps if sk == n_model_steps - 1 else 0)
+                for key, value in total_cache.items()
+            }))
+
+        # Add assistant output to sub-agent context
+        if not is_empty_content(sub_content):
+            sub_input_messages.extend(
+                _raw_content_to_input_message(sub_content, "assistant")
+            )
+
+        # Sub-agent tool spans
+        for sub_tc in sub_step.get("tool_calls", []):
+            sub_tool_start = _parse_timestamp(sub_tc.get("_start_time"))
+            with client.start_span(name=f"tool_{sub_tc.get('name', 'unknown')}", span_type="tool", child_of=parent,
+                                   start_time=_span_start(sub_tool_start)) as sub_tool_span:
+                _finish_at(sub_tool_span, sub_tool_start, _parse_timestamp(sub_tc.get("_end_time")))
+                sub_tool_span.set_tags({
+                    "tool_name": sub_tc.get("name"),
+                    "tool_call_id": sub_tc.get("id"),
+                    "agent_name": agent_id,
+                })
+                sub_tool_span.set_runtime(Runtime(library="claude-code"))
+                _set_tool_input(sub_tool_span, dumps_bounded(sub_tc.get("input", {}), 2000), trace)
+
+                sub_tool_id = sub_tc.get("id")
+                for sub_result in sub_step.get("tool_results", []):
+                    if sub_result.get("tool_use_id") == sub_tool_id:
+                        sr_content = sub_result.get("content", "")
+                        _set_tool_output(sub_tool_span, _format_tool_output(sr_content), trace)
+                        break
 
-            # Set root span input: first user message across all turns
-            first_user_content = None
-            for turn in turns:
-                um = turn.get("user_message", {}).get("message", {})
-                uc = um.get("content") if um else None
-                if not is_empty_content(uc):
-                    first_user_content = uc
-                    break
-            if first_user_content is not None:
-                root_span.set_input(format_content(first_user_content))
+        # Add tool results to sub-agent context
+        for sub_result in sub_step.get("tool_results", []):
+            sr_content = sub_result.get("content", "")
+            sub_input_messages.append(_make_tool_result_message(
+                sr_content,
+                tool_call_id=sub_result.get("tool_use_id", "")
+            ))
+        sub_last_time = _latest(sub_last_time, _step_end_time(sub_step))
+
+
+def send_turns_to_cozeloop(turns: Iterable[Dict[str, Any]], session_id: str,
+                           history_messages: Optional[list] = None, client: Optional[Any] = None,
+                           chain: Optional[Dict[str, Any]] = None) -> bool:
+    """Send conversation turns to CozeLoop as one trace.
 
-            # Build cumulative history from previously processed turns
-            history_messages = _build_history_messages(history_turns)
+    `turns` may be any iterable (e.g. the `iter_turns` generator); turns are
+    consumed one at a time. `history_messages` holds the model messages of
+    previously processed turns; it is used as the prefix of every model input
+    and is not modified. When `client` is given it is used as is and left open.
+    Turns marked `_sampled_out` (see sample_turns) only extend the history.
+    `chain` is the model chain of the transcript state (see _new_trace_state);
+    it is advanced in place.
+
+    Returns False if building the trace failed. Export errors of the SDK's
+    background uploader are not visible here; see _record_export_event.
+    """
+    turns = iter(turns)
+    history_messages = list(history_messages or [])
+    for first_turn in turns:
+        if not first_turn.get("_sampled_out"):
+            break
+        _append_turn_history(history_messages, first_turn)
+    else:
+        return True
+    turns = itertools.chain([first_turn], turns)
+    total_turns = 0
+
+    _import_sdk()
+    owns_client = client is None
+    if owns_client:
+        debug_log(f"Initializing CozeLoop client for session: {session_id}")
+        client = new_export_client()
+    if _metrics["enabled"] and not isinstance(client, _MeteredClient):
+        client = _MeteredClient(client)
+
+    try:
+        trace_start = _turn_start_time(first_turn)
+        with _start_root_span(client, session_id, _span_start(trace_start)) as root_span:
+            trace = _new_trace_state(chain)
+            root_input_set = False
+            last_output = None
+            trace_end = trace_start
 
             # Process each turn as a child span under the root
-            for i, turn in enumerate(turns):
+            for turn in turns:
+                if turn.get("_sampled_out"):
+                    _append_turn_history(history_messages, turn)
+                    continue
+                i = total_turns
+                total_turns += 1
                 try:
-                    steps = turn.get("steps", [])
-                    total_steps = len(steps)
-
-                    with client.start_span(name=f"turn_{i}", span_type="main") as turn_span:
-                        turn_span.set_runtime(Runtime(library="claude-code"))
-                        turn_span.set_tags({
-                            "thread_id": session_id,
-                            "turn_index": i,
-                            "total_steps": total_steps,
-                            "source": "claude_code",
-                        })
-
-                        # Extract user input for this turn
+                    with _start_turn_span(client, root_span, turn, i, session_id) as turn_span:
+                        # Set root span input: first user message across all turns
                         user_message = turn.get("user_message", {}).get("message", {})
                         user_raw_content = user_message.get("content") if user_message else None
-
-                        # Build input context for the first model call in this turn
-                        input_messages = list(history_messages)
-                        if not is_empty_content(user_raw_content):
-                            input_messages.append(_make_message("user", format_content(user_raw_content)))
+                        if not root_input_set and not is_empty_content(user_raw_content):
+                            root_span.set_input(format_content(user_raw_content))
+                            root_input_set = True
 
                         # Process each step: model_span + tool_spans
-                        for j, step in enumerate(steps):
-                            assistant_msg = step.get("assistant_message", {})
-                            assistant_message_obj = assistant_msg.get("message", {})
-                            raw_content = assistant_message_obj.get("content", [])
-                            model_name = assistant_message_obj.get("model", "claude-code")
-
-                            # --- Create model span for this step ---
-                            with client.start_span(name=f"model_call_{j}", span_type="model") as model_span:
-                                model_span.set_runtime(Runtime(library="claude-code"))
-                                model_span.set_model_name(model_name)
-
-                                # Set input: accumulated context up to this point
-                                model_span.set_input(ModelInput(
-                                    messages=list(input_messages),
-                                    tools=[],
-                                    tool_choice=ModelToolChoice(type="", function=None)
-                                ))
-
-                                # Build output: text -> parts, tool_use -> tool_calls
-                                text_parts = []
-                                tool_call_list = []
-                                parts_list = []
-                                if isinstance(raw_content, list):
-                                    for item in raw_content:
-                                        if not isinstance(item, dict):
-                                            continue
-                                        item_type = item.get("type", "")
-                                        if item_type == "text":
-                                            text = item.get("text", "")
-                                            if text:
-                                                text_parts.append(text)
-                                                parts_list.append(ModelMessagePart(type=ModelMessagePartType.TEXT, text=text))
-                                        elif item_type == "tool_use":
-                                            tool_call_list.append(ModelToolCall(
-                                                id=item.get("id", ""),
-                                                type="function",
-                                                function=ModelToolCallFunction(
-                                                    name=item.get("name", ""),
-                                                    arguments=json.dumps(item.get("input", {}), ensure_ascii=False) if isinstance(item.get("input"), dict) else str(item.get("input", ""))
-                                                )
-                                            ))
-                                        else:
-                                            parts_list.append(ModelMessagePart(
-                                                type=ModelMessagePartType.TEXT,
-                                                text=json.dumps(item, ensure_ascii=False)[:4096]
-                                            ))
-                                elif isinstance(raw_content, str) and raw_content:
-                                    text_parts.append(raw_content)
-
-                                content_text = "" if parts_list else ("\n".join(text_parts) if text_parts else "")
-                                finish_reason = "tool_calls" if tool_call_list else "stop"
-
-                                output_choice = ModelChoice(
-                                    finish_reason=finish_reason,
-                                    index=0,
-                                    message=ModelMessage(
-                                        role="assistant",
-                                        content=content_text,
-                                        reasoning_content="",
-                                        parts=parts_list,
-                                        name="",
-                                        tool_calls=tool_call_list if tool_call_list else [],
-                                        tool_call_id="",
-                                        metadata={}
-                                    )
-                                )
-
-                                model_span.set_output(ModelOutput(choices=[output_choice]))
-
-                                # Set token usage for this specific model call
-                                usage = assistant_message_obj.get("usage", {})
-                                input_tokens = usage.get("input_tokens", 0)
-                                output_tokens = usage.get("output_tokens", 0)
-                                cache_creation = usage.get("cache_creation_input_tokens", 0)
-                                cache_read = usage.get("cache_read_input_tokens", 0)
-                                if input_tokens > 0 or cache_creation > 0 or cache_read > 0:
-                                    model_span.set_input_tokens(input_tokens + cache_creation + cache_read)
-                                if output_tokens > 0:
-                                    model_span.set_output_tokens(output_tokens)
-
-                            # Add this assistant message to context for subsequent steps
-                            if not is_empty_content(raw_content):
-                                input_messages.extend(_raw_content_to_input_message(raw_content, "assistant"))
-
-                            # --- Create tool spans for each tool call in this step ---
-                            for tool_call in step.get("tool_calls", []):
-                                tool_name = tool_call.get('name', 'unknown')
-                                sub_steps = tool_call.get("_sub_steps", [])
-                                agent_id = tool_call.get("_agent_id", "")
-                                is_agent = bool(sub_steps)
-
-                                # Task tool with sub-agent steps uses "agent" span type
-                                span_type = "agent" if is_agent else "tool"
-                                span_name = f"agent_{tool_name}" if is_agent else f"tool_{tool_name}"
-
-                                with client.start_span(name=span_name, span_type=span_type) as tool_span:
-                                    tool_span.set_runtime(Runtime(library="claude-code"))
-                                    tags = {
-                                        "tool_name": tool_name,
-                                        "tool_call_id": tool_call.get("id"),
-                                        "step_index": j,
-                                    }
-                                    if is_agent:
-                                        tags["agent_name"] = agent_id
-                                    tool_span.set_tags(tags)
-                                    tool_span.set_input(
-                                        json.dumps(tool_call.get("input", {}), ensure_ascii=False)[:2000]
-                                    )
-
-                                    # Find matching tool result
-                                    tool_id = tool_call.get("id")
-                                    for result in step.get("tool_results", []):
-                                        if result.get("tool_use_id") == tool_id:
-                                            result_content = result.get("content", "")
-                                            tool_span.set_output(_format_tool_output(result_content))
-                                            break
-
-                                    # If this tool call has sub-agent steps (e.g. Task tool),
-                                    # create child spans for each sub-agent model call and tool call.
-                                    if sub_steps:
-                                        # Initialize sub-agent input with the prompt (first user message)
-                                        sub_input_messages = []
-                                        task_prompt = tool_call.get("input", {}).get("prompt", "")
-                                        if task_prompt:
-                                            sub_input_messages.append(_make_message("user", format_content(task_prompt)))
-
-                                        # Distribute total usage evenly across sub-agent model steps.
-                                        total_usage = tool_call.get("_total_usage", {})
-                                        total_in = (total_usage.get("input_tokens", 0)
-                                                    + total_usage.get("cache_creation_input_tokens", 0)
-                                                    + total_usage.get("cache_read_input_tokens", 0))
-                                        total_out = total_usage.get("output_tokens", 0)
-                                        n_model_steps = len(sub_steps)
-                                        per_step_in = total_in // n_model_steps if n_model_steps > 0 else 0
-                                        per_step_out = total_out // n_model_steps if n_model_steps > 0 else 0
-                                        # Give remainder to the last step
-                                        remainder_in = total_in - per_step_in * n_model_steps if n_model_steps > 0 else 0
-                                        remainder_out = total_out - per_step_out * n_model_steps if n_model_steps > 0 else 0
-
-                                        for sk, sub_step in enumerate(sub_steps):
-                                            sub_asst = sub_step.get("assistant_message", {}).get("message", {})
-                                            sub_content = sub_asst.get("content", [])
-                                            sub_model = sub_asst.get("model") or "claude-code"
-
-                                            # Sub-agent model span
-                                            with client.start_span(name=f"subagent_model_{sk}", span_type="model") as sub_model_span:
-                                                sub_model_span.set_runtime(Runtime(library="claude-code"))
-                                                sub_model_span.set_model_name(sub_model)
-                                                sub_model_span.set_tags({"agent_name": agent_id})
-
-                                                # Set input: accumulated sub-agent context
-                                                sub_model_span.set_input(ModelInput(
-                                                    messages=list(sub_input_messages),
-                                                    tools=[],
-                                                    tool_choice=ModelToolChoice(type="", function=None)
-                                                ))
-
-                                                # Build output for sub-agent model call
-                                                sub_text_parts = []
-                                                sub_tc_list = []
-                                                sub_parts_list = []
-                                                if isinstance(sub_content, list):
-                                                    for item in sub_content:
-                                                        if not isinstance(item, dict):
-                                                            continue
-                                                        item_type = item.get("type", "")
-                                                        if item_type == "text":
-                                                            t = item.get("text", "")
-                                                            if t:
-                                                                sub_text_parts.append(t)
-                                                                sub_parts_list.append(ModelMessagePart(type=ModelMessagePartType.TEXT, text=t))
-                                                        elif item_type == "tool_use":
-                                                            sub_tc_list.append(ModelToolCall(
-                                                                id=item.get("id", ""),
-                                                                type="function",
-                                                                function=ModelToolCallFunction(
-                                                                    name=item.get("name", ""),
-                                                                    arguments=json.dumps(item.get("input", {}), ensure_ascii=False) if isinstance(item.get("input"), dict) else str(item.get("input", ""))
-                                                                )
-                                                            ))
-                                                        else:
-                                                            sub_parts_list.append(ModelMessagePart(
-                                                                type=ModelMessagePartType.TEXT,
-                                                                text=json.dumps(item, ensure_ascii=False)[:4096]
-                                                            ))
-
-                                                sub_content_text = "" if sub_parts_list else ("\n".join(sub_text_parts) if sub_text_parts else "")
-                                                sub_finish = "tool_calls" if sub_tc_list else "stop"
-                                                sub_model_span.set_output(ModelOutput(choices=[ModelChoice(
-                                                    finish_reason=sub_finish,
-                                                    index=0,
-                                                    message=ModelMessage(
-                                                        role="assistant",
-                                                        content=sub_content_text,
-                                                        reasoning_content="",
-                                                        parts=sub_parts_list,
-                                                        name="",
-                                                        tool_calls=sub_tc_list if sub_tc_list else [],
-                                                        tool_call_id="",
-                                                        metadata={}
-                                                    )
-                                                )]))
-
-                                                # Distribute tokens evenly; remainder goes to last step
-                                                step_in = per_step_in + (remainder_in if sk == n_model_steps - 1 else 0)
-                                                step_out = per_step_out + (remainder_out if sk == n_model_steps - 1 else 0)
-                                                if step_in > 0:
-                                                    sub_model_span.set_input_tokens(step_in)
-                                                if step_out > 0:
-                                                    sub_model_span.set_output_tokens(step_out)
-
-                                            # Add assistant output to sub-agent context
-                                            if not is_empty_content(sub_content):
-                                                sub_input_messages.extend(
-                                                    _raw_content_to_input_message(sub_content, "assistant")
-                                                )
-
-                                            # Sub-agent tool spans
-                                            for sub_tc in sub_step.get("tool_calls", []):
-                                                with client.start_span(name=f"tool_{sub_tc.get('name', 'unknown')}", span_type="tool") as sub_tool_span:
-                                                    sub_tool_span.set_tags({
-                                                        "tool_name": sub_tc.get("name"),
-                                                        "tool_call_id": sub_tc.get("id"),
-                                                        "agent_name": agent_id,
-                                                    })
-                                                    sub_tool_span.set_runtime(Runtime(library="claude-code"))
-                                                    sub_tool_span.set_input(
-                                                        json.dumps(sub_tc.get("input", {}), ensure_ascii=False)[:2000]
-                                                    )
-
-                                                    sub_tool_id = sub_tc.get("id")
-                                                    for sub_result in sub_step.get("tool_results", []):
-                                                        if sub_result.get("tool_use_id") == sub_tool_id:
-                                                            sr_content = sub_result.get("content", "")
-                                                            sub_tool_span.set_output(_format_tool_output(sr_content))
-                                                            break
-
-                                            # Add tool results to sub-agent context
-                                            for sub_result in sub_step.get("tool_results", []):
-                                                sr_content = sub_result.get("content", "")
-                                                sub_input_messages.append(_make_tool_result_message(
-                                                    sr_content,
-                                                    tool_call_id=sub_result.get("tool_use_id", "")
-                                                ))
-
-                            # Add tool results to context for subsequent model calls
-                            for result in step.get("tool_results", []):
-                                result_content = result.get("content", "")
-                                input_messages.append(_make_tool_result_message(
-                                    result_content,
-                                    tool_call_id=result.get("tool_use_id", "")
-                                ))
-
-                        # Append this turn's messages to history for subsequent turns
-                        if user_message and not is_empty_content(user_message.get("content")):
-                            history_messages.append(_make_message(
-                                "user", format_content(user_message.get("content"))
-                            ))
-                        for step in steps:
-                            msg = step.get("assistant_message", {})
-                            asst_content = msg.get("message", {}).get("content")
-                            if not is_empty_content(asst_content):
-                                history_messages.extend(_raw_content_to_input_message(asst_content, "assistant"))
-                            for tr in step.get("tool_results", []):
-                                tr_content = tr.get("content", "")
-                                history_messages.append(_make_tool_result_message(
-                                    tr_content,
-                                    tool_call_id=tr.get("tool_use_id", "")
-                                ))
+                        context = _new_turn_context(turn, history_messages, trace)
+                        for j, step in enumerate(turn.get("steps", [])):
+                            _emit_step_spans(client, turn_span, step, j, context)
+                        _finish_at(turn_span, _turn_start_time(turn), context["last_time"])
+                        turn_span.set_tags({**_turn_time_tags(turn), **_turn_cache_tags(turn, context),
+                                            **_context_growth_rollup_tags(context["growth"])})
+                        trace_end = _latest(trace_end, context["last_time"])
 
                 except Exception as e:
                     debug_log(f"Error processing turn {i}: {e}")
-                    continue
+
+                # Append this turn's messages to history for subsequent turns
+                _append_turn_history(history_messages, turn)
+                last_output = _last_text_output(turn) or last_output
 
             # Set root span output: last assistant text from the last step of the last turn
-            last_output = None
-            for turn in reversed(turns):
-                for step in reversed(turn.get("steps", [])):
-                    asst = step.get("assistant_message", {}).get("message", {})
-                    content = asst.get("content", [])
-                    if isinstance(content, list):
-                        text_parts = [
-                            item.get("text", "")
-                            for item in content
-                            if isinstance(item, dict) and item.get("type") == "text" and item.get("text")
-                        ]
-                        if text_parts:
-                            last_output = "\n".join(text_parts)
-                            break
-                    elif isinstance(content, str) and content.strip():
-                        last_output = content
-                        break
-                if last_output:
-                    break
+            root_span.set_tags({"total_turns": total_turns, **_trace_tags(trace)})
+            if METRICS_TAG:
+                root_span.set_tags({"hook_metrics": json.dumps(metrics_snapshot(), separators=(",", ":"))})
             if last_output:
                 root_span.set_output(format_content(last_output))
-
-        debug_log(f"Successfully processed {len(turns)} turn(s) for session {session_id}")
+            _finish_at(root_span, trace_start, trace_end)
+
+        debug_log(f"Successfully processed {total_turns} turn(s) for session {session_id}")
+        dedup, budget = trace["dedup"], trace["budget"]
+        if dedup is not None:
+            debug_log(f"Dedup: {dedup['hits']}/{dedup['lookups']} block(s) deduplicated, "
+                      f"{dedup['bytes_saved']} bytes saved")
+        if budget is not None:
+            debug_log(f"Budget: ~{budget['bytes']} bytes, level {budget['level']}, "
+                      f"{budget['degraded_spans']} span(s) degraded")
+        return True
 
     except Exception as e:
         debug_log(f"An error occurred while sending traces to CozeLoop: {e}")
+        return False
     finally:
         # Crucial: close the client to ensure all buffered traces are sent.
-        client.close()
-        debug_log("CozeLoop client closed.")
+        if owns_client:
+            client.close()
+            debug_log("CozeLoop client closed.")
+
+
+# --- OTLP Export ---
+#
+# With CC_COZELOOP_EXPORTER=otlp the span builders above write to _OtlpClient
+# instead of the SDK client. It keeps finished spans as plain attribute dicts
+# and, on flush, encodes all of them into one OTLP ExportTraceServiceRequest
+# (protobuf, encoded here so no OpenTelemetry or protobuf package is needed),
+# gzips it and POSTs it to CozeLoop's OpenTelemetry endpoint, i.e. one request
+# per hook run unless it exceeds CC_COZELOOP_OTLP_MAX_REQUEST_BYTES. The
+# attributes follow the conventions of the OpenTelemetry integrations:
+# cozeloop.span_type, cozeloop.input/output, cozeloop.system_tag_runtime and
+# gen_ai.* for the model and token counts. Spans of a failed request are
+# counted like SDK drops (see _record_export_event), so spooled batches are
+# kept for replay.
+
+def _pb_varint(n: int) -> bytes:
+    out = bytearray()
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+    return bytes(out)
+
+
+def _pb_bytes(field: int, data: bytes) -> bytes:
+    """Length-delimited field (strings, bytes, sub-messages)."""
+    return _pb_varint(field << 3 | 2) + _pb_varint(len(data)) + data
+
+
+def _pb_uint(field: int, n: int) -> bytes:
+    return _pb_varint(field << 3) + _pb_varint(n & 0xFFFFFFFFFFFFFFFF)
+
+
+def _pb_fixed64(field: int, n: int) -> bytes:
+    return _pb_varint(field << 3 | 1) + n.to_bytes(8, "little")
+
+
+def _otlp_attribute_value(value: Any) -> Any:
+    """Map a tag value to a type OTLP can carry (str, bool, int or float)."""
+    if isinstance(value, (str, bool, int, float)):
+        return value
+    if hasattr(value, "model_dump_json"):
+        return value.model_dump_json(exclude_none=True)
+    return json.dumps(value, ensure_ascii=False, default=str)
+
+
+def _pb_key_value(key: str, value: Any) -> bytes:
+    """Encode an OTLP KeyValue."""
+    if isinstance(value, bool):
+        any_value = _pb_uint(2, int(value))
+    elif isinstance(value, int):
+        any_value = _pb_uint(3, value)
+    elif isinstance(value, float):
+        any_value = _pb_varint(4 << 3 | 1) + struct.pack("<d", value)
+    else:
+        any_value = _pb_bytes(1, str(value).encode("utf-8", "surrogatepass"))
+    return _pb_bytes(1, key.encode()) + _pb_bytes(2, any_value)
+
+
+class _OtlpSpan:
+    """Span with the setters the hook uses, recorded as OTLP attributes."""
+
+    def __init__(self, client: "_OtlpClient", name: str, span_type: str, start_time: Optional[datetime],
+                 parent: Optional["_OtlpSpan"]):
+        self.client = client
+        self.name = name
+        self.trace_id = parent.trace_id if parent else os.urandom(16)
+        self.span_id = os.urandom(8)
+        self.parent_span_id = parent.span_id if parent else b""
+        self.start_ns = int(start_time.timestamp() * 1e9) if start_time else time.time_ns()
+        self.end_ns = 0
+        self.attributes: Dict[str, Any] = {"cozeloop.span_type": span_type}
+        self._baggage: Dict[str, str] = dict(parent._baggage) if parent else {}
+        self.attributes.update(self._baggage)
+
+    def set_tags(self, tags: Dict[str, Any]):
+        for key, value in tags.items():
+            self.attributes[key] = _otlp_attribute_value(value)
+
+    def set_input(self, value: Any):
+        self.attributes["cozeloop.input"] = value if isinstance(value, str) else _otlp_attribute_value(value)
+
+    def set_output(self, value: Any):
+        self.attributes["cozeloop.output"] = value if isinstance(value, str) else _otlp_attribute_value(value)
+
+    def set_runtime(self, runtime: Any):
+        runtime.scene = os.environ.get("COZELOOP_SCENE") or "custom"
+        self.attributes["cozeloop.system_tag_runtime"] = _otlp_attribute_value(runtime)
+
+    def set_baggage(self, baggage: Dict[str, str]):
+        self._baggage.update(baggage)
+        self.set_tags(baggage)
+
+    def baggage(self) -> Dict[str, str]:
+        return dict(self._baggage)
+
+    def set_model_name(self, model_name: str):
+        self.attributes["gen_ai.request.model"] = model_name
+
+    def set_input_tokens(self, tokens: int):
+        self.attributes["gen_ai.usage.input_tokens"] = tokens
+
+    def set_output_tokens(self, tokens: int):
+        self.attributes["gen_ai.usage.output_tokens"] = tokens
+
+    def set_finish_time(self, finish_time: datetime):
+        self.end_ns = int(finish_time.timestamp() * 1e9)
+
+    def finish(self):
+        if self.client is None:
+            return
+        self.end_ns = self.end_ns or time.time_ns()
+        self.client.finished.append(self)
+        self.client = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.finish()
+        return False
+
+    def encode(self) -> bytes:
+        """Encode as an OTLP Span message."""
+        parts = [_pb_bytes(1, self.trace_id), _pb_bytes(2, self.span_id)]
+        if self.parent_span_id:
+            parts.append(_pb_bytes(4, self.parent_span_id))
+        parts += [_pb_bytes(5, self.name.encode()), _pb_uint(6, 1),  # SPAN_KIND_INTERNAL
+                  _pb_fixed64(7, self.start_ns), _pb_fixed64(8, max(self.end_ns, self.start_ns))]
+        parts += [_pb_bytes(9, _pb_key_value(key, value)) for key, value in self.attributes.items()]
+        return b"".join(parts)
+
+
+class _OtlpClient:
+    """Drop-in for the CozeLoop client that exports over OTLP/HTTP, see above."""
+
+    def __init__(self, endpoint: str = "", workspace_id: str = "", api_token: str = ""):
+        self.endpoint = endpoint or OTLP_ENDPOINT
+        self.headers = {
+            "Content-Type": "application/x-protobuf",
+            "Content-Encoding": "gzip",
+            "Authorization": f"Bearer {api_token or os.environ.get('COZELOOP_API_TOKEN', '')}",
+            "cozeloop-workspace-id": workspace_id or os.environ.get("COZELOOP_WORKSPACE_ID", ""),
+        }
+        self.finished: List[_OtlpSpan] = []
+        self.bytes_sent = 0
+
+    def start_span(self, name: str, span_type: str, start_time: Optional[datetime] = None,
+                   child_of: Optional[_OtlpSpan] = None, **kwargs) -> _OtlpSpan:
+        return _OtlpSpan(self, name, span_type, start_time, child_of)
+
+    def _resource_spans(self, encoded_spans: List[bytes]) -> bytes:
+        resource = b"".join(_pb_bytes(1, _pb_key_value(key, value)) for key, value in
+                            (("service.name", "claude-code"), ("host.name", socket.gethostname())))
+        scope = _pb_bytes(1, b"cozeloop-claude-code-hook")
+        scope_spans = _pb_bytes(1, scope) + b"".join(_pb_bytes(2, span) for span in encoded_spans)
+        return _pb_bytes(1, _pb_bytes(1, resource) + _pb_bytes(2, scope_spans))
+
+    def encode_requests(self) -> List[bytes]:
+        """Encode the finished spans into ExportTraceServiceRequest bodies of bounded size."""
+        requests, batch, size = [], [], 0
+        for span in self.finished:
+            encoded = span.encode()
+            if batch and size + len(encoded) > OTLP_MAX_REQUEST_BYTES:
+                requests.append(self._resource_spans(batch))
+                batch, size = [], 0
+            batch.append(encoded)
+            size += len(encoded) + 8
+        if batch:
+            requests.append(self._resource_spans(batch))
+        return requests
+
+    def _post(self, body: bytes) -> bool:
+        """POST one gzip'ed request, retrying once on connection errors, 429 and 5xx."""
+        import urllib.error
+        import urllib.request
+        data = gzip.compress(body, compresslevel=OTLP_GZIP_LEVEL)
+        for attempt in range(2):
+            request = urllib.request.Request(self.endpoint, data=data, headers=self.headers, method="POST")
+            try:
+                with urllib.request.urlopen(request, timeout=OTLP_TIMEOUT) as response:
+                    response.read()
+                self.bytes_sent += len(data)
+                return True
+            except urllib.error.HTTPError as e:
+                debug_log(f"OTLP export failed: HTTP {e.code} {e.read()[:200]!r}")
+                if e.code != 429 and e.code < 500:
+                    return False
+            except (urllib.error.URLError, OSError) as e:
+                debug_log(f"OTLP export failed: {e}")
+            if attempt == 0:
+                time.sleep(1.0)
+        return False
+
+    def flush(self):
+        if not self.finished:
+            return
+        n_spans, requests = len(self.finished), self.encode_requests()
+        self.finished = []
+        sent = sum(1 for body in requests if self._post(body))
+        if sent < len(requests):
+            # Which spans made it is not tracked per request; count them all
+            _export_failures["dropped"] += n_spans
+        debug_log(f"OTLP export: {n_spans} span(s) in {sent}/{len(requests)} request(s)")
+
+    def close(self):
+        self.flush()
+
+
+def new_export_client(**kwargs):
+    """Create the client spans are exported with, per CC_COZELOOP_EXPORTER."""
+    if EXPORTER == "otlp":
+        return _OtlpClient()
+    _import_sdk()
+    return cozeloop.new_client(**kwargs)
+
+
+# --- Sampling ---
+#
+# With CC_COZELOOP_SAMPLE_RATE below 1, only that fraction of sessions is
+# exported. The decision is a deterministic function of the session_id hash,
+# stored in the transcript state so every hook invocation of a session agrees.
+# Turns of sessions left out are still exported when they hit an always-keep
+# rule: a tool error, a sub-agent run, or at least CC_COZELOOP_SAMPLE_KEEP_TOKENS
+# tokens. Kept turns carry the reason in their `sample_reason` tag. Turns that
+# are dropped still feed the model input history of later turns.
+
+def is_session_sampled(state: Dict[str, Any], session_id: str) -> bool:
+    """Return whether a session is sampled in, deciding once per session and rate."""
+    decision = state.get("sampling")
+    if isinstance(decision, dict) and decision.get("session_id") == session_id and decision.get("rate") == SAMPLE_RATE:
+        return decision["sampled"]
+    bucket = int(hashlib.sha256(session_id.encode()).hexdigest()[:8], 16) / 0x100000000
+    sampled = bucket < SAMPLE_RATE
+    state["sampling"] = {"session_id": session_id, "rate": SAMPLE_RATE, "sampled": sampled}
+    debug_log(f"Session {session_id} sampled {'in' if sampled else 'out'} at rate {SAMPLE_RATE}")
+    return sampled
+
+
+def _usage_tokens(usage: Optional[Dict[str, Any]]) -> int:
+    usage = usage or {}
+    return sum(usage.get(key) or 0 for key in ("input_tokens", "cache_creation_input_tokens",
+                                               "cache_read_input_tokens", "output_tokens"))
+
+
+def turn_keep_reason(turn: Dict[str, Any]) -> Optional[str]:
+    """Return why a turn must be kept regardless of session sampling, or None."""
+    tokens = 0
+    has_subagent = False
+    for step in turn.get("steps", []):
+        if any(tr.get("is_error") for tr in step.get("tool_results", [])):
+            return "error"
+        tokens += _usage_tokens(step.get("assistant_message", {}).get("message", {}).get("usage", {}))
+        for tc in step.get("tool_calls", []):
+            if tc.get("_sub_steps"):
+                has_subagent = True
+                tokens += _usage_tokens(tc.get("_total_usage", {}))
+                if any(tr.get("is_error") for sub in tc["_sub_steps"] for tr in sub.get("tool_results", [])):
+                    return "error"
+    if has_subagent:
+        return "subagent"
+    if tokens >= SAMPLE_KEEP_TOKENS:
+        return "tokens"
+    return None
+
+
+def sample_turns(turns: Iterable[Dict[str, Any]], sampled: bool) -> Iterator[Dict[str, Any]]:
+    """Apply sampling to a stream of turns.
+
+    Every turn is passed through, so later turns keep their full history;
+    turns to leave out are marked `_sampled_out` and skipped by
+    send_turns_to_cozeloop.
+    """
+    if SAMPLE_RATE >= 1:
+        yield from turns
+        return
+    dropped = 0
+    for turn in turns:
+        reason = "session" if sampled else turn_keep_reason(turn)
+        if reason:
+            turn["_sample_reason"] = reason
+        else:
+            turn["_sampled_out"] = True
+            dropped += 1
+        yield turn
+    if dropped:
+        debug_log(f"Sampling dropped {dropped} turn(s)")
 
 
 # --- Hook Input ---
@@ -970,21 +2816,954 @@ def read_hook_stdin() -> Dict[str, Any]:
     return {}
 
 
-# --- Main Execution ---
+# --- Exporter Daemon ---
+#
+# With CC_COZELOOP_DAEMON=true the hook hands the payload to a resident local
+# process over a UNIX socket and returns immediately. The daemon keeps one
+# CozeLoop client (and its connection pool) warm, processes payloads one at a
+# time, flushes after each, and exits after CC_COZELOOP_DAEMON_IDLE_SECONDS
+# without requests. It is spawned on demand by the first hook that cannot
+# connect. One daemon runs per set of COZELOOP_* settings, so projects with
+# different workspaces do not share a client.
 
-def main():
-    """Main entry point for the hook script."""
-    debug_log("Hook started.")
+def get_daemon_socket_path() -> str:
+    """Get the daemon socket path for the current CozeLoop settings."""
+    settings = sorted((k, v) for k, v in os.environ.items() if k.startswith(("COZELOOP_", "CC_COZELOOP_")))
+    settings_hash = hashlib.md5(json.dumps(settings).encode()).hexdigest()[:12]
+    return str(get_state_dir() / f"daemon_{settings_hash}.sock")
 
-    # Check if tracing is enabled
-    if os.environ.get("TRACE_TO_COZELOOP", "").lower() == "false":
-        debug_log("TRACE_TO_COZELOOP is set to 'false', skipping")
+
+def _request_daemon(socket_path: str, hook_input: Dict[str, Any]) -> bool:
+    """Send a hook payload to a running daemon; return True once it is accepted."""
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(DAEMON_CONNECT_TIMEOUT)
+            conn.connect(socket_path)
+            conn.sendall(json.dumps(hook_input).encode() + b"\n")
+            return conn.makefile("rb").readline().strip() == b"ok"
+    except OSError:
+        return False
+
+
+def _spawn_daemon():
+    """Start the daemon as a detached background process."""
+    log_path = get_state_dir() / "daemon.log"
+    with open(log_path if DEBUG else os.devnull, 'ab') as log:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--daemon"],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+            start_new_session=True, close_fds=True,
+        )
+
+
+def send_to_daemon(hook_input: Dict[str, Any]) -> bool:
+    """Hand a hook payload to the daemon, spawning it if needed.
+
+    Returns False when the daemon is unavailable and the caller should process
+    the payload itself.
+    """
+    if not hasattr(socket, "AF_UNIX") or fcntl is None:
+        return False
+    # Resolve the transcript here: the daemon has no view of this hook's stdin
+    if hook_input.get("transcript_path"):
+        hook_input = dict(hook_input, transcript_path=os.path.abspath(os.path.expanduser(hook_input["transcript_path"])))
+    socket_path = get_daemon_socket_path()
+    if _request_daemon(socket_path, hook_input):
+        return True
+
+    debug_log("Daemon not running, spawning it")
+    _spawn_daemon()
+    deadline = time.monotonic() + DAEMON_SPAWN_TIMEOUT
+    while time.monotonic() < deadline:
+        time.sleep(0.05)
+        if _request_daemon(socket_path, hook_input):
+            return True
+    debug_log("Daemon did not come up, processing in the hook")
+    return False
+
+
+def run_daemon():
+    """Serve hook payloads on the daemon socket until idle for too long."""
+    socket_path = get_daemon_socket_path()
+    lock_file = open(socket_path + ".lock", 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        debug_log("Another daemon is already running")
         return
 
-    # Read hook input from stdin (Claude Code provides transcript_path, session_id, etc.)
-    hook_input = read_hook_stdin()
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    server.listen(16)
+    server.settimeout(1.0)
+    debug_log(f"Daemon listening on {socket_path}")
+
+    _import_sdk()
+    client = new_export_client()
+    jobs: "queue.Queue[Dict[str, Any]]" = queue.Queue()
+
+    def worker():
+        while True:
+            hook_input = jobs.get()
+            try:
+                process_transcript(hook_input, client=client)
+                client.flush()
+            except Exception as e:
+                debug_log(f"Daemon failed to process payload: {e}")
+            finally:
+                jobs.task_done()
+
+    threading.Thread(target=worker, daemon=True).start()
+
+    last_activity = time.monotonic()
+    try:
+        while True:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                if jobs.unfinished_tasks == 0 and time.monotonic() - last_activity > DAEMON_IDLE_SECONDS:
+                    debug_log("Daemon idle, shutting down")
+                    break
+                continue
+            last_activity = time.monotonic()
+            with conn:
+                try:
+                    conn.settimeout(DAEMON_CONNECT_TIMEOUT)
+                    hook_input = json.loads(conn.makefile("rb").readline())
+                    jobs.put(hook_input)
+                    conn.sendall(b"ok\n")
+                except (OSError, ValueError) as e:
+                    debug_log(f"Daemon received a bad request: {e}")
+    finally:
+        server.close()
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        jobs.join()
+        client.close()
+        lock_file.close()
+        debug_log("Daemon stopped.")
+
+
+# --- Export Spool ---
+#
+# With CC_COZELOOP_SPOOL=true the hook does not export anything itself. The
+# turns ready for export are written to a local spool as one batch file
+# (a header line, then one turn per line) and the transcript state advances
+# only once that file is in place, so the hook never waits on the network and
+# a failed export never loses data. A detached replayer (`--replay`, one per
+# user) drains the spool oldest batch first and deletes each batch once it
+# was exported; while exports fail it retries with exponential backoff. The
+# spool is bounded by CC_COZELOOP_SPOOL_MAX_BYTES and
+# CC_COZELOOP_SPOOL_MAX_AGE_SECONDS, evicting the oldest batches first.
+#
+# Batches reference their model input history by position in the history
+# store (see get_history_file_path) instead of copying it, together with the
+# digest of that many stored lines. The store is appended to, but rewritten
+# when it was rebuilt, e.g. after the transcript was rotated or truncated; a
+# batch whose digest no longer matches the head of the store is exported
+# without history rather than with the context of other messages.
+#
+# A batch is replayed whole: its spans are not tracked one by one, and span
+# ids are assigned at random by the SDK, so the backend cannot tell a replay
+# from new spans. If only some spans of a batch fail, the batch is kept and
+# its next replay exports every span again, including those already
+# accepted: the trace of that batch then shows up twice in CozeLoop (as two
+# traces with the same thread_id and turns). Delivery is at least once per
+# batch, not per span; duplicates are the price of never losing a batch.
+
+_export_failures = {"dropped": 0}
+
+
+def _record_export_event(info) -> None:
+    """Count spans the SDK gave up exporting (failures it retries itself say "retry later")."""
+    if info is None or not info.is_event_fail or info.event_type != "exporter.span_flush.rate":
+        return
+    if "retry later" in (info.detail_msg or ""):
+        return
+    _export_failures["dropped"] += info.item_num
+    debug_log(f"Export failed: {info.detail_msg}")
+
+
+def get_spool_dir() -> Path:
+    """Get (and create) the directory holding spooled span batches."""
+    spool_dir = get_state_dir() / "spool"
+    spool_dir.mkdir(parents=True, exist_ok=True)
+    return spool_dir
+
+
+def _list_spool_batches(spool_dir: Path) -> List[Path]:
+    """List spooled batches, oldest first."""
+    return sorted(spool_dir.glob("batch_*.jsonl"))
+
+
+def evict_spool(spool_dir: Path):
+    """Drop batches older than the age cap, then the oldest ones until the size cap holds."""
+    batches = []
+    now = time.time()
+    for path in _list_spool_batches(spool_dir):
+        try:
+            st = path.stat()
+        except OSError:
+            continue
+        if now - st.st_mtime > SPOOL_MAX_AGE_SECONDS:
+            debug_log(f"Evicting expired spool batch {path.name}")
+            path.unlink(missing_ok=True)
+        else:
+            batches.append((path, st.st_size))
+    total = sum(size for _, size in batches)
+    for path, size in batches:
+        if total <= SPOOL_MAX_BYTES:
+            break
+        debug_log(f"Evicting spool batch {path.name} ({size} bytes) to stay under the size cap")
+        path.unlink(missing_ok=True)
+        total -= size
+
+
+def spool_turns(turns: Iterable[Dict[str, Any]], session_id: str, history_file: str,
+                history_count: int, history_digest: str, chain: Dict[str, Any]) -> bool:
+    """Write turns to the spool as one batch; return False if the batch could not be written.
+
+    `history_count` is the number of messages at the head of the history store
+    that precede these turns and `history_digest` the digest of their lines;
+    `chain` is the model chain the batch starts from.
+    Nothing is written when no turn is to be exported; sampled-out turns are
+    spooled only for the history of later ones.
+    """
+    turns = iter(turns)
+    leading = []
+    for turn in turns:
+        leading.append(turn)
+        if not turn.get("_sampled_out"):
+            break
+    else:
+        return True
+    spool_dir = get_spool_dir()
+    name = f"batch_{time.time_ns():020d}_{os.getpid()}.jsonl"
+    tmp_path = spool_dir / f".{name}.tmp"
+    header = {"session_id": session_id, "history_file": history_file,
+              "history_count": history_count, "history_digest": history_digest, "model_chain": chain,
+              "created": time.time()}
+    try:
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(json.dumps(header) + "\n")
+            for turn in itertools.chain(leading, turns):
+                f.write(json.dumps(turn, ensure_ascii=False) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, spool_dir / name)
+    except (IOError, TypeError, ValueError) as e:
+        debug_log(f"Error writing spool batch: {e}")
+        tmp_path.unlink(missing_ok=True)
+        return False
+    debug_log(f"Spooled batch {name}")
+    evict_spool(spool_dir)
+    return True
+
+
+def _load_spooled_history(history_file: str, count: int, digest: Optional[str]) -> list:
+    """Load the first `count` messages of a history store, or none if they are not the spooled ones."""
+    try:
+        with open(history_file, 'r', encoding='utf-8') as f:
+            lines = list(itertools.islice(f, count))
+    except IOError as e:
+        debug_log(f"Error loading spooled history: {e}")
+        return []
+    if len(lines) != count or (digest is not None and history_digest("", lines) != digest):
+        debug_log("History store changed since the batch was spooled, exporting without context")
+        return []
+    try:
+        return [ModelMessage.model_validate_json(line) for line in lines]
+    except ValueError as e:
+        debug_log(f"Error loading spooled history: {e}")
+        return []
+
+
+def replay_spool_batch(client, path: Path) -> bool:
+    """Export one spooled batch; return True once it is done with (exported or unreadable).
+
+    Any dropped span fails the whole batch, which is then replayed in full
+    later; see Export Spool for the duplicates this can cause.
+    """
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            header = json.loads(f.readline())
+            turns = [json_loads(line) for line in f if line.strip()]
+    except (IOError, ValueError) as e:
+        debug_log(f"Dropping unreadable spool batch {path.name}: {e}")
+        return True
+    history_messages = _load_spooled_history(header.get("history_file", ""), header.get("history_count", 0),
+                                             header.get("history_digest"))
+    dropped = _export_failures["dropped"]
+    sent = send_turns_to_cozeloop(turns, header.get("session_id", ""), history_messages, client=client,
+                                  chain=dict(header.get("model_chain") or {}))
+    client.flush()
+    return sent and _export_failures["dropped"] == dropped
+
+
+def drain_spool(client) -> bool:
+    """Replay spooled batches oldest first; return True once the spool is empty."""
+    spool_dir = get_spool_dir()
+    evict_spool(spool_dir)
+    for path in _list_spool_batches(spool_dir):
+        if not replay_spool_batch(client, path):
+            debug_log(f"Replay of {path.name} failed, keeping it spooled")
+            return False
+        path.unlink(missing_ok=True)
+        debug_log(f"Replayed spool batch {path.name}")
+    return True
+
+
+def _try_lock(lock_file) -> bool:
+    """Take an exclusive, non-blocking lock on an open file."""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def ensure_replayer():
+    """Spawn the spool replayer unless one is already running."""
+    with open(get_spool_dir() / ".lock", 'w') as lock_file:
+        if not _try_lock(lock_file):
+            return
+    log_path = get_state_dir() / "replay.log"
+    with open(log_path if DEBUG else os.devnull, 'ab') as log:
+        subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), "--replay"],
+            stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+            start_new_session=True, close_fds=True,
+        )
+
+
+def run_replayer():
+    """Drain the spool, backing off exponentially while exports fail."""
+    spool_dir = get_spool_dir()
+    lock_file = open(spool_dir / ".lock", 'w')
+    if not _try_lock(lock_file):
+        debug_log("Another replayer is already running")
+        lock_file.close()
+        return
+
+    _import_sdk()
+    client = new_export_client(trace_finish_event_processor=_record_export_event)
+    backoff = SPOOL_BACKOFF_INITIAL
+    try:
+        while True:
+            if not drain_spool(client):
+                debug_log(f"Retrying spool replay in {backoff:.0f}s")
+                time.sleep(backoff)
+                backoff = min(backoff * 2, SPOOL_BACKOFF_MAX)
+                continue
+            backoff = SPOOL_BACKOFF_INITIAL
+            # A hook that spooled a batch while we held the lock did not spawn
+            # a replayer, so look again after letting go of the lock.
+            lock_file.close()
+            if not _list_spool_batches(spool_dir):
+                break
+            lock_file = open(spool_dir / ".lock", 'w')
+            if not _try_lock(lock_file):
+                break
+    finally:
+        lock_file.close()
+        client.close()
+        debug_log("Replayer stopped.")
+
+
+# --- Live Follow Mode ---
+#
+# `cozeloop_hook.py --follow` tails the transcript while the session runs and
+# exports each model step (with its tool spans) as soon as all of its
+# tool_results have landed, instead of one burst when Stop fires. Every turn
+# becomes its own trace, closed when the next user input arrives. A final
+# text-only step is exported once the transcript has been quiet for
+# FOLLOW_QUIET_SECONDS. While the follower runs it owns the transcript's state
+# and holds an flock on state_<hash>.follow, and the regular hook skips any
+# transcript whose follow lock is taken. The lock goes away with the process,
+# however it ends, so a crashed follower never blocks later exports.
+
+IN_MODIFY = 0x00000002
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+
+
+class _TranscriptWatcher:
+    """Wait for a file to change, using inotify on Linux and polling elsewhere."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.fd = None
+        self._last_size = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init1(os.O_NONBLOCK)
+            if fd >= 0:
+                if libc.inotify_add_watch(fd, os.fsencode(path), IN_MODIFY | IN_DELETE_SELF | IN_MOVE_SELF) >= 0:
+                    self.fd = fd
+                else:
+                    os.close(fd)
+        except (OSError, AttributeError) as e:
+            debug_log(f"inotify unavailable, polling instead: {e}")
+
+    def wait(self, timeout: float) -> bool:
+        """Block until the file changes or `timeout` passes; return True on change."""
+        if self.fd is not None:
+            ready, _, _ = select.select([self.fd], [], [], timeout)
+            if not ready:
+                return False
+            try:
+                os.read(self.fd, 65536)
+            except BlockingIOError:
+                pass
+            return True
 
-    # Determine conversation file: prefer stdin, fallback to file scan
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                size = os.stat(self.path).st_size
+            except OSError:
+                size = None
+            if size != self._last_size:
+                self._last_size = size
+                return True
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            time.sleep(min(FOLLOW_POLL_INTERVAL, remaining))
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+def _is_step_ready(step: Dict[str, Any], quiet: bool) -> bool:
+    """A step is ready once every tool call has its result, or, without tool calls, once the file is quiet."""
+    if not step["tool_calls"]:
+        return quiet
+    result_ids = {tr.get("tool_use_id") for tr in step["tool_results"]}
+    return all(tc.get("id") in result_ids for tc in step["tool_calls"])
+
+
+class _FollowExporter:
+    """Export the turns of a live transcript step by step.
+
+    Turns of a session that is sampled out are held back until they close and
+    exported only if they match an always-keep rule (see turn_keep_reason).
+    """
+
+    def __init__(self, client, session_id: str, history_messages: list, sampled: bool = True,
+                 chain: Optional[Dict[str, Any]] = None):
+        self.client = client
+        self.chain = chain if chain is not None else {}
+        self.session_id = session_id
+        self.sampled = sampled
+        self.history_messages = history_messages
+        self.new_history = []
+        self.turn = None
+        self.root_span = None
+        self.turn_span = None
+        self.context = None
+        self.emitted = 0
+
+    def _open(self, turn: Dict[str, Any]):
+        if self.sampled and SAMPLE_RATE < 1:
+            turn["_sample_reason"] = "session"
+        self.turn = turn
+        self.root_span = _start_root_span(self.client, self.session_id, _span_start(_turn_start_time(turn)))
+        user_message = turn.get("user_message", {}).get("message", {})
+        user_raw_content = user_message.get("content") if user_message else None
+        if not is_empty_content(user_raw_content):
+            self.root_span.set_input(format_content(user_raw_content))
+        self.turn_span = _start_turn_span(self.client, self.root_span, turn, 0, self.session_id)
+        self.context = _new_turn_context(turn, self.history_messages, _new_trace_state(self.chain))
+        self.emitted = 0
+
+    def _emit(self, count: int):
+        steps = self.turn["steps"]
+        while self.emitted < count:
+            try:
+                _emit_step_spans(self.client, self.turn_span, steps[self.emitted], self.emitted, self.context)
+            except Exception as e:
+                debug_log(f"Error exporting step {self.emitted}: {e}")
+            self.emitted += 1
+
+    def emit_ready(self, turn: Dict[str, Any], quiet: bool):
+        """Export the steps of the open turn that are ready."""
+        if not self.sampled:
+            return
+        if turn is not self.turn:
+            self._open(turn)
+        steps = turn["steps"]
+        ready = len(steps)
+        if steps and not _is_step_ready(steps[-1], quiet):
+            ready -= 1
+        if ready > self.emitted:
+            self._emit(ready)
+            self.client.flush()
+
+    def close_turn(self, turn: Dict[str, Any]):
+        """Export the remaining steps of a finished turn and end its trace."""
+        if turn is not self.turn:
+            if not self.sampled:
+                turn["_sample_reason"] = turn_keep_reason(turn)
+                if not turn["_sample_reason"]:
+                    debug_log("Sampling dropped a turn")
+                    _append_turn_history(self.history_messages, turn)
+                    _append_turn_history(self.new_history, turn)
+                    return
+            self._open(turn)
+        self._emit(len(turn["steps"]))
+        self.turn_span.set_tags({"total_steps": len(turn["steps"]), **_turn_time_tags(turn),
+                                 **_turn_cache_tags(turn, self.context),
+                                 **_context_growth_rollup_tags(self.context["growth"])})
+        _finish_at(self.turn_span, _turn_start_time(turn), self.context["last_time"])
+        self.turn_span.finish()
+        self.root_span.set_tags({"total_turns": 1, **_trace_tags(self.context["trace"])})
+        last_output = _last_text_output(turn)
+        if last_output:
+            self.root_span.set_output(format_content(last_output))
+        _finish_at(self.root_span, _turn_start_time(turn), self.context["last_time"])
+        self.root_span.finish()
+        self.client.flush()
+        _append_turn_history(self.history_messages, turn)
+        _append_turn_history(self.new_history, turn)
+        self.turn = None
+
+
+def follow_transcript(hook_input: Dict[str, Any]):
+    """Export a transcript live until it has been idle for FOLLOW_EXIT_SECONDS."""
+    conversation_file = resolve_conversation_file(hook_input)
+    if not conversation_file:
+        debug_log("Follow skipped: No conversation file found.")
+        return
+    state_file = get_state_file_path(conversation_file)
+    # Wait for a running hook invocation to commit before taking over the state
+    with open(get_lock_file_path(state_file), 'a') as lock_file:
+        if fcntl is not None:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+        follow_lock = open(get_follow_lock_file_path(state_file), 'a')
+        if not _try_lock(follow_lock):
+            follow_lock.close()
+            debug_log("Another --follow exporter owns this transcript")
+            return
+        state = load_state(state_file)
+        if is_transcript_replaced(conversation_file, state):
+            reset_transcript_state(state)
+        restore_open_turn(conversation_file, state)
+        session_id = hook_input.get("session_id") or state.get("session_id") or Path(conversation_file).stem
+        state["session_id"] = session_id
+        save_state(state_file, state)
+    debug_log(f"Following {conversation_file} (session {session_id})")
+
+    _import_sdk()
+    client = new_export_client()
+    history_file = get_history_file_path(state_file)
+    history_messages, history_stored = load_history(conversation_file, state, history_file)
+    history_base = list(history_messages)
+    exporter = _FollowExporter(client, session_id, history_messages, is_session_sampled(state, session_id),
+                               state.setdefault("model_chain", {}))
+    watcher = _TranscriptWatcher(conversation_file)
+
+    def on_sigterm(signum, frame):
+        raise KeyboardInterrupt
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    last_change = time.monotonic()
+    try:
+        while True:
+            changed = watcher.wait(FOLLOW_QUIET_SECONDS)
+            if is_transcript_replaced(conversation_file, state):
+                # End the trace of the old file's open turn, then start over on the new file
+                if state.get("open_turn"):
+                    exporter.close_turn(state["open_turn"])
+                reset_transcript_state(state)
+                del exporter.history_messages[:]
+                exporter.chain = state.setdefault("model_chain", {})
+                history_base, history_stored = [], False
+                exporter.new_history = []
+            position: Dict[str, Any] = {}
+            messages = _track_position(
+                iter_new_messages(conversation_file, state.get("last_processed_line", 0), state), position)
+            for turn in iter_turns(messages, state):
+                exporter.close_turn(turn)
+            if position["count"]:
+                last_change = time.monotonic()
+                state["last_processed_line"] = position["line"] + 1
+                record_resume_point(state, conversation_file, position["offset"])
+            if state.get("open_turn"):
+                exporter.emit_ready(state["open_turn"], quiet=not changed and not position["count"])
+            if exporter.new_history or position["count"]:
+                store_history(history_file, state, history_base, exporter.new_history, history_stored)
+                history_base, history_stored = [], True
+                exporter.new_history = []
+                save_state(state_file, state)
+            if time.monotonic() - last_change > FOLLOW_EXIT_SECONDS:
+                debug_log("Transcript idle, stopping follow mode")
+                break
+    except KeyboardInterrupt:
+        debug_log("Follow mode interrupted")
+    finally:
+        watcher.close()
+        if state.get("open_turn"):
+            exporter.close_turn(state["open_turn"])
+            state["open_turn"] = None
+            state["pending_tool_ids"] = []
+            state["orphan_progress"] = {}
+        store_history(history_file, state, history_base, exporter.new_history, history_stored)
+        save_state(state_file, state)
+        follow_lock.close()
+        client.close()
+        debug_log("Follow mode stopped.")
+
+
+def _spawn_follower(hook_input: Dict[str, Any]):
+    """Start a detached follower for the transcript named by a hook payload."""
+    conversation_file = resolve_conversation_file(hook_input)
+    if not conversation_file:
+        return
+    args = [sys.executable, os.path.abspath(__file__), "--follow", "--transcript", conversation_file]
+    if hook_input.get("session_id"):
+        args += ["--session-id", hook_input["session_id"]]
+    log_path = get_state_dir() / "follow.log"
+    with open(log_path if DEBUG else os.devnull, 'ab') as log:
+        subprocess.Popen(args, stdin=subprocess.DEVNULL, stdout=log, stderr=log,
+                         start_new_session=True, close_fds=True)
+
+
+# --- Historical Backfill ---
+#
+# `cozeloop_hook.py --backfill` exports every transcript under
+# ~/.claude/projects, e.g. to import sessions recorded before the hook was
+# installed. Transcripts are sharded across a process pool, largest first;
+# each worker keeps one CozeLoop client for all files it handles and flushes
+# after each file. Files go through process_transcript, so the per-file state
+# makes reruns idempotent: a transcript that was exported before is skipped,
+# and one that grew is exported from where it stopped.
+
+_backfill_client = None
+
+
+def _init_backfill_worker():
+    """Create the CozeLoop client shared by all files of a backfill worker."""
+    global _backfill_client
+    import multiprocessing.util
+    _import_sdk()
+    _backfill_client = _MeteredClient(new_export_client())
+    # Pool workers skip atexit; close (and flush) the client on pool shutdown
+    multiprocessing.util.Finalize(_backfill_client, _backfill_client.close, exitpriority=10)
+
+
+def _backfill_file(path: str):
+    """Export one transcript in a backfill worker; return (path, spans, error)."""
+    spans_before = _backfill_client.spans
+    try:
+        outcome = process_transcript({"transcript_path": path}, client=_backfill_client)
+        _backfill_client.flush()
+        if outcome in ("export_failed", "spool_failed"):
+            return path, _backfill_client.spans - spans_before, outcome.replace("_", " ")
+    except Exception as e:
+        return path, _backfill_client.spans - spans_before, str(e)
+    return path, _backfill_client.spans - spans_before, None
+
+
+def run_backfill(jobs: Optional[int] = None) -> int:
+    """Export all transcripts under ~/.claude/projects; return the number of failed files."""
+    import multiprocessing
+    claude_dir = Path.home() / ".claude" / "projects"
+    if not claude_dir.exists():
+        print(f"Claude projects directory not found: {claude_dir}", file=sys.stderr)
+        return 0
+    files = refresh_transcript_index(claude_dir, str(get_state_dir() / "transcript_index.json"))
+    # Largest first, so one long transcript does not end up last on a single worker
+    paths = sorted(files, key=lambda p: files[p][1], reverse=True)
+    total = len(paths)
+    jobs = max(1, min(jobs or os.cpu_count() or 1, total or 1))
+    print(f"Backfilling {total} transcript(s) with {jobs} worker(s)", file=sys.stderr)
+
+    done = spans = failed = 0
+    started = last_report = time.monotonic()
+    with multiprocessing.Pool(jobs, initializer=_init_backfill_worker) as pool:
+        for path, file_spans, error in pool.imap_unordered(_backfill_file, paths):
+            done += 1
+            spans += file_spans
+            if error:
+                failed += 1
+                print(f"Failed to export {path}: {error}", file=sys.stderr)
+            now = time.monotonic()
+            if now - last_report >= 1.0 or done == total:
+                last_report = now
+                elapsed = max(now - started, 1e-9)
+                print(f"[{done}/{total}] {done / elapsed:.1f} files/s, {spans} spans, "
+                      f"{spans / elapsed:.0f} spans/s", file=sys.stderr)
+        pool.close()
+        pool.join()
+    elapsed = time.monotonic() - started
+    print(f"Backfilled {done} transcript(s), {spans} span(s) in {elapsed:.1f}s"
+          f"{f', {failed} failed' if failed else ''}", file=sys.stderr)
+    return failed
+
+
+# --- Offline Report ---
+#
+# `--report` turns a transcript into a local performance view without the SDK
+# or the network: a text summary of where the time and tokens went, and
+# optionally a Chrome trace-event JSON of the same frames, which opens in
+# Perfetto (ui.perfetto.dev), chrome://tracing and speedscope (speedscope.app).
+#
+# Frames mirror the CozeLoop span tree and its transcript timing (see Span
+# Timing). Thread 1 holds the turns and their model calls; the tool calls of
+# a step are laid out on threads 2, 3, ... by their position in the step, so
+# parallel calls do not overlap, with sub-agent steps nested in their Task call.
+
+REPORT_TOP_N = 10
+# Tool input keys shown in the summary, in order of preference
+REPORT_INPUT_KEYS = ("command", "file_path", "pattern", "path", "url", "description", "prompt")
+
+
+def _report_input_summary(tool_input: Any, limit: int = 60) -> str:
+    """Return a one-line hint of what a tool call was about."""
+    value = ""
+    if isinstance(tool_input, dict):
+        value = next((tool_input[k] for k in REPORT_INPUT_KEYS if isinstance(tool_input.get(k), str)), "")
+    value = " ".join(value.split())
+    return value if len(value) <= limit else value[:limit - 3] + "..."
+
+
+def _step_tokens(step: Dict[str, Any]) -> Dict[str, int]:
+    """Return the input (including cache) and output tokens and the cache hit ratio of a step's model call."""
+    usage = step.get("assistant_message", {}).get("message", {}).get("usage", {}) or {}
+    cache = _cache_usage(usage)
+    return {
+        "input_tokens": sum(cache.values()),
+        "output_tokens": usage.get("output_tokens", 0) or 0,
+        "cache_hit_ratio": _cache_hit_ratio(cache),
+    }
+
+
+def report_frames(turns: Iterable[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Flatten turns into timed frames (name, cat, start, end, tid, args).
+
+    Turns without a timestamped user prompt are skipped.
+    """
+    frames = []
+
+    def frame(name, cat, start, end, tid, **args):
+        frames.append({"name": name, "cat": cat, "start": start, "end": max(end or start, start),
+                       "tid": tid, "args": args})
+
+    for i, turn in enumerate(turns):
+        start = _turn_start_time(turn)
+        if start is None:
+            continue
+        turn_frame = len(frames)
+        frame(f"turn_{i}", "turn", start, start, 1, turn_index=i)
+        last = start
+        for j, step in enumerate(turn.get("steps", [])):
+            model_end = _latest(last, _parse_timestamp(step.get("_end_time")))
+            model = step.get("assistant_message", {}).get("message", {}).get("model", "")
+            frame(f"model_call_{j}", "model", last, model_end, 1,
+                  turn_index=i, step_index=j, model=model, **_step_tokens(step))
+            for k, tc in enumerate(step.get("tool_calls", [])):
+                tool_start = _parse_timestamp(tc.get("_start_time")) or model_end
+                tool_name = tc.get("name", "unknown")
+                sub_steps = tc.get("_sub_steps", [])
+                frame(f"agent_{tool_name}" if sub_steps else f"tool_{tool_name}", "agent" if sub_steps else "tool",
+                      tool_start, _parse_timestamp(tc.get("_end_time")), k + 2, turn_index=i, step_index=j,
+                      tool_name=tool_name, input=_report_input_summary(tc.get("input")))
+                sub_last = tool_start
+                for sk, sub_step in enumerate(sub_steps):
+                    sub_end = _latest(sub_last, _parse_timestamp(sub_step.get("_end_time")))
+                    frame(f"subagent_model_{sk}", "model", sub_last, sub_end, k + 2,
+                          turn_index=i, step_index=j, subagent=tc.get("_agent_id", ""))
+                    for sub_tc in sub_step.get("tool_calls", []):
+                        sub_start = _parse_timestamp(sub_tc.get("_start_time")) or sub_end
+                        sub_name = sub_tc.get("name", "unknown")
+                        frame(f"tool_{sub_name}", "tool", sub_start, _parse_timestamp(sub_tc.get("_end_time")), k + 2,
+                              turn_index=i, step_index=j, tool_name=sub_name, subagent=tc.get("_agent_id", ""),
+                              input=_report_input_summary(sub_tc.get("input")))
+                    sub_last = _latest(sub_last, _step_end_time(sub_step))
+            last = _latest(model_end, _step_end_time(step))
+        frames[turn_frame]["end"] = last
+        frames[turn_frame]["args"].update(_turn_time_tags(turn))
+    return frames
+
+
+def _micros(t: datetime, origin: datetime) -> int:
+    """Microseconds from `origin` to `t`."""
+    return round((t - origin).total_seconds() * 1e6)
+
+
+def chrome_trace(frames: List[Dict[str, Any]], title: str = "claude-code") -> Dict[str, Any]:
+    """Convert report frames to the Chrome trace-event format."""
+    origin = min((f["start"] for f in frames), default=None)
+    events = [{"ph": "M", "name": "process_name", "pid": 1, "tid": 0, "args": {"name": title}}]
+    for tid in sorted({f["tid"] for f in frames}):
+        name = "turns / model calls" if tid == 1 else f"tool calls #{tid - 1}"
+        events.append({"ph": "M", "name": "thread_name", "pid": 1, "tid": tid, "args": {"name": name}})
+    # Enclosing frames first when they start together, so viewers nest them
+    for f in sorted(frames, key=lambda f: (f["start"], -(f["end"] - f["start"]).total_seconds())):
+        events.append({
+            "ph": "X", "name": f["name"], "cat": f["cat"], "pid": 1, "tid": f["tid"],
+            "ts": _micros(f["start"], origin), "dur": _micros(f["end"], origin) - _micros(f["start"], origin),
+            "args": f["args"],
+        })
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+
+def _fmt_seconds(seconds: float) -> str:
+    """Format a duration compactly: 850ms, 12.3s, 4m05s, 1h02m."""
+    if seconds < 1:
+        return f"{seconds * 1000:.0f}ms"
+    if seconds < 60:
+        return f"{seconds:.1f}s"
+    if seconds < 3600:
+        return f"{int(seconds // 60)}m{int(seconds % 60):02d}s"
+    return f"{int(seconds // 3600)}h{int(seconds % 3600 // 60):02d}m"
+
+
+def _frame_seconds(frame: Dict[str, Any]) -> float:
+    """Duration of a report frame in seconds."""
+    return (frame["end"] - frame["start"]).total_seconds()
+
+
+def _fmt_share(value: float, busy: float) -> str:
+    """Format a duration with its share of `busy` seconds."""
+    return f"{_fmt_seconds(value)} ({value / busy:.0%})" if busy else _fmt_seconds(value)
+
+
+def _frame_tokens(frame: Dict[str, Any]) -> int:
+    """Input plus output tokens of a model call frame."""
+    return frame["args"]["input_tokens"] + frame["args"]["output_tokens"]
+
+
+def report_summary(turns: List[Dict[str, Any]], frames: List[Dict[str, Any]]) -> str:
+    """Render a text summary: time breakdown, time by tool, slowest tools and most expensive steps."""
+    turn_frames = [f for f in frames if f["cat"] == "turn"]
+    lines = [f"Turns: {len(turns)} ({len(turn_frames)} with timestamps)"]
+    if not turn_frames:
+        return "\n".join(lines)
+
+    totals = {"model": 0.0, "subagent": 0.0, "gap": 0.0}
+    tools_critical = {}
+    for turn in turns:
+        breakdown = turn_time_breakdown(turn)
+        if breakdown is None:
+            continue
+        for key in totals:
+            totals[key] += breakdown[key]
+        for name, value in breakdown["tools"].items():
+            tools_critical[name] = tools_critical.get(name, 0.0) + value
+    busy = sum(_frame_seconds(f) for f in turn_frames)
+    session = (max(f["end"] for f in turn_frames) - min(f["start"] for f in turn_frames)).total_seconds()
+    lines += [
+        f"Session: {_fmt_seconds(session)}, in turns {_fmt_seconds(busy)}, "
+        f"waiting for the user {_fmt_seconds(max(session - busy, 0.0))}",
+        f"Critical path: model {_fmt_share(totals['model'], busy)}, tools {_fmt_share(sum(tools_critical.values()), busy)}, "
+        f"sub-agents {_fmt_share(totals['subagent'], busy)}, gaps {_fmt_share(totals['gap'], busy)}",
+    ]
+    cache = {"read": 0, "write": 0, "uncached": 0}
+    for turn in turns:
+        _add_cache_usage(cache, turn_cache_usage(turn))
+    if _cache_hit_ratio(cache) is not None:
+        lines.append(f"Prompt cache: {_cache_hit_ratio(cache):.0%} hit, {cache['read']} tokens read, "
+                     f"{cache['write']} written, {cache['uncached']} uncached")
+
+    tool_frames = [f for f in frames if f["cat"] in ("tool", "agent")]
+    if tool_frames:
+        by_tool = {}
+        for f in tool_frames:
+            name = f["args"]["tool_name"]
+            stats = by_tool.setdefault(name, {"calls": 0, "total": 0.0, "max": 0.0})
+            stats["calls"] += 1
+            stats["total"] += _frame_seconds(f)
+            stats["max"] = max(stats["max"], _frame_seconds(f))
+        lines += ["", "Time by tool:", f"  {'tool':<20} {'calls':>6} {'total':>9} {'max':>9} {'critical':>9}"]
+        for name, stats in sorted(by_tool.items(), key=lambda item: -item[1]["total"]):
+            lines.append(f"  {name:<20} {stats['calls']:>6} {_fmt_seconds(stats['total']):>9} "
+                         f"{_fmt_seconds(stats['max']):>9} {_fmt_seconds(tools_critical.get(name, 0.0)):>9}")
+        lines += ["", "Slowest tool calls:"]
+        for f in sorted(tool_frames, key=lambda f: -_frame_seconds(f))[:REPORT_TOP_N]:
+            where = f"turn {f['args']['turn_index']} step {f['args']['step_index']}"
+            lines.append(f"  {_fmt_seconds(_frame_seconds(f)):>9}  {f['args']['tool_name']:<16} {where:<18} {f['args']['input']}")
+
+    model_frames = [f for f in frames if f["name"].startswith("model_call_")]
+    if model_frames:
+        lines += ["", "Most expensive model calls:",
+                  f"  {'in tokens':>10} {'out tokens':>10} {'cache hit':>9} {'time':>9}  {'turn/step':<18} model"]
+        for f in sorted(model_frames, key=lambda f: (-_frame_tokens(f), -_frame_seconds(f)))[:REPORT_TOP_N]:
+            where = f"turn {f['args']['turn_index']} step {f['args']['step_index']}"
+            ratio = f["args"]["cache_hit_ratio"]
+            hit = f"{ratio:.0%}" if ratio is not None else "-"
+            lines.append(f"  {f['args']['input_tokens']:>10} {f['args']['output_tokens']:>10} {hit:>9} "
+                         f"{_fmt_seconds(_frame_seconds(f)):>9}  {where:<18} {f['args']['model']}")
+    return "\n".join(lines)
+
+
+def run_report(conversation_file: str, trace_file: str = "") -> bool:
+    """Print the performance summary of a transcript and optionally write its trace-event JSON."""
+    turns = group_messages_into_turns(read_new_messages(conversation_file))
+    frames = report_frames(turns)
+    print(f"Transcript: {conversation_file}")
+    print(report_summary(turns, frames))
+    if trace_file:
+        title = f"claude-code {os.path.splitext(os.path.basename(conversation_file))[0]}"
+        with open(trace_file, "w", encoding="utf-8") as f:
+            json.dump(chrome_trace(frames, title), f, ensure_ascii=False, default=str)
+        print(f"\nTrace events written to {trace_file}")
+    return bool(frames)
+
+
+# --- Main Execution ---
+
+def _peek_session_id(messages: Iterator[Dict[str, Any]]):
+    """Find the first sessionId in a message stream without losing any messages.
+
+    Returns (session_id or None, iterator over all messages).
+    """
+    buffered = []
+    for msg in messages:
+        buffered.append(msg)
+        if msg.get("sessionId"):
+            return msg["sessionId"], itertools.chain(buffered, messages)
+    return None, iter(buffered)
+
+
+def _track_position(messages: Iterable[Dict[str, Any]], position: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
+    """Yield messages unchanged, recording the count, last line number and end offset seen."""
+    position["count"] = 0
+    for msg in messages:
+        position["count"] += 1
+        position["line"] = msg.get("_line_number", 0)
+        position["offset"] = msg.get("_end_offset")
+        yield msg
+
+
+def _iter_exportable_turns(messages: Iterable[Dict[str, Any]], carry: Dict[str, Any],
+                           flush_open: bool, new_history: list) -> Iterator[Dict[str, Any]]:
+    """Yield the turns that are ready to export, appending their messages to `new_history`.
+
+    The turn still open at the end of the stream is only yielded when it is
+    complete or `flush_open` is set; otherwise it stays in `carry`.
+    """
+    for turn in iter_turns(messages, carry):
+        _append_turn_history(new_history, turn)
+        yield turn
+    open_turn = carry.get("open_turn")
+    if open_turn and (flush_open or is_turn_complete(open_turn, carry.get("pending_tool_ids", []))):
+        carry["open_turn"] = None
+        carry["pending_tool_ids"] = []
+        carry["orphan_progress"] = {}
+        _append_turn_history(new_history, open_turn)
+        yield open_turn
+
+
+def resolve_conversation_file(hook_input: Dict[str, Any]) -> Optional[str]:
+    """Determine the conversation file: prefer the hook payload, fallback to file scan."""
     conversation_file = hook_input.get("transcript_path")
     if conversation_file:
         conversation_file = os.path.expanduser(conversation_file)
@@ -994,28 +3773,207 @@ def main():
 
     if not conversation_file:
         conversation_file = find_latest_conversation_file()
+    return conversation_file
+
+
+def load_history(conversation_file: str, state: Dict[str, Any], history_file: str):
+    """Load the history messages of previously processed turns for model input context.
+
+    Returns (history_messages, stored); `stored` is False when the history
+    store was missing or stale and the messages were rebuilt from the
+    transcript. A turn left open by the previous run is carried in the state,
+    not in history.
+    """
+    last_processed_line = state.get("last_processed_line", 0)
+    if last_processed_line <= 0:
+        return [], False
+    stored = load_history_messages(history_file, state)
+    if stored is not None:
+        debug_log(f"Loaded {len(stored)} history message(s) for context.")
+        return stored, True
+    # Store missing or stale: rebuild it from the transcript once
+    history_end = open_turn_start(state)
+    if history_end is None:
+        history_end = last_processed_line
+    historical_messages = itertools.takewhile(
+        lambda m: m.get("_line_number", 0) < history_end,
+        iter_new_messages(conversation_file, 0)
+    )
+    history_messages = _build_history_messages(group_messages_into_turns(historical_messages))
+    debug_log(f"Rebuilt {len(history_messages)} history message(s) for context.")
+    return history_messages, False
+
+
+def store_history(history_file: str, state: Dict[str, Any], history_messages: list,
+                  new_history: list, stored: bool):
+    """Persist new history messages, rewriting the store if it was rebuilt."""
+    if stored:
+        save_history_messages(history_file, new_history, state)
+    else:
+        save_history_messages(history_file, history_messages + new_history, state, append=False)
+
+
+def get_follow_lock_file_path(state_file: str) -> str:
+    """Get the lock file a --follow exporter holds for its lifetime."""
+    return str(Path(state_file).with_suffix(".follow"))
+
+
+def _follower_alive(state_file: str) -> bool:
+    """Return True if a --follow exporter holds the follow lock of a state file."""
+    follow_lock_file = get_follow_lock_file_path(state_file)
+    if fcntl is None or not os.path.exists(follow_lock_file):
+        return False
+    with open(follow_lock_file, 'a') as follow_lock:
+        if not _try_lock(follow_lock):
+            return True
+        _unlock(follow_lock)
+    return False
+
+
+# --- Concurrent Invocations ---
+#
+# Stop, SubagentStop and other events can fire the hook for the same transcript
+# while an earlier invocation is still exporting. The read-process-commit cycle
+# runs under an exclusive flock on state_<hash>.lock. An invocation that finds
+# the lock taken does not wait and redo the work: it appends a rerun request
+# to state_<hash>.rerun and exits. The lock holder looks for a request after
+# releasing the lock and, if there is one, takes the lock again and runs
+# another cycle, which picks up whatever was appended in the meantime. The
+# requester tries the lock once more after writing its request, so a request
+# is never left behind by a holder that has already finished.
+
+def get_lock_file_path(state_file: str) -> str:
+    """Get the lock file that serializes invocations on a state file."""
+    return str(Path(state_file).with_suffix(".lock"))
+
+def get_rerun_file_path(state_file: str) -> str:
+    """Get the file where coalesced invocations leave their rerun requests."""
+    return str(Path(state_file).with_suffix(".rerun"))
+
+
+def _unlock(lock_file):
+    if fcntl is not None:
+        fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def request_rerun(state_file: str, flush_open: bool, lock_file) -> bool:
+    """Ask the lock holder for another cycle; return True if the lock was free after all."""
+    try:
+        with open(get_rerun_file_path(state_file), 'a') as f:
+            f.write("flush\n" if flush_open else "append\n")
+    except IOError as e:
+        debug_log(f"Error writing rerun request: {e}")
+    return _try_lock(lock_file)
+
+
+def take_rerun_request(state_file: str, flush_open: bool) -> bool:
+    """Consume pending rerun requests; return whether this cycle must flush the open turn."""
+    rerun_file = get_rerun_file_path(state_file)
+    claimed = f"{rerun_file}.{os.getpid()}"
+    try:
+        # Renaming first keeps requests appended while we read for the next cycle
+        os.replace(rerun_file, claimed)
+    except FileNotFoundError:
+        return flush_open
+    except OSError as e:
+        debug_log(f"Error claiming rerun requests: {e}")
+        return flush_open
+    try:
+        with open(claimed, 'r') as f:
+            requests = f.read().split()
+        os.unlink(claimed)
+    except IOError as e:
+        debug_log(f"Error reading rerun requests: {e}")
+        return True
+    debug_log(f"Coalesced {len(requests)} concurrent invocation(s)")
+    return flush_open or "flush" in requests
+
 
+def process_transcript(hook_input: Dict[str, Any], client: Optional[Any] = None) -> str:
+    """Export the unprocessed part of the transcript named by a hook payload.
+
+    `client` is passed through to send_turns_to_cozeloop; the daemon uses it to
+    share one CozeLoop client across invocations. In spool mode the turns are
+    spooled instead and `client` is unused. Returns a short outcome label, e.g.
+    "export_failed" when the turns could not be exported and the state was left
+    as is for the next run.
+    """
+    reset_metrics(bool(METRICS_FILE or METRICS_TAG) or _metrics.get("profile", False))
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        outcome = _process_transcript(hook_input, client)
+    finally:
+        if METRICS_FILE:
+            write_metrics({
+                "time": datetime.now().isoformat(),
+                "session_id": hook_input.get("session_id"),
+                "transcript": hook_input.get("transcript_path"),
+                "hook_event_name": hook_input.get("hook_event_name"),
+                "outcome": outcome,
+                "total_ms": round((time.perf_counter() - started) * 1000, 2),
+                **metrics_snapshot(),
+            })
+    return outcome
+
+
+def _process_transcript(hook_input: Dict[str, Any], client: Optional[Any]) -> str:
+    """Body of process_transcript; returns a short outcome label for the metrics."""
+    with _phase("resolve"):
+        conversation_file = resolve_conversation_file(hook_input)
     if not conversation_file:
         debug_log("Execution skipped: No conversation file found.")
-        return
+        return "no_transcript"
 
     debug_log(f"Using conversation file: {conversation_file}")
-
-    # Load state to know where to start reading
     state_file = get_state_file_path(conversation_file)
-    state = load_state(state_file)
+    flush_open = hook_input.get("hook_event_name") in (None, "Stop", "SessionEnd")
+    with open(get_lock_file_path(state_file), 'a') as lock_file:
+        if not _try_lock(lock_file) and not request_rerun(state_file, flush_open, lock_file):
+            debug_log("Another invocation is processing this transcript, coalesced into it")
+            return "coalesced"
+        while True:
+            flush_open = take_rerun_request(state_file, flush_open)
+            outcome = _export_transcript(conversation_file, state_file, hook_input, flush_open, client)
+            _unlock(lock_file)
+            if not os.path.exists(get_rerun_file_path(state_file)) or not _try_lock(lock_file):
+                return outcome
+            debug_log("Picking up work coalesced from a concurrent invocation")
+            flush_open = False
+
+
+def _export_transcript(conversation_file: str, state_file: str, hook_input: Dict[str, Any],
+                       flush_open: bool, client: Optional[Any]) -> str:
+    """Export what was appended to the transcript since the last run; the caller holds its lock."""
+    # Load state to know where to start reading
+    with _phase("state_load"):
+        state = load_state(state_file)
     last_processed_line = state.get("last_processed_line", 0)
 
-    # Read new messages from the file
-    new_messages = read_new_messages(conversation_file, last_processed_line)
+    if _follower_alive(state_file):
+        debug_log("A --follow exporter owns this transcript, skipping")
+        return "followed"
+
+    if is_transcript_replaced(conversation_file, state):
+        reset_transcript_state(state)
+        last_processed_line = 0
+
+    # Fast exit before touching the transcript contents or the SDK
+    has_open_turn = open_turn_start(state) is not None
+    if is_transcript_unchanged(conversation_file, state) and not (flush_open and has_open_turn):
+        debug_log("Transcript unchanged since last run, nothing to do.")
+        return "unchanged"
+
+    with _phase("open_turn_restore"):
+        restore_open_turn(conversation_file, state)
+
+    # Stream new messages from the file
+    new_messages = _timed_iter(iter_new_messages(conversation_file, last_processed_line, state), "read_parse", "lines")
 
     # Determine session ID: prefer stdin, then messages, then state, then generate
     session_id = hook_input.get("session_id")
     if not session_id:
-        for msg in new_messages:
-            if msg.get("sessionId"):
-                session_id = msg.get("sessionId")
-                break
+        session_id, new_messages = _peek_session_id(new_messages)
     if not session_id:
         if state.get("session_id"):
             session_id = state["session_id"]
@@ -1026,31 +3984,160 @@ def main():
     state["session_id"] = session_id
     debug_log(f"Session ID: {session_id}")
 
-    if not new_messages:
+    position: Dict[str, Any] = {}
+    new_messages = _track_position(new_messages, position)
+    first_message = next(new_messages, None)
+    if first_message is None and not (flush_open and has_open_turn):
         debug_log("No new messages to process.")
+        return "no_new_messages"
+    new_messages = itertools.chain([first_message] if first_message else [], new_messages)
+    with _phase("sdk_import"):
+        _import_sdk()
+
+    history_file = get_history_file_path(state_file)
+    with _phase("history_build"):
+        history_messages, history_stored = load_history(conversation_file, state, history_file)
+
+    # Group messages into turns and send to CozeLoop. The state doubles as the
+    # grouper carry, so a turn still in progress (e.g. on SubagentStop) is resumed
+    # by the next run. Stop means the model finished responding, so the last turn
+    # is exported as is.
+    new_history = []
+    turns = sample_turns(_iter_exportable_turns(new_messages, state, flush_open, new_history),
+                         is_session_sampled(state, session_id))
+    turns = _timed_iter(turns, "grouping", "turns")
+    chain = state.setdefault("model_chain", {})
+    if SPOOL_MODE:
+        with _phase("spool_write"):
+            digest = state.get("history_digest", "") if history_stored else history_digest(
+                "", (message.model_dump_json() + "\n" for message in history_messages))
+            spooled = spool_turns(advance_model_chain(turns, chain), session_id, history_file,
+                                  len(history_messages), digest, dict(chain))
+        if not spooled:
+            debug_log("Spool write failed, state not advanced.")
+            return "spool_failed"
+    else:
+        with _phase("span_build"):
+            exported = send_turns_to_cozeloop(turns, session_id, history_messages, client=client, chain=chain)
+        if not exported:
+            debug_log("Export failed, state not advanced; the turns are retried by the next run.")
+            return "export_failed"
+    leftover = next(turns, None)
+    if leftover is not None:
+        debug_log(f"Turn at line {leftover.get('start_line')} was grouped but not exported, state not advanced.")
+        return "export_failed"
+    debug_log(f"Consumed {position['count']} new messages.")
+    if state.get("open_turn"):
+        debug_log(f"Carrying open turn from line {state['open_turn']['start_line']} to the next run")
+
+    # Update state with the new last processed line number
+    with _phase("state_save"):
+        if position["count"]:
+            state["last_processed_line"] = position["line"] + 1
+            record_resume_point(state, conversation_file, position["offset"])
+        store_history(history_file, state, history_messages, new_history, history_stored)
+        save_state(state_file, state)
+    debug_log(f"State updated. Last processed line: {state['last_processed_line']}")
+    if SPOOL_MODE:
+        ensure_replayer()
+    return "spooled" if SPOOL_MODE else "exported"
+
+
+def main():
+    """Main entry point for the hook script."""
+    parser = argparse.ArgumentParser(description="CozeLoop hook for Claude Code")
+    parser.add_argument("--daemon", action="store_true",
+                        help="run the background exporter daemon (normally auto-spawned)")
+    parser.add_argument("--replay", action="store_true",
+                        help="drain the export spool (normally auto-spawned)")
+    parser.add_argument("--backfill", action="store_true",
+                        help="export all transcripts under ~/.claude/projects and exit")
+    parser.add_argument("--jobs", type=int,
+                        help="with --backfill: number of worker processes (default: CPU count)")
+    parser.add_argument("--follow", action="store_true",
+                        help="export spans live while the transcript is written")
+    parser.add_argument("--detach", action="store_true",
+                        help="with --follow: start the follower in the background and return "
+                             "(e.g. from a SessionStart hook)")
+    parser.add_argument("--transcript", help="transcript to follow or report (default: from the hook payload)")
+    parser.add_argument("--session-id", help="session id to report (default: from the hook payload)")
+    parser.add_argument("--report", nargs="?", const="", metavar="FILE",
+                        help="print a performance summary of a transcript (--transcript, default: the "
+                             "latest) without exporting, and write its Chrome trace-event JSON to FILE")
+    parser.add_argument("--profile", nargs="?", const="", metavar="FILE",
+                        help="profile this invocation with cProfile, dump the stats to FILE "
+                             "(default: ~/.claude/cozeloop_state/profile_<pid>.prof) and print "
+                             "the phase timings to stderr")
+    args = parser.parse_args()
+
+    if args.profile is not None:
+        import cProfile
+        profile_path = args.profile or str(get_state_dir() / f"profile_{os.getpid()}.prof")
+        profiler = cProfile.Profile()
+        _metrics["profile"] = True
+        profiler.enable()
+        try:
+            _run(args)
+        finally:
+            profiler.disable()
+            profiler.dump_stats(profile_path)
+            print(f"cProfile stats written to {profile_path}", file=sys.stderr)
+            print(json.dumps(metrics_snapshot(), indent=2), file=sys.stderr)
         return
+    _run(args)
 
-    debug_log(f"Found {len(new_messages)} new messages.")
 
-    # Read historical messages to build context for model input
-    history_turns = []
-    if last_processed_line > 0:
-        historical_messages = read_new_messages(conversation_file, 0)
-        historical_messages = [m for m in historical_messages if m.get("_line_number", 0) < last_processed_line]
-        history_turns = group_messages_into_turns(historical_messages)
-        debug_log(f"Loaded {len(history_turns)} historical turn(s) for context.")
+def _run(args: argparse.Namespace):
+    """Dispatch the parsed command line."""
 
-    # Group messages into turns and send to CozeLoop
-    turns = group_messages_into_turns(new_messages)
-    if turns:
-        send_turns_to_cozeloop(turns, session_id, history_turns)
+    if args.daemon:
+        run_daemon()
+        return
 
-        # Update state with the new last processed line number
-        last_line_in_batch = max(msg.get("_line_number", 0) for msg in new_messages)
-        state["last_processed_line"] = last_line_in_batch + 1
-        save_state(state_file, state)
-        debug_log(f"State updated. Last processed line: {state['last_processed_line']}")
+    if args.replay:
+        run_replayer()
+        return
+
+    if args.backfill:
+        sys.exit(1 if run_backfill(args.jobs) else 0)
+
+    if args.report is not None:
+        if args.transcript and not os.path.exists(args.transcript):
+            sys.exit(f"Transcript not found: {args.transcript}")
+        conversation_file = resolve_conversation_file({"transcript_path": args.transcript})
+        if not conversation_file:
+            sys.exit("No transcript found")
+        sys.exit(0 if run_report(conversation_file, args.report) else 1)
+
+    if args.follow:
+        if os.environ.get("TRACE_TO_COZELOOP", "").lower() == "false":
+            return
+        hook_input = {} if args.transcript else read_hook_stdin()
+        if args.transcript:
+            hook_input["transcript_path"] = args.transcript
+        if args.session_id:
+            hook_input["session_id"] = args.session_id
+        if args.detach:
+            _spawn_follower(hook_input)
+        else:
+            follow_transcript(hook_input)
+        return
+
+    debug_log("Hook started.")
+
+    # Check if tracing is enabled
+    if os.environ.get("TRACE_TO_COZELOOP", "").lower() == "false":
+        debug_log("TRACE_TO_COZELOOP is set to 'false', skipping")
+        return
+
+    # Read hook input from stdin (Claude Code provides transcript_path, session_id, etc.)
+    hook_input = read_hook_stdin()
+
+    if DAEMON_MODE and send_to_daemon(hook_input):
+        debug_log("Hook handed off to daemon.")
+        return
 
+    process_transcript(hook_input)
     debug_log("Hook finished.")
 
 if __name__ == "__main__":
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the direct OTLP/HTTP exporter of cozeloop_hook.py
+
+A generated transcript is exported through _OtlpClient to the local stand-in
+collector of benchmark_hook.py; the gzip'ed request bodies are decoded as
+ExportTraceServiceRequest messages with a minimal protobuf wire-format reader
+(the protobuf package is not a dependency of the hook) and checked against
+the span tree the hook built.
+
+Usage:
+    python -m unittest test_otlp_exporter    (or: python -m pytest test_otlp_exporter.py)
+"""
+
+import gzip
+import json
+import os
+import struct
+import sys
+import tempfile
+import unittest
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Tuple
+from unittest import mock
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import benchmark_hook  # noqa: E402
+import cozeloop_hook  # noqa: E402
+
+
+# --- Protobuf Wire Format ---
+
+def _varint(data: bytes, pos: int) -> Tuple[int, int]:
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, pos
+
+
+def pb_fields(data: bytes) -> List[Tuple[int, Any]]:
+    """Decode one protobuf message into (field number, value) pairs; wire types 0, 1 and 2 only."""
+    fields, pos = [], 0
+    while pos < len(data):
+        key, pos = _varint(data, pos)
+        number, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            value, pos = _varint(data, pos)
+        elif wire_type == 1:
+            value, pos = data[pos:pos + 8], pos + 8
+        elif wire_type == 2:
+            length, pos = _varint(data, pos)
+            value, pos = data[pos:pos + length], pos + length
+        else:
+            raise ValueError(f"unexpected wire type {wire_type} for field {number}")
+        if pos > len(data):
+            raise ValueError("truncated message")
+        fields.append((number, value))
+    return fields
+
+
+def _any_value(data: bytes) -> Any:
+    """Decode an OTLP AnyValue (string, bool, int or double)."""
+    (number, value), = pb_fields(data)
+    if number == 1:
+        return value.decode("utf-8")
+    if number == 2:
+        return bool(value)
+    if number == 3:
+        return value - (1 << 64) if value >= 1 << 63 else value
+    if number == 4:
+        return struct.unpack("<d", value)[0]
+    raise ValueError(f"unexpected AnyValue field {number}")
+
+
+def _key_value(data: bytes) -> Tuple[str, Any]:
+    fields = dict(pb_fields(data))
+    return fields[1].decode("utf-8"), _any_value(fields[2])
+
+
+def decode_export_request(body: bytes) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Decode an ExportTraceServiceRequest into (resource attributes, spans) per resource."""
+    resources, spans = [], []
+    for number, resource_spans in pb_fields(body):
+        assert number == 1, "ExportTraceServiceRequest.resource_spans"
+        for field, value in pb_fields(resource_spans):
+            if field == 1:
+                resources.append(dict(_key_value(kv) for n, kv in pb_fields(value) if n == 1))
+            elif field == 2:
+                for scope_field, scope_value in pb_fields(value):
+                    if scope_field != 2:
+                        continue
+                    span = {"attributes": {}, "parent_span_id": b""}
+                    for span_field, span_value in pb_fields(scope_value):
+                        if span_field == 1:
+                            span["trace_id"] = span_value
+                        elif span_field == 2:
+                            span["span_id"] = span_value
+                        elif span_field == 4:
+                            span["parent_span_id"] = span_value
+                        elif span_field == 5:
+                            span["name"] = span_value.decode("utf-8")
+                        elif span_field == 6:
+                            span["kind"] = span_value
+                        elif span_field == 7:
+                            span["start_ns"] = struct.unpack("<Q", span_value)[0]
+                        elif span_field == 8:
+                            span["end_ns"] = struct.unpack("<Q", span_value)[0]
+                        elif span_field == 9:
+                            key, attr = _key_value(span_value)
+                            span["attributes"][key] = attr
+                    spans.append(span)
+    return resources, spans
+
+
+# --- Tests ---
+
+class OtlpExporterTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.collector = benchmark_hook._Collector()
+        cls.tmp = tempfile.TemporaryDirectory()
+        cls.transcript = os.path.join(cls.tmp.name, "session.jsonl")
+        benchmark_hook.generate_transcript(cls.transcript, 3, 3, subagent_every=2)
+        cozeloop_hook._import_sdk()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.collector.shutdown()
+        cls.collector.server_close()
+        cls.tmp.cleanup()
+
+    def setUp(self):
+        self.collector.reset()
+        # Skip the pause between a failed request and its retry
+        patcher = mock.patch.object(cozeloop_hook.time, "sleep")
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def export(self) -> int:
+        """Export the transcript through a fresh client; return the number of spans started."""
+        client = cozeloop_hook._MeteredClient(
+            cozeloop_hook._OtlpClient(self.collector.url, workspace_id="ws-1", api_token="token-1"))
+        turns = cozeloop_hook.group_messages_into_turns(cozeloop_hook.read_new_messages(self.transcript))
+        self.assertTrue(cozeloop_hook.send_turns_to_cozeloop(turns, "session-1", client=client))
+        client.close()
+        return client.spans
+
+    def decoded_spans(self) -> List[Dict[str, Any]]:
+        spans = []
+        for body in self.collector.requests:
+            resources, request_spans = decode_export_request(gzip.decompress(body))
+            self.assertEqual(resources[0]["service.name"], "claude-code")
+            spans += request_spans
+        return spans
+
+    def test_request_headers(self):
+        self.export()
+        headers = self.collector.headers[0]
+        self.assertEqual(headers["content-type"], "application/x-protobuf")
+        self.assertEqual(headers["content-encoding"], "gzip")
+        self.assertEqual(headers["authorization"], "Bearer token-1")
+        self.assertEqual(headers["cozeloop-workspace-id"], "ws-1")
+
+    def test_span_tree(self):
+        started = self.export()
+        self.assertEqual(len(self.collector.requests), 1)
+        spans = self.decoded_spans()
+        self.assertEqual(len(spans), started)
+
+        by_id = {span["span_id"]: span for span in spans}
+        self.assertEqual(len(by_id), len(spans), "span ids are unique")
+        self.assertEqual(len({span["trace_id"] for span in spans}), 1)
+        for span in spans:
+            self.assertEqual(len(span["trace_id"]), 16)
+            self.assertEqual(len(span["span_id"]), 8)
+            self.assertEqual(span["kind"], 1)
+            self.assertLessEqual(span["start_ns"], span["end_ns"])
+
+        roots = [span for span in spans if not span["parent_span_id"]]
+        self.assertEqual([span["name"] for span in roots], ["claude_code_request"])
+        expected_parents = {"turn_": ("claude_code_request",), "model_call_": ("turn_",),
+                            "tool_": ("turn_", "agent_"), "agent_": ("turn_",), "subagent_model_": ("agent_",)}
+        for span in spans:
+            if span is roots[0]:
+                continue
+            parent = by_id[span["parent_span_id"]]
+            prefix = next(p for p in expected_parents if span["name"].startswith(p))
+            self.assertTrue(parent["name"].startswith(expected_parents[prefix]),
+                            f"{span['name']} under {parent['name']}")
+            self.assertLessEqual(parent["start_ns"], span["start_ns"])
+            self.assertLessEqual(span["end_ns"], parent["end_ns"])
+        self.assertTrue(any(span["name"].startswith("subagent_model_") for span in spans))
+
+    def test_span_attributes(self):
+        self.export()
+        spans = self.decoded_spans()
+        for span in spans:
+            attributes = span["attributes"]
+            self.assertIn(attributes["cozeloop.span_type"], ("main", "model", "tool", "agent"))
+            self.assertEqual(json.loads(attributes["cozeloop.system_tag_runtime"])["library"], "claude-code")
+            self.assertEqual(attributes["thread_id"], "session-1")
+
+        root = next(span for span in spans if span["name"] == "claude_code_request")
+        self.assertEqual(root["attributes"]["total_turns"], 3)
+        self.assertTrue(root["attributes"]["cozeloop.input"])
+
+        models = [span for span in spans if span["name"].startswith("model_call_")]
+        self.assertTrue(models)
+        for span in models:
+            attributes = span["attributes"]
+            self.assertEqual(attributes["cozeloop.span_type"], "model")
+            self.assertTrue(attributes["gen_ai.request.model"])
+            self.assertGreater(attributes["gen_ai.usage.input_tokens"], 0)
+            self.assertGreater(attributes["gen_ai.usage.output_tokens"], 0)
+            self.assertIsInstance(attributes["cache_hit_ratio"], float)
+            self.assertIn("messages", json.loads(attributes["cozeloop.input"]))
+            self.assertIn("choices", json.loads(attributes["cozeloop.output"]))
+
+        tools = [span for span in spans if span["attributes"]["cozeloop.span_type"] == "tool"]
+        self.assertTrue(tools)
+        for span in tools:
+            self.assertIn("cozeloop.input", span["attributes"])
+            self.assertIn("cozeloop.output", span["attributes"])
+            self.assertTrue(span["attributes"]["tool_name"])
+
+        # Span times come from the transcript (see Span Timing)
+        turn = next(span for span in spans if span["name"] == "turn_0")
+        first_turn = cozeloop_hook.group_messages_into_turns(cozeloop_hook.read_new_messages(self.transcript))[0]
+        prompt = first_turn["user_message"]["timestamp"]
+        prompt_time = datetime.fromisoformat(prompt.replace("Z", "+00:00"))
+        self.assertEqual(turn["start_ns"], int(prompt_time.timestamp() * 1e9))
+
+    def test_request_split(self):
+        started = self.export()
+        single = gzip.decompress(self.collector.requests[0])
+        self.collector.reset()
+        limit = len(single) // 4
+        with mock.patch.object(cozeloop_hook, "OTLP_MAX_REQUEST_BYTES", limit):
+            self.export()
+        self.assertGreater(len(self.collector.requests), 2)
+        for body in self.collector.requests:
+            raw = gzip.decompress(body)
+            _, spans = decode_export_request(raw)
+            # A request only exceeds the limit when it holds a single oversized span
+            self.assertTrue(len(raw) <= limit + 1024 or len(spans) == 1)
+        self.assertEqual(len(self.decoded_spans()), started)
+
+    def test_client_error_is_not_retried(self):
+        dropped = cozeloop_hook._export_failures["dropped"]
+        self.collector.statuses = [400]
+        started = self.export()
+        self.assertEqual(len(self.collector.requests), 1)
+        self.assertEqual(cozeloop_hook._export_failures["dropped"] - dropped, started)
+
+    def test_server_error_is_retried(self):
+        dropped = cozeloop_hook._export_failures["dropped"]
+        self.collector.statuses = [503]
+        started = self.export()
+        self.assertEqual(len(self.collector.requests), 2)
+        self.assertEqual(self.collector.requests[0], self.collector.requests[1])
+        self.assertEqual(cozeloop_hook._export_failures["dropped"], dropped)
+        self.assertEqual(len(decode_export_request(gzip.decompress(self.collector.requests[1]))[1]), started)
+
+    def test_persistent_server_error_drops_spans(self):
+        dropped = cozeloop_hook._export_failures["dropped"]
+        self.collector.statuses = [503, 503]
+        started = self.export()
+        self.assertEqual(len(self.collector.requests), 2)
+        self.assertEqual(cozeloop_hook._export_failures["dropped"] - dropped, started)
+
+
+if __name__ == "__main__":
+    unittest.main()